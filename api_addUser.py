@@ -3,15 +3,17 @@
 
 """
   添加用户信息接口
-  @Version: 1.0
+  @Version: 1.1
   @Author: lordli
   @Date: 2025-6-16
   @Update:
         1.0 构建基础服务
+        1.1 用户信息写入用户存储：新用户按默认值创建，老用户更新设备信息
 """
 from fastapi import APIRouter
 from pydantic import BaseModel
 from typing import Optional, Union
+from common_user_store import user_store
 
 router = APIRouter()
 
@@ -28,34 +30,35 @@ class UserData(BaseModel):
     batteryLevel: Optional[Union[str, int]] = None
     networkType: Optional[str] = None
 
-def addUser(user_data: UserData):
-    # 构建返回的用户数据结构
+async def addUser(user_data: UserData):
+    # 写入用户存储，返回库中的用户信息
+    user = await user_store.add_user(user_data.openid, user_data.model_dump(exclude={"openid"}))
     result = {
         "addUserResult": {
-            "userType": "vip",
+            "userType": "vip" if user["vip"] else "normal",
             "userData": {
-                "openid": user_data.openid,
-                "nickName": "User",
-                "mobileNo": None,
-                "inviter": "Lord",
-                "notice": 0,
+                "openid": user["openid"],
+                "nickName": user["nickName"],
+                "mobileNo": user["mobileNo"],
+                "inviter": user["inviter"],
+                "notice": user["notice"],
                 "HashPW": "",
-                "balanceAmount": 99,
-                "batteryLevel": str(user_data.batteryLevel) if user_data.batteryLevel else "无",
-                "brand": user_data.brand or "Unknown",
-                "createDate": "",
-                "deviceOrientation": user_data.deviceOrientation or "portrait",
-                "freeTry": 0,
-                "model": user_data.model or "Unknown",
-                "networkType": user_data.networkType or "wifi",
-                "osVer": user_data.osVer or "Unknown",
-                "platform": user_data.platform or "unknown",
-                "settings": "E",
-                "topupAmount": 99,
-                "vip": 1,
-                "wxFontSize": str(user_data.wxFontSize) if user_data.wxFontSize else "无",
-                "wxLang": user_data.wxLang or "zh",
-                "wxVer": user_data.wxVer or "Unknown"
+                "balanceAmount": user["balanceAmount"],
+                "batteryLevel": user["batteryLevel"],
+                "brand": user["brand"],
+                "createDate": user["createDate"],
+                "deviceOrientation": user["deviceOrientation"],
+                "freeTry": user["freeTry"],
+                "model": user["model"],
+                "networkType": user["networkType"],
+                "osVer": user["osVer"],
+                "platform": user["platform"],
+                "settings": user["settings"],
+                "topupAmount": user["topupAmount"],
+                "vip": user["vip"],
+                "wxFontSize": user["wxFontSize"],
+                "wxLang": user["wxLang"],
+                "wxVer": user["wxVer"]
             }
         }
     }
@@ -66,4 +69,4 @@ async def add_user(user_data: UserData):
     """
     添加用户信息
     """
-    return addUser(user_data)
\ No newline at end of file
+    return await addUser(user_data)
@@ -3,70 +3,122 @@
 
 """
 法律咨询聊天接口 -- 基于智谱AI GLM-4-Flash
-@Version: 1.0
+@Version: 1.4
 @Author: lordli
 @Date: 2025-06-09
 @Description: 提供法律咨询聊天功能，配合前端小程序使用
+@Update:
+        1.0 构建基础服务
+        1.1 要求模型按JSON分段输出（直接回答、法条引用、详细分析），流式模式下每段边生成边推送，
+            直接回答在分析生成之前就能显示；模型没有按格式输出时退回按关键词分段
+        1.2 示例列表写在代码中，getSample不再监视config.ini
+        1.3 流式请求同样经过 single_flight 合并；合并的请求按上游调用的实际token用量计费
+        1.4 合并的请求传入各自的VIP等级，合并的上游调用按其中最高的优先级排队
 """
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
 from pydantic import BaseModel
-from typing import Optional
-from common_ai_chat import chat_with_ai
-from configparser import ConfigParser
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Tuple
+from common_config import config
+from common_ai_chat import async_chat_with_usage, async_stream_chat_with_usage
+from common_admission import AdmissionRejected
+from common_metrics import track_chat
+from common_tracing import span
+from common_user_store import get_user_info, check_user_balance
+from common_usage_buffer import usage_buffer
+from common_function_registry import function_registry
+from common_sse import sse_event, sse_response
+from common_json_sections import JsonSectionParser, parse_json_sections
+from common_response_cache import response_cache
+from common_single_flight import single_flight
+from common_static_payload import StaticPayload
 import logging
 
-# 系统提示和参数配置常量
-FUNCTION_CONFIGS = {
-    'law': {
-        'system_prompt': "你是一个专业的法律顾问助手。请根据用户的问题提供准确、专业的法律建议和分析。在回答时，请分别提供：1. 直接回答用户问题的内容；2. 相关的法律条文或案例引用；3. 详细的法律分析。",
-        'temperature': 0.7
-    }
-}
-
-# 默认配置
-DEFAULT_SYSTEM_PROMPT = "你是一个专业的法律顾问助手，请用中文回答用户的法律问题。"
-
-# 读取配置文件
-config = ConfigParser()
-config.read(r'config.ini', encoding='utf-8')
-
 router = APIRouter()
 
 class ChatLegalRequest(BaseModel):
     function: str
     openid: str
     userInputStr: str
+    stream: Optional[bool] = False  # 为True时以SSE流式返回
+
+# 是否要求模型按JSON分段输出
+STRUCTURED_OUTPUT = config.getboolean('legal', 'structured_output', fallback=True)
+
+# 追加在系统提示之后的输出格式要求；直接回答排在最前面，流式模式下最先推送
+STRUCTURED_OUTPUT_INSTRUCTION = (
+    "请严格按以下JSON格式输出，不要输出JSON以外的任何内容，三个字段按此顺序、值均为字符串：\n"
+    '{"answer": "直接回答用户的问题", "statutes": "相关的法律条文或案例引用", "analysis": "详细的法律分析"}'
+)
 
-def get_user_info(openid: str):
+# JSON中的字段 -> 响应中的字段
+SECTION_FIELDS = {"answer": "ResultText", "statutes": "chosenText", "analysis": "analysisText"}
+
+# 没有解析出法条引用和分析时的默认内容
+DEFAULT_CHOSEN_TEXT = "请咨询专业律师获取具体法律条文引用。"
+DEFAULT_ANALYSIS_TEXT = "建议根据具体情况咨询专业法律人士进行详细分析。"
+
+def parse_legal_answer(ai_response: str) -> Tuple[str, str, str]:
     """
-    获取用户信息（模拟数据库查询）
+    解析AI响应，提取ResultText、chosenText和analysisText：
+    优先按JSON分段解析（回复被截断时使用已有的部分），不是JSON格式时按关键词分段
     """
-    # 这里应该查询数据库获取用户信息
-    # 为了演示，返回模拟数据
-    return {
-        "exists": True,
-        "vip": 1,
-        "balance": 99,
-        "freeTry": 0
-    }
+    sections = parse_json_sections(ai_response) if STRUCTURED_OUTPUT else None
+    if not sections or not sections.get("answer"):
+        return parse_ai_response(ai_response)
+    return (sections["answer"],
+            sections.get("statutes") or DEFAULT_CHOSEN_TEXT,
+            sections.get("analysis") or DEFAULT_ANALYSIS_TEXT)
 
-def check_user_balance(openid: str):
+async def sse_legal_stream(chunks: AsyncIterator[str],
+                           on_complete: Callable[[str], Dict[str, Any]],
+                           on_error: Callable[[Exception], Dict[str, Any]]) -> AsyncIterator[str]:
     """
-    检查用户余额
+    法律咨询的SSE事件流：边接收边解析JSON分段
+
+    - delta 事件：{"section": 字段, "content": 新生成的文本}，内容是解码后的文本而不是JSON原文
+    - section 事件：{"section": 字段, "content": 完整内容}，该段结束时立即推送
+    - done 事件：on_complete 的返回值（三段完整内容）
+
+    一开始就不是JSON格式时按原文推送 delta（不带section）；中途格式出错时不再推送，
+    以 done 事件中退回关键词分段的结果为准
     """
-    user_info = get_user_info(openid)
-    if not user_info["exists"]:
-        return False, "noUser"
-    
-    if user_info["balance"] <= 0 and user_info["freeTry"] <= 0:
-        return False, "runOut"
-    
-    return True, "ok"
+    parser = JsonSectionParser()
+    # json: 按分段推送；raw: 按原文推送；quiet: 中途格式出错，不再推送
+    mode = "json" if STRUCTURED_OUTPUT else "raw"
+    emitted = False
+    parts = []
+    try:
+        async for delta in chunks:
+            parts.append(delta)
+            if mode == "raw":
+                yield sse_event("delta", {"content": delta})
+                continue
+            if mode == "quiet":
+                continue
+            events = parser.feed(delta)
+            for kind, key, text in events:
+                field = SECTION_FIELDS.get(key)
+                if field is not None:
+                    emitted = True
+                    yield sse_event("delta" if kind == "delta" else "section", {"section": field, "content": text})
+            if parser.failed:
+                if emitted:
+                    mode = "quiet"
+                    logging.warning("法律咨询回复中途不符合JSON格式，结束后按关键词分段")
+                else:
+                    mode = "raw"
+                    yield sse_event("delta", {"content": "".join(parts)})
+    except Exception as e:
+        logging.exception("AI流式调用失败: %s", e)
+        yield sse_event("error", on_error(e))
+        return
+
+    yield sse_event("done", on_complete("".join(parts)))
 
 def parse_ai_response(ai_response: str):
     """
-    解析AI响应，提取ResultText、chosenText和analysisText
+    按关键词分段解析AI响应，提取ResultText、chosenText和analysisText（模型没有按JSON格式输出时使用）
     """
     # 尝试按照特定格式解析AI响应
     lines = ai_response.split('\n')
@@ -113,60 +165,71 @@ def parse_ai_response(ai_response: str):
     
     # 如果没有解析出chosen_text和analysis_text，则提供默认值
     if not chosen_text:
-        chosen_text = "请咨询专业律师获取具体法律条文引用。"
+        chosen_text = DEFAULT_CHOSEN_TEXT
     if not analysis_text:
-        analysis_text = "建议根据具体情况咨询专业法律人士进行详细分析。"
+        analysis_text = DEFAULT_ANALYSIS_TEXT
     
     return result_text, chosen_text, analysis_text
 
+def getSample():
+    """
+    法律问题示例列表
+    """
+    # 预定义的法律问题示例
+    sample_questions = {
+        'questionList': [
+            {
+                'text': '我想跟我堂哥结婚，可以吗？'
+            },
+            {
+                'text': '我现在16岁了，想跟男朋友结婚，可以吗？'
+            },
+            {
+                'text': '我的老婆以前没有重大疾病，在我们结婚三年之后被诊断为精神病，我现在想跟她离婚，要怎么办理？'
+            },
+            {
+                'text': '我在公司工作了5年，现在被无故辞退，我可以要求赔偿吗？'
+            },
+            {
+                'text': '邻居家的狗经常叫，影响我休息，我可以起诉他们吗？'
+            },
+            {
+                'text': '我借给朋友10万元，现在他不还钱，我该怎么办？'
+            }
+        ]
+    }
+
+    return {
+        "sample": sample_questions
+    }
+
+# 预先序列化的响应（示例写在代码中，不需要监视文件）
+sample_payload = StaticPayload(getSample, watch_files=())
+
 @router.put("/getSample/")
-async def get_sample():
+async def get_sample(request: Request):
     """
     获取法律问题示例列表
     """
     try:
-        # 返回预定义的法律问题示例
-        sample_questions = {
-            'questionList': [
-                {
-                    'text': '我想跟我堂哥结婚，可以吗？'
-                },
-                {
-                    'text': '我现在16岁了，想跟男朋友结婚，可以吗？'
-                },
-                {
-                    'text': '我的老婆以前没有重大疾病，在我们结婚三年之后被诊断为精神病，我现在想跟她离婚，要怎么办理？'
-                },
-                {
-                    'text': '我在公司工作了5年，现在被无故辞退，我可以要求赔偿吗？'
-                },
-                {
-                    'text': '邻居家的狗经常叫，影响我休息，我可以起诉他们吗？'
-                },
-                {
-                    'text': '我借给朋友10万元，现在他不还钱，我该怎么办？'
-                }
-            ]
-        }
-        
-        return {
-            "sample": sample_questions
-        }
+        return sample_payload.response(request)
         
     except Exception as e:
-        logging.error(f"getSample接口异常: {e}")
+        logging.exception("getSample接口异常: %s", e)
         return {
             "error": f"系统错误: {str(e)}"
         }
 
 @router.put("/chatLegal/")
+@track_chat("chatLegal", lambda: function_registry.names("chatLegal"))
 async def chat_legal(request: ChatLegalRequest):
     """
     法律咨询聊天接口
     """
     try:
         # 检查用户状态
-        balance_ok, balance_status = check_user_balance(request.openid)
+        with span("check_user_balance"):
+            balance_ok, balance_status = await check_user_balance(request.openid)
         if not balance_ok:
             if balance_status == "noUser":
                 return {
@@ -192,9 +255,13 @@ async def chat_legal(request: ChatLegalRequest):
         # 构建消息
         messages = []
         
+        # 本接口上该function的参数（系统提示、温度、max_tokens、模型）
+        spec = function_registry.resolve(request.function, "chatLegal")
+        system_prompt = spec.system_prompt
+        if STRUCTURED_OUTPUT:
+            system_prompt = f"{system_prompt}\n{STRUCTURED_OUTPUT_INSTRUCTION}"
+        
         # 添加系统提示
-        config_info = FUNCTION_CONFIGS.get(request.function, {})
-        system_prompt = config_info.get('system_prompt', DEFAULT_SYSTEM_PROMPT)
         messages.append({
             "role": "system",
             "content": system_prompt
@@ -206,24 +273,75 @@ async def chat_legal(request: ChatLegalRequest):
             "content": request.userInputStr
         })
         
+        # 排队优先级：VIP等级越高，上游繁忙时越优先
+        with span("get_user_info"):
+            user_priority = (await get_user_info(request.openid)).get("vip", 0)
+        
         # 调用AI接口
         try:
-            # 从配置文件读取AI参数
-            model = config.get('zhipu', 'model', fallback='glm-4-flash')
-            # 根据function参数获取对应的温度设置
-            config_info = FUNCTION_CONFIGS.get(request.function, {})
-            temperature = config_info.get('temperature', config.getfloat('zhipu', 'temperature', fallback=1.0))
-            max_tokens = config.getint('zhipu', 'max_completion_tokens', fallback=1000)
+            # AI参数取自功能注册表（已用config.ini的默认值补齐）
+            model = spec.model
+            temperature = spec.temperature
+            max_tokens = spec.max_tokens
+            
+            # 同一时刻相同的问题（如示例问题）只向AI发起一次调用，所有等待者按这次调用的实际用量计费
+            request_key = response_cache.make_key(model, system_prompt, request.userInputStr, temperature, max_tokens)
             
-            ai_response = chat_with_ai(
+            # 流式模式：边生成边推送各部分，流结束后推送完整的三部分
+            if request.stream:
+                # 后到的请求先重放已收到的内容再跟随；usage在流结束时填好
+                chunks, usage = single_flight.stream(request_key, lambda: async_stream_chat_with_usage(
+                    messages=messages,
+                    model=model,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    priority=user_priority
+                ), priority=user_priority)
+
+                def on_complete(ai_response: str):
+                    usage_buffer.record_chat(request.openid, "3", usage, messages, ai_response)
+                    with span("parse_answer"):
+                        result_text, chosen_text, analysis_text = parse_legal_answer(ai_response)
+                    return {
+                        "chatResult": {
+                            "status": "OK",
+                            "ResultText": result_text,
+                            "chosenText": chosen_text,
+                            "analysisText": analysis_text
+                        }
+                    }
+
+                def on_error(ai_error: Exception):
+                    if isinstance(ai_error, AdmissionRejected):
+                        return {
+                            "chatResult": {
+                                "status": "busy",
+                                "errMsg": str(ai_error)
+                            }
+                        }
+                    return {
+                        "chatResult": {
+                            "status": "error",
+                            "errMsg": f"AI服务暂时不可用: {str(ai_error)}"
+                        }
+                    }
+
+                return sse_response(sse_legal_stream(chunks, on_complete, on_error))
+            
+            ai_response, usage = await single_flight.do(request_key, lambda: async_chat_with_usage(
                 messages=messages,
                 model=model,
                 temperature=temperature,
-                max_tokens=max_tokens
-            )
+                max_tokens=max_tokens,
+                priority=user_priority
+            ), priority=user_priority)
             
             # 解析AI响应
-            result_text, chosen_text, analysis_text = parse_ai_response(ai_response)
+            with span("parse_answer"):
+                result_text, chosen_text, analysis_text = parse_legal_answer(ai_response)
+            
+            # 记入用户的用量（写后缓冲，不直接访问数据库）
+            usage_buffer.record_chat(request.openid, "3", usage, messages, ai_response)
             
             return {
                 "chatResult": {
@@ -234,8 +352,17 @@ async def chat_legal(request: ChatLegalRequest):
                 }
             }
             
+        except AdmissionRejected as busy_error:
+            # 上游繁忙，排队已满或排队超时
+            return {
+                "chatResult": {
+                    "status": "busy",
+                    "errMsg": str(busy_error)
+                }
+            }
+            
         except Exception as ai_error:
-            logging.error(f"AI调用失败: {ai_error}")
+            logging.exception("AI调用失败: %s", ai_error)
             return {
                 "chatResult": {
                     "status": "error",
@@ -244,7 +371,7 @@ async def chat_legal(request: ChatLegalRequest):
             }
     
     except Exception as e:
-        logging.error(f"chatLegal接口异常: {e}")
+        logging.exception("chatLegal接口异常: %s", e)
         return {
             "chatResult": {
                 "status": "error",
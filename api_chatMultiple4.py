@@ -12,25 +12,19 @@
 from fastapi import APIRouter
 from pydantic import BaseModel
 from typing import Optional
-from common_ai_chat import chat_with_ai
-from configparser import ConfigParser
+from common_ai_chat import async_chat_with_ai, async_stream_chat_with_ai, collect_usage
+from common_admission import AdmissionRejected
+from common_metrics import track_chat
+from common_tracing import span
+from common_user_store import get_user_info, check_user_balance
+from common_usage_buffer import usage_buffer
+from common_function_registry import function_registry
+from common_sse import sse_chat_stream, sse_response
+from common_session_store import Message, session_store, shared_prompt
+from common_session_summary import session_summarizer
+from common_context_window import select_context
 import logging
 
-# 系统提示和参数配置常量
-FUNCTION_CONFIGS = {
-    'chat4': {
-        'system_prompt': "你是我的助理。",
-        'temperature': 0.9
-    }
-}
-
-# 默认配置
-DEFAULT_SYSTEM_PROMPT = "你是一个有用的AI助手，请用中文回答用户的问题。"
-
-# 读取配置文件
-config = ConfigParser()
-config.read(r'config.ini', encoding='utf-8')
-
 router = APIRouter()
 
 class ChatMultiple4Request(BaseModel):
@@ -38,61 +32,27 @@ class ChatMultiple4Request(BaseModel):
     openid: str
     sessionid: int
     userInputStr: str
+    stream: Optional[bool] = False  # 为True时以SSE流式返回
 
-# 模拟会话存储（实际项目中应使用数据库）
-sessions = {}
-
-def get_user_info(openid: str):
-    """
-    获取用户信息（模拟数据库查询）
-    """
-    # 这里应该查询数据库获取用户信息
-    # 为了演示，返回模拟数据
-    return {
-        "exists": True,
-        "vip": 1,
-        "balance": 99,
-        "freeTry": 0
-    }
-
-def check_user_balance(openid: str):
-    """
-    检查用户余额
-    """
-    user_info = get_user_info(openid)
-    if not user_info["exists"]:
-        return False, "noUser"
-    
-    if user_info["balance"] <= 0 and user_info["freeTry"] <= 0:
-        return False, "runOut"
-    
-    return True, "ok"
+# 会话存储中区分本接口的命名空间
+SESSION_NAMESPACE = "chatMultiple4"
 
 def get_session_messages(sessionid: int, openid: str):
     """
-    获取会话历史消息
+    获取会话历史消息（Message记录的新列表，修改不会影响会话存储）
     """
-    session_key = f"{openid}_{sessionid}"
-    if session_key not in sessions:
-        sessions[session_key] = []
-    return sessions[session_key]
+    session_key = session_store.make_key(SESSION_NAMESPACE, openid, sessionid)
+    with span("session_get"):
+        return session_store.get(session_key) or []
 
-def save_session_message(sessionid: int, openid: str, role: str, content: str):
+async def save_session_messages(sessionid: int, openid: str, messages: list):
     """
-    保存会话消息
+    保存本轮新增的会话消息（超长历史和容量淘汰由会话存储负责），会话过长时在后台摘要最早的对话
     """
-    session_key = f"{openid}_{sessionid}"
-    if session_key not in sessions:
-        sessions[session_key] = []
-    
-    sessions[session_key].append({
-        "role": role,
-        "content": content
-    })
-    
-    # 限制会话历史长度，避免token过多
-    if len(sessions[session_key]) > 20:
-        sessions[session_key] = sessions[session_key][-20:]
+    session_key = session_store.make_key(SESSION_NAMESPACE, openid, sessionid)
+    with span("session_save"):
+        await session_store.extend_async(session_key, messages)
+    session_summarizer.maybe_schedule(session_key)
 
 def generate_new_session_id(openid: str):
     """
@@ -103,13 +63,15 @@ def generate_new_session_id(openid: str):
     return int(time.time())
 
 @router.put("/chatMultiple4/")
+@track_chat("chatMultiple4", lambda: function_registry.names("chatMultiple4"))
 async def chat_multiple4(request: ChatMultiple4Request):
     """
     多轮对话聊天接口4
     """
     try:
         # 检查用户状态
-        balance_ok, balance_status = check_user_balance(request.openid)
+        with span("check_user_balance"):
+            balance_ok, balance_status = await check_user_balance(request.openid)
         if not balance_ok:
             if balance_status == "noUser":
                 return {
@@ -142,42 +104,95 @@ async def chat_multiple4(request: ChatMultiple4Request):
         
         # 获取会话历史
         messages = get_session_messages(current_session_id, request.openid)
+        # 本轮新增的消息，AI调用成功后才写入会话历史
+        new_messages = []
+        
+        # 本接口上该function的参数（系统提示、温度、max_tokens、模型）
+        spec = function_registry.resolve(request.function, "chatMultiple4")
         
-        # 添加系统提示（如果是新会话）
+        # 添加系统提示（如果是新会话）；会话中只保存对共享提示的引用
         if len(messages) == 0:
-            # 根据function参数获取对应的系统提示
-            config_info = FUNCTION_CONFIGS.get(request.function, {})
-            system_prompt = config_info.get('system_prompt', DEFAULT_SYSTEM_PROMPT)
-            messages.append({
-                "role": "system",
-                "content": system_prompt
-            })
+            new_messages.append(shared_prompt(spec.system_prompt))
         
         # 添加用户消息
-        messages.append({
-            "role": "user",
-            "content": request.userInputStr
-        })
+        new_messages.append(Message("user", request.userInputStr))
+        messages = messages + new_messages
+        
+        # 排队优先级：VIP等级越高，上游繁忙时越优先
+        with span("get_user_info"):
+            user_priority = (await get_user_info(request.openid)).get("vip", 0)
         
         # 调用AI接口
         try:
-            # 从配置文件读取AI参数
-            model = config.get('zhipu', 'model', fallback='glm-4-flash')
-            # 根据function参数获取对应的温度设置
-            config_info = FUNCTION_CONFIGS.get(request.function, {})
-            temperature = config_info.get('temperature', config.getfloat('zhipu', 'temperature', fallback=1.0))
-            max_tokens = config.getint('zhipu', 'max_completion_tokens', fallback=1000)
+            # AI参数取自功能注册表（已用config.ini的默认值补齐）
+            model = spec.model
+            temperature = spec.temperature
+            max_tokens = spec.max_tokens
             
-            ai_response = chat_with_ai(
+            # 按token预算选择发送的历史消息（始终保留系统提示）
+            with span("select_context"):
+                messages, saved_tokens = select_context(messages, max_tokens)
+            
+            # 收集本次请求的上游token用量，回复完成后记入用户的用量
+            usage = collect_usage()
+            
+            # 流式模式：逐段推送AI回复，流结束后再保存会话历史
+            if request.stream:
+                async def on_complete(ai_response: str):
+                    usage_buffer.record_chat(request.openid, "4", usage, messages, ai_response)
+                    await save_session_messages(current_session_id, request.openid,
+                                          new_messages + [Message("assistant", ai_response)])
+                    return {
+                        "chatResult": {
+                            "status": "OK",
+                            "GPTmsg": ai_response,
+                            "sessionId": current_session_id
+                        }
+                    }
+
+                def on_error(ai_error: Exception):
+                    if isinstance(ai_error, AdmissionRejected):
+                        return {
+                            "chatResult": {
+                                "status": "busy",
+                                "errMsg": str(ai_error),
+                                "sessionId": current_session_id
+                            }
+                        }
+                    return {
+                        "chatResult": {
+                            "status": "error",
+                            "errMsg": f"AI服务暂时不可用: {str(ai_error)}",
+                            "sessionId": current_session_id
+                        }
+                    }
+
+                return sse_response(sse_chat_stream(
+                    async_stream_chat_with_ai(
+                        messages=messages,
+                        model=model,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        priority=user_priority
+                    ),
+                    on_complete,
+                    on_error
+                ))
+            
+            ai_response = await async_chat_with_ai(
                 messages=messages,
                 model=model,
                 temperature=temperature,
-                max_tokens=max_tokens
+                max_tokens=max_tokens,
+                priority=user_priority
             )
             
             # 保存用户消息和AI回复到会话历史
-            save_session_message(current_session_id, request.openid, "user", request.userInputStr)
-            save_session_message(current_session_id, request.openid, "assistant", ai_response)
+            await save_session_messages(current_session_id, request.openid,
+                                  new_messages + [Message("assistant", ai_response)])
+            
+            # 记入用户的用量（写后缓冲，不直接访问数据库）
+            usage_buffer.record_chat(request.openid, "4", usage, messages, ai_response)
             
             return {
                 "chatResult": {
@@ -187,8 +202,18 @@ async def chat_multiple4(request: ChatMultiple4Request):
                 }
             }
             
+        except AdmissionRejected as busy_error:
+            # 上游繁忙，排队已满或排队超时
+            return {
+                "chatResult": {
+                    "status": "busy",
+                    "errMsg": str(busy_error),
+                    "sessionId": current_session_id
+                }
+            }
+            
         except Exception as ai_error:
-            logging.error(f"AI调用失败: {ai_error}")
+            logging.exception("AI调用失败: %s", ai_error)
             return {
                 "chatResult": {
                     "status": "error",
@@ -198,7 +223,7 @@ async def chat_multiple4(request: ChatMultiple4Request):
             }
     
     except Exception as e:
-        logging.error(f"chatMultiple4接口异常: {e}")
+        logging.exception("chatMultiple4接口异常: %s", e)
         return {
             "chatResult": {
                 "status": "error",
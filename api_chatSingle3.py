@@ -3,76 +3,55 @@
 
 """
 单轮对话聊天接口 -- 基于智谱AI GLM-4-Flash
-@Version: 1.0
+@Version: 1.4
 @Author: lordli
 @Date: 2025-06-09
 @Description: 提供单轮对话聊天功能，配合前端小程序使用
+@Update:
+        1.0 构建基础服务
+        1.1 批量接口 /chatSingle3Batch/：同一function的多条输入一次提交，只检查一次余额、扣一次费
+        1.2 流式请求同样经过 single_flight 合并；合并的请求和命中缓存的请求按上游调用的实际token用量计费
+        1.3 批量接口中命中缓存或与其他请求合并的条目，同样按上游调用的实际token用量计费
+        1.4 合并的请求传入各自的VIP等级，合并的上游调用按其中最高的优先级排队
 """
 
+import asyncio
+import json
 from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
-from common_ai_chat import chat_with_ai
-from configparser import ConfigParser
+from typing import Any, Dict, List, Optional, Tuple
+from common_config import config
+from common_ai_chat import async_chat_with_usage, async_stream_chat_with_usage
+from common_admission import AdmissionRejected
+from common_metrics import track_chat
+from common_tracing import span
+from common_user_store import get_user_info, check_user_balance
+from common_usage_buffer import usage_buffer
+from common_function_registry import FunctionSpec, function_registry
+from common_sse import sse_chat_stream, sse_response, iter_text
+from common_response_cache import response_cache
+from common_single_flight import single_flight
 import logging
 import time
 
-# 系统提示和参数配置常量
-FUNCTION_CONFIGS = {
-    'translate2En': {
-        'system_prompt': "I want you to act as an English translator, spelling corrector and improver. I will speak to you in any language and you will detect the language, translate it and answer in the corrected and improved version of my text, in English. I want you to replace my simplified A0-level words and sentences with more beautiful and elegant, upper level English words and sentences. Keep the meaning same, but make them more literary. I want you to only reply the correction, the improvements and nothing else, do not write explanations.",
-        'temperature': 0.8
-    },
-    'translate2Ch': {
-        'system_prompt': "你化身为中文专业翻译与润色大师。无论我采用何种语言，你务必迅速辨别，并对其进行精准、流畅、高雅的中文翻译和回复。望保持原意不变，又不失文学品味。请仅回复翻译结果，不要写出解释。",
-        'temperature': 0.8
-    },
-    'dianping': {
-        'system_prompt': "你作为喜欢赞誉和表扬的人。请对如下内容做出点评，语言风格生动、活泼、有趣，尽量补充更多细节。例如：用户输入：乐喜棋牌室。你的回答：【乐喜棋牌室体验超棒！】\n环境干净整洁，麻将机灵敏流畅，包厢私密性强，隔音效果很棒，完全沉浸式搓麻！服务热情周到，茶水零食随时供应，老板还会主动帮忙调空调温度，细节满分～最近新换了舒适座椅，久坐不累，牌友们都夸赞。周末人很多，建议提前预约，但等待区也有茶饮招待，体验很贴心。价格透明合理，还会不定期送小福利，绝对是附近麻将爱好者的首选！强烈推荐给喜欢休闲聚会的朋友们～",
-        'temperature': 1.5,
-        'max_tokens': 200
-    }
-}
-
-# 默认配置
-DEFAULT_SYSTEM_PROMPT = "你是一个有用的AI助手，请用中文回答用户的问题。"
-
-# 读取配置文件
-config = ConfigParser()
-config.read(r'config.ini', encoding='utf-8')
-
 router = APIRouter()
 
 class ChatSingle3Request(BaseModel):
     function: str
     openid: str
     userInputStr: str
+    stream: Optional[bool] = False  # 为True时以SSE流式返回
 
-def get_user_info(openid: str):
-    """
-    获取用户信息（模拟数据库查询）
-    """
-    # 这里应该查询数据库获取用户信息
-    # 为了演示，返回模拟数据
-    return {
-        "exists": True,
-        "vip": 1,
-        "balance": 99,
-        "freeTry": 0
-    }
-
-def check_user_balance(openid: str):
-    """
-    检查用户余额
-    """
-    user_info = get_user_info(openid)
-    if not user_info["exists"]:
-        return False, "noUser"
-    
-    if user_info["balance"] <= 0 and user_info["freeTry"] <= 0:
-        return False, "noMoney"
-    
-    return True, "ok"
+class ChatSingle3BatchRequest(BaseModel):
+    function: str
+    openid: str
+    userInputs: List[str]
+    stream: Optional[bool] = False  # 为True时以NDJSON逐条返回（按完成的先后，每行带index）
+
+# 批量接口：每批最多的输入条数，以及每批同时进行的AI调用数（所有请求的总并发另由排队控制限制）
+BATCH_MAX_ITEMS = config.getint('batch', 'max_items', fallback=50)
+BATCH_CONCURRENCY = config.getint('batch', 'concurrency', fallback=4)
 
 def generate_session_id():
     """
@@ -81,13 +60,15 @@ def generate_session_id():
     return int(time.time())
 
 @router.put("/chatSingle3/")
+@track_chat("chatSingle3", lambda: function_registry.names("chatSingle3"))
 async def chat_single3(request: ChatSingle3Request):
     """
     单轮对话聊天接口
     """
     try:
         # 检查用户状态
-        balance_ok, balance_status = check_user_balance(request.openid)
+        with span("check_user_balance"):
+            balance_ok, balance_status = await check_user_balance(request.openid, depleted_status="noMoney")
         if not balance_ok:
             if balance_status == "noUser":
                 return {
@@ -113,18 +94,10 @@ async def chat_single3(request: ChatSingle3Request):
                 }
             }
         
-        # 根据function参数设置不同的系统提示和参数
-        if request.function in FUNCTION_CONFIGS:
-            config_data = FUNCTION_CONFIGS[request.function]
-            system_prompt = config_data['system_prompt']
-            temperature = config_data['temperature']
-            # 如果配置中指定了max_tokens，则使用指定的值
-            function_max_tokens = config_data.get('max_tokens')
-        else:
-            # 使用默认配置
-            system_prompt = DEFAULT_SYSTEM_PROMPT
-            temperature = config.getfloat('zhipu', 'temperature', fallback=1.0)
-            function_max_tokens = None
+        # 根据function参数取得系统提示和AI参数（功能注册表中已预先解析，未知的function使用默认配置）
+        spec = function_registry.resolve(request.function, "chatSingle3")
+        system_prompt = spec.system_prompt
+        temperature = spec.temperature
         
         # 构建单轮对话消息
         messages = [
@@ -138,21 +111,86 @@ async def chat_single3(request: ChatSingle3Request):
             }
         ]
         
+        # 排队优先级：VIP等级越高，上游繁忙时越优先
+        with span("get_user_info"):
+            user_priority = (await get_user_info(request.openid)).get("vip", 0)
+        
         # 调用AI接口
         try:
-            # 从配置文件读取AI参数
-            model = config.get('zhipu', 'model', fallback='glm-4-flash')
-            default_max_tokens = config.getint('zhipu', 'max_completion_tokens', fallback=1000)
+            model = spec.model
+            max_tokens = spec.max_tokens
             
-            # 如果function配置中指定了max_tokens，则使用指定的值，否则使用默认值
-            max_tokens = function_max_tokens if function_max_tokens is not None else default_max_tokens
+            # 确定性的function（翻译类、低温度）先查响应缓存
+            request_key = response_cache.make_key(model, system_prompt, request.userInputStr, temperature, max_tokens)
+            cache_key = None
+            cached_response = None
+            if response_cache.is_cacheable(request.function, temperature):
+                cache_key = request_key
+                with span("cache_lookup"):
+                    cached_response = response_cache.get(cache_key)
             
-            ai_response = chat_with_ai(
-                messages=messages,
-                model=model,
-                temperature=temperature,  # 使用根据function动态设置的temperature
-                max_tokens=max_tokens
-            )
+            # 流式模式：逐段推送AI回复
+            if request.stream:
+                if cached_response is not None:
+                    chunks, usage = iter_text(cached_response.text), cached_response.usage
+                else:
+                    # 同一时刻相同的流式请求只向AI发起一次调用，后到的请求先重放已收到的内容再跟随
+                    chunks, usage = single_flight.stream(request_key, lambda: async_stream_chat_with_usage(
+                        messages=messages,
+                        model=model,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        priority=user_priority
+                    ), priority=user_priority)
+
+                def on_complete(ai_response: str):
+                    # 按上游调用的实际用量计费（流结束时已填好），与其他请求合并或命中缓存时也是如此
+                    usage_buffer.record_chat(request.openid, "3", usage, messages, ai_response)
+                    if cache_key is not None and cached_response is None:
+                        response_cache.put(cache_key, ai_response, usage)
+                    return {
+                        "chatResult": {
+                            "status": "OK",
+                            "GPTmsg": ai_response,
+                            "sessionId": generate_session_id()
+                        }
+                    }
+
+                def on_error(ai_error: Exception):
+                    if isinstance(ai_error, AdmissionRejected):
+                        return {
+                            "chatResult": {
+                                "status": "busy",
+                                "errMsg": str(ai_error),
+                                "sessionId": generate_session_id()
+                            }
+                        }
+                    return {
+                        "chatResult": {
+                            "status": "error",
+                            "errMsg": f"AI服务暂时不可用: {str(ai_error)}",
+                            "sessionId": generate_session_id()
+                        }
+                    }
+
+                return sse_response(sse_chat_stream(chunks, on_complete, on_error))
+            
+            if cached_response is not None:
+                ai_response, usage = cached_response
+            else:
+                # 同一时刻相同的请求只向AI发起一次调用，所有等待者拿到同一个回复和这次调用的用量
+                ai_response, usage = await single_flight.do(request_key, lambda: async_chat_with_usage(
+                    messages=messages,
+                    model=model,
+                    temperature=temperature,  # 使用根据function动态设置的temperature
+                    max_tokens=max_tokens,
+                    priority=user_priority
+                ), priority=user_priority)
+                if cache_key is not None:
+                    response_cache.put(cache_key, ai_response, usage)
+            
+            # 记入用户的用量（写后缓冲，不直接访问数据库）
+            usage_buffer.record_chat(request.openid, "3", usage, messages, ai_response)
             
             return {
                 "chatResult": {
@@ -162,8 +200,18 @@ async def chat_single3(request: ChatSingle3Request):
                 }
             }
             
+        except AdmissionRejected as busy_error:
+            # 上游繁忙，排队已满或排队超时
+            return {
+                "chatResult": {
+                    "status": "busy",
+                    "errMsg": str(busy_error),
+                    "sessionId": generate_session_id()
+                }
+            }
+            
         except Exception as ai_error:
-            logging.error(f"AI调用失败: {ai_error}")
+            logging.exception("AI调用失败: %s", ai_error)
             return {
                 "chatResult": {
                     "status": "error",
@@ -173,11 +221,171 @@ async def chat_single3(request: ChatSingle3Request):
             }
     
     except Exception as e:
-        logging.error(f"chatSingle3接口异常: {e}")
+        logging.exception("chatSingle3接口异常: %s", e)
+        return {
+            "chatResult": {
+                "status": "error",
+                "errMsg": f"系统错误: {str(e)}",
+                "sessionId": generate_session_id()
+            }
+        }
+
+
+async def answer_batch_item(spec: FunctionSpec,
+                            function: str,
+                            user_input: str,
+                            priority: int,
+                            semaphore: asyncio.Semaphore,
+                            charges: List[Tuple[Dict[str, int], List[Dict[str, str]], str]]) -> Dict[str, Any]:
+    """
+    批量接口中的一条输入：与单条接口相同，确定性的function先查响应缓存，相同的请求同一时刻只调用一次AI；
+    成功的回复及其用量加入 charges，整批结束后一次记入用户的用量
+
+    命中缓存或与其他请求合并时，按生成该回复的上游调用的实际用量计费
+    """
+    if not user_input or user_input.strip() == "":
+        return {"status": "noSessionWord"}
+
+    messages = [
+        {"role": "system", "content": spec.system_prompt},
+        {"role": "user", "content": user_input}
+    ]
+    request_key = response_cache.make_key(spec.model, spec.system_prompt, user_input, spec.temperature, spec.max_tokens)
+    cacheable = response_cache.is_cacheable(function, spec.temperature)
+    try:
+        cached = response_cache.get(request_key) if cacheable else None
+        if cached is not None:
+            ai_response, usage = cached
+        else:
+            async with semaphore:
+                ai_response, usage = await single_flight.do(request_key, lambda: async_chat_with_usage(
+                    messages=messages,
+                    model=spec.model,
+                    temperature=spec.temperature,
+                    max_tokens=spec.max_tokens,
+                    priority=priority
+                ), priority=priority)
+            if cacheable:
+                response_cache.put(request_key, ai_response, usage)
+    except AdmissionRejected as busy_error:
+        return {"status": "busy", "errMsg": str(busy_error)}
+    except Exception as ai_error:
+        logging.exception("AI调用失败: %s", ai_error)
+        return {"status": "error", "errMsg": f"AI服务暂时不可用: {str(ai_error)}"}
+
+    charges.append((usage, messages, ai_response))
+    return {"status": "OK", "GPTmsg": ai_response}
+
+async def indexed(index: int, item):
+    """
+    给批量结果加上输入的序号（NDJSON按完成先后返回，客户端按index对应）
+    """
+    result = await item
+    return {"index": index, **result}
+
+@router.put("/chatSingle3Batch/")
+@track_chat("chatSingle3Batch", lambda: function_registry.names("chatSingle3"))
+async def chat_single3_batch(request: ChatSingle3BatchRequest):
+    """
+    单轮对话批量接口：同一function的多条输入（翻译、点评等），按输入顺序返回每条的结果和状态
+
+    只检查一次余额，整批成功的条目合计为一次用量；AI调用按 BATCH_CONCURRENCY 限制并发。
+    stream为True时以NDJSON返回：每完成一条输出一行 {"index", "status", "GPTmsg"}，
+    最后一行为 {"chatResult": {"status", "count", "sessionId"}}
+    """
+    try:
+        # 检查用户状态（整批一次）
+        with span("check_user_balance"):
+            balance_ok, balance_status = await check_user_balance(request.openid, depleted_status="noMoney")
+        if not balance_ok:
+            return {
+                "chatResult": {
+                    "status": balance_status,
+                    "sessionId": generate_session_id()
+                }
+            }
+
+        # 检查输入条数
+        if not request.userInputs:
+            return {
+                "chatResult": {
+                    "status": "noSessionWord",
+                    "sessionId": generate_session_id()
+                }
+            }
+        if len(request.userInputs) > BATCH_MAX_ITEMS:
+            return {
+                "chatResult": {
+                    "status": "tooMany",
+                    "errMsg": f"每批最多{BATCH_MAX_ITEMS}条",
+                    "sessionId": generate_session_id()
+                }
+            }
+
+        spec = function_registry.resolve(request.function, "chatSingle3")
+        with span("get_user_info"):
+            user_priority = (await get_user_info(request.openid)).get("vip", 0)
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+        charges = []
+        tasks = [
+            asyncio.create_task(indexed(index, answer_batch_item(
+                spec, request.function, user_input, user_priority, semaphore, charges
+            )))
+            for index, user_input in enumerate(request.userInputs)
+        ]
+
+        def charge():
+            # 整批成功的条目一次记入用量（写后缓冲，不直接访问数据库）
+            if charges:
+                usage_buffer.record_chats(request.openid, "3", charges)
+                charges.clear()
+
+        if request.stream:
+            async def ndjson_lines():
+                try:
+                    for item in asyncio.as_completed(tasks):
+                        yield json.dumps(await item, ensure_ascii=False) + "\n"
+                    yield json.dumps({
+                        "chatResult": {
+                            "status": "OK",
+                            "count": len(tasks),
+                            "sessionId": generate_session_id()
+                        }
+                    }, ensure_ascii=False) + "\n"
+                finally:
+                    # 客户端中途断开时取消剩余的调用，已完成的条目照常计费
+                    for task in tasks:
+                        task.cancel()
+                    charge()
+
+            return StreamingResponse(
+                ndjson_lines(),
+                media_type="application/x-ndjson",
+                headers={
+                    "Cache-Control": "no-cache",
+                    "X-Accel-Buffering": "no",
+                }
+            )
+
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            charge()
+
+        return {
+            "chatResult": {
+                "status": "OK",
+                "results": results,
+                "sessionId": generate_session_id()
+            }
+        }
+
+    except Exception as e:
+        logging.exception("chatSingle3Batch接口异常: %s", e)
         return {
             "chatResult": {
                 "status": "error",
                 "errMsg": f"系统错误: {str(e)}",
                 "sessionId": generate_session_id()
             }
-        }
\ No newline at end of file
+        }
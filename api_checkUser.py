@@ -3,36 +3,47 @@
 
 """
   检查用户信息接口
-  @Version: 1.0
+  @Version: 1.1
   @Author: lordli
   @Date: 2025-6-16
   @Update:
         1.0 构建基础服务
+        1.1 从用户存储读取用户信息，用户不存在时返回 noUser
 """
 from fastapi import APIRouter
 from pydantic import BaseModel
 from typing import Optional
+from common_user_store import user_store
 
 router = APIRouter()
 
 class CheckUserRequest(BaseModel):
     openid: str
 
-def checkUser(openid: str):
-    # 构建返回的用户检查结果，模拟数据库查询结果
+async def checkUser(openid: str):
+    # 读取库中的用户信息（不经过缓存，显示最新的余额）
+    user = await user_store.get_user(openid)
+    if user is None:
+        return {
+            "checkUserResult": {
+                "openid": openid,
+                "status": "noUser"
+            }
+        }
+
     result = {
         "checkUserResult": {
             "openid": openid,
-            "vip": 1,
-            "nickName": "尊贵用户",
-            "balanceAmount": 99,
-            "freeTry": 0,
-            "usedToken3": 0,
-            "usedToken4": 0,
-            "sysContent3": "你是一个得力的助手",
-            "sysContent4": "你是一个得力的助手",
-            "temperature3": 1,
-            "temperature4": 1,
+            "vip": user["vip"],
+            "nickName": user["nickName"],
+            "balanceAmount": user["balanceAmount"],
+            "freeTry": user["freeTry"],
+            "usedToken3": user["usedToken3"],
+            "usedToken4": user["usedToken4"],
+            "sysContent3": user["sysContent3"],
+            "sysContent4": user["sysContent4"],
+            "temperature3": user["temperature3"],
+            "temperature4": user["temperature4"],
             "status": "ok"
         }
     }
@@ -43,4 +54,4 @@ async def check_user(request: CheckUserRequest):
     """
     检查用户信息
     """
-    return checkUser(request.openid)
\ No newline at end of file
+    return await checkUser(request.openid)
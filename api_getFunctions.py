@@ -3,79 +3,24 @@
 
 """
   获得小程序首页功能列表
-  @Version: 1.0
+  @Version: 1.3
   @Author: lordli
   @Date: 2023-5-6
   @Update:
         1.0 构建基础服务
+        1.1 启动时预先序列化，支持ETag / 304
+        1.2 导航列表由功能注册表（functions.json）生成
+        1.3 只监视function配置文件（config.ini只在启动时解析一次，变化后重新生成的内容不变）
 """
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
+from common_static_payload import StaticPayload
+from common_function_registry import function_registry
 
 router = APIRouter()
 def getFunctions():
     """获取功能配置数据"""
     baseConfig = {
-        'naviConfig': [
-        {
-          'icon': '/images/navigator/icon-chat3.png',
-          'title': '畅聊 3.5',
-          'navigateMark': 'chat3',
-          'Tag': 'hot'
-        },
-        {
-          'icon': '/images/navigator/icon-chat4.png',
-          'title': '畅聊 4.0',
-          'navigateMark': 'chat4',
-          'Tag': 'new'
-        },
-        {
-          'icon': '/images/navigator/icon-dayi.png',
-          'title': '答疑解惑',
-          'navigateMark': 'queries',
-          'Tag': 'hot'
-        },
-        {
-          'icon': '/images/navigator/icon-law.png',
-          'title': '婚姻法咨询',
-          'navigateMark': 'hunyin_law',
-          'Tag': 'new'
-        },
-        {
-          'icon': '/images/navigator/icon-liao.png',
-          'title': '寂寞陪聊',
-          'navigateMark': 'lonely'
-        },
-        {
-          'icon': '/images/navigator/icon-poem.png',
-          'title': '吟游诗人',
-          'navigateMark': 'poet'
-        },
-        {
-          'icon': '/images/navigator/icon-zuoti.png',
-          'title': '少女Ani',
-          'navigateMark': 'MJPrompt'
-        },
-        {
-          'icon': '/images/navigator/icon-dianping.png',
-          'title': '写点评',
-          'navigateMark': 'dianping'
-        },
-        {
-          'icon': '/images/navigator/icon-kua.png',
-          'title': '夸夸我',
-          'navigateMark': 'kuakua'
-        },
-        {
-          'icon': '/images/navigator/icon-zhong.png',
-          'title': '中译英',
-          'navigateMark': 'translate2En'
-        },
-        {
-          'icon': '/images/navigator/icon-ying.png',
-          'title': '英译中',
-          'navigateMark': 'translate2Ch'
-        }
-        ],
+        'naviConfig': function_registry.navigation(),
         'labelConfig': {
           'label1': '用户名',
           'label2': '手机号码',
@@ -95,9 +40,13 @@ def getFunctions():
     
     return {'baseConfig': baseConfig}
 
+# 预先序列化的响应，function配置文件变化后自动重新生成
+functions_payload = StaticPayload(getFunctions, watch_files=(function_registry.path,))
+
 @router.put("/getFunctions/")
-async def get_functions():
+async def get_functions(request: Request):
     """
     获取小程序首页功能列表
     """
-    return getFunctions()
+    return functions_payload.response(request)
+
@@ -3,13 +3,16 @@
 
 """
   获得welcome页面中，图片下面的跑马灯
-  @Version: 1.0
+  @Version: 1.2
   @Author: lordli
   @Date: 2023-5-6
   @Update:
         1.0 构建基础服务
+        1.1 启动时预先序列化，支持ETag / 304
+        1.2 提示信息写在代码中，不再监视config.ini
 """
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
+from common_static_payload import StaticPayload
 
 router = APIRouter()
 
@@ -31,9 +34,13 @@ def getTips():
     }
     return result
 
+# 预先序列化的响应（数据写在代码中，不需要监视文件）
+tips_payload = StaticPayload(getTips, watch_files=())
+
 @router.put("/getTips/")
-async def get_tips():
+async def get_tips(request: Request):
     """
     获取欢迎页面的提示信息
     """
-    return getTips()
+    return tips_payload.response(request)
+
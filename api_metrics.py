@@ -0,0 +1,115 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  运行指标接口，供Prometheus抓取
+  @Version: 1.6
+  @Author: lordli
+  @Date: 2025-06-29
+  @Update:
+        1.0 构建基础服务：接口请求、聊天接口按function、上游调用、token用量，以及各模块的运行状态
+        1.1 服务启动各阶段的耗时
+        1.2 会话快照
+        1.3 会话滚动摘要
+        1.4 慢请求数
+        1.5 日志队列积压和丢弃数、访问日志抽样数
+        1.6 只增不减的累计计数改为counter类型导出（名称加 _total 后缀），callback_gauge 只用于当前值
+"""
+from common_config import config
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse, Response
+import common_context_window
+from common_metrics import metrics
+from common_admission import admission_controller
+from common_circuit_breaker import circuit_breaker, STATE_CLOSED, STATE_OPEN, STATE_HALF_OPEN
+from common_hedge import hedge_policy
+from common_response_cache import response_cache
+from common_session_store import session_store
+from common_session_snapshot import session_snapshot
+from common_session_summary import session_summarizer
+from common_tracing import tracing_stats
+from common_logging import access_log, log_shipper
+from common_single_flight import single_flight
+from common_usage_buffer import usage_buffer
+from common_startup import startup_report
+
+router = APIRouter()
+
+# Prometheus文本格式的Content-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 熔断器状态导出为数值：0正常，1半开，2熔断
+BREAKER_STATE_VALUES = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+
+# 各模块已有的统计在抓取时读取，不在热路径上额外计数；累计计数用 callback_counter，当前值用 callback_gauge
+metrics.callback_gauge("admission_inflight", "准入控制放行的在途上游调用数",
+                       lambda: admission_controller.inflight)
+metrics.callback_gauge("admission_queue_depth", "等待上游调用名额的请求数",
+                       lambda: admission_controller.queue_depth)
+metrics.callback_counter("admission_rejected_total", "准入控制拒绝的请求累计数",
+                         lambda: {"queue_full": admission_controller.rejected_full,
+                                  "timeout": admission_controller.rejected_timeout}, ("reason",))
+metrics.callback_gauge("circuit_breaker_state", "熔断器状态：0正常，1半开，2熔断",
+                       lambda: BREAKER_STATE_VALUES.get(circuit_breaker.state, 0))
+metrics.callback_counter("circuit_breaker_rejected_total", "熔断期间直接失败的调用累计数",
+                         lambda: circuit_breaker.rejected)
+metrics.callback_counter("hedge_requests_total", "对冲策略的累计计数",
+                         lambda: {"primary": hedge_policy.primaries,
+                                  "hedged": hedge_policy.hedges,
+                                  "hedge_won": hedge_policy.hedge_wins,
+                                  "budget_exhausted": hedge_policy.budget_exhausted,
+                                  "no_slot": hedge_policy.no_slot}, ("kind",))
+metrics.callback_gauge("response_cache_entries", "AI响应缓存的条目数",
+                       lambda: response_cache.stats()["entries"])
+metrics.callback_counter("response_cache_lookups_total", "AI响应缓存的累计查询数",
+                         lambda: {"hit": response_cache.hits, "miss": response_cache.misses}, ("result",))
+metrics.callback_gauge("session_store_entries", "内存中的会话数",
+                       lambda: session_store.stats()["entries"])
+metrics.callback_gauge("session_store_bytes", "内存中会话内容的估算字节数",
+                       lambda: session_store.stats()["bytes"])
+metrics.callback_counter("session_snapshot_sessions_total", "会话快照的累计计数",
+                         lambda: {"written": session_snapshot.written,
+                                  "deleted": session_snapshot.deleted,
+                                  "restored": session_snapshot.restored,
+                                  "paged_in": session_snapshot.stats()["paged_in"]}, ("kind",))
+metrics.callback_gauge("session_snapshot_duration_seconds", "最近一次会话快照的耗时",
+                       lambda: session_snapshot.last_duration)
+metrics.callback_counter("session_snapshot_errors_total", "会话快照写入失败的累计次数",
+                         lambda: session_snapshot.errors)
+metrics.callback_counter("session_summary_runs_total", "会话滚动摘要的累计次数",
+                         lambda: {"summarized": session_summarizer.summarized,
+                                  "discarded": session_summarizer.discarded,
+                                  "failed": session_summarizer.failed,
+                                  "skipped": session_summarizer.skipped}, ("result",))
+metrics.callback_counter("session_summary_folded_messages_total", "折叠进摘要的消息累计数",
+                         lambda: session_summarizer.folded_messages)
+metrics.callback_gauge("session_summary_pending", "等待或正在摘要的会话数",
+                       lambda: session_summarizer.stats()["pending"])
+metrics.callback_counter("slow_requests_total", "超过慢请求阈值的请求累计数",
+                         lambda: tracing_stats["slow_requests"])
+metrics.callback_gauge("log_queue_pending", "等待后台线程写出的日志条数",
+                       lambda: log_shipper.stats()["pending"])
+metrics.callback_counter("log_records_dropped_total", "日志积压时丢弃的INFO及以下日志累计数",
+                         lambda: log_shipper.stats()["dropped"])
+metrics.callback_counter("access_log_sampled_out_total", "访问日志抽样时未记录的请求累计数",
+                         lambda: access_log.sampled_out)
+metrics.callback_counter("single_flight_folded_total", "被合并到同一次上游调用的请求累计数",
+                         lambda: single_flight.folded)
+metrics.callback_gauge("usage_buffer_pending_users", "用量缓冲中尚未写入数据库的用户数",
+                       lambda: usage_buffer.stats()["pending_users"])
+metrics.callback_counter("usage_buffer_flush_errors_total", "用量批量写入失败的累计次数",
+                         lambda: usage_buffer.flush_errors)
+metrics.callback_gauge("startup_phase_seconds", "服务启动各阶段的耗时，total为启动到就绪的总耗时",
+                       lambda: dict(startup_report.phases), ("phase",))
+metrics.callback_counter("context_window_saved_tokens_total", "上下文裁剪累计节省的token数",
+                         lambda: common_context_window.total_saved_tokens)
+
+
+@router.get("/metrics")
+async def get_metrics():
+    """
+    以Prometheus文本格式导出全部运行指标
+    """
+    if not config.getboolean('metrics', 'enabled', fallback=True):
+        return Response(status_code=404)
+    return PlainTextResponse(metrics.render(), media_type=CONTENT_TYPE)
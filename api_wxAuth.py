@@ -3,41 +3,128 @@
 
 """
   通过微信官方接口，获取OpenId
-  @Version: 1.0
+  @Version: 1.2
   @Author: lordli
   @Date: 2023-3-21
   @Update:
         1.0 构建基础服务
+        1.1 改用共享连接池的异步HTTP客户端，增加连接/读取超时、有限次重试和耗时统计
+        1.2 code只能使用一次，只在请求未发出（连接失败）和5xx时重试；读取超时不再重试，
+            微信返回的内容无法解析时同样按错误格式返回
 """
-import json
-import requests
+import asyncio
+import logging
+import time
+import httpx
 from fastapi import APIRouter
 from pydantic import BaseModel
-from configparser import ConfigParser
+from common_config import config
+from typing import Optional
+from common_metrics import LatencyHistogram
 
 router = APIRouter()
 
 class WxAuthRequest(BaseModel):
     code: str
 
-# 读取配置文件
-config = ConfigParser()
-config.read(r'config.ini', encoding='utf-8')
+# 微信接口地址，可在config.ini中改为本地模拟服务的地址
+WECHAT_API_BASE = "https://api.weixin.qq.com"
 
-def getOpenId(code):
+# 调用jscode2session的耗时分布
+wx_latency = LatencyHistogram()
+
+# 请求尚未发出、可以安全重试的异常（code只能使用一次，已发出的请求重试会得到40163）
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# 进程级共享的HTTP客户端，首次使用时创建
+_http_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    获取共享的异步HTTP客户端，连接池和超时参数从config.ini的[wechat]段读取
+    """
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            base_url=config.get('wechat', 'api_base', fallback=WECHAT_API_BASE),
+            limits=httpx.Limits(
+                max_connections=config.getint('wechat', 'pool_max_connections', fallback=50),
+                max_keepalive_connections=config.getint('wechat', 'pool_max_keepalive', fallback=10),
+            ),
+            timeout=httpx.Timeout(
+                config.getfloat('wechat', 'read_timeout', fallback=5.0),
+                connect=config.getfloat('wechat', 'connect_timeout', fallback=2.0),
+            ),
+        )
+    return _http_client
+
+async def close_http_client():
+    """
+    关闭共享的HTTP客户端（在服务关闭时调用）
+    """
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+def error_response(error) -> dict:
+    """
+    按微信的错误格式返回，前端按登录失败处理
+    """
+    return {
+        "openid": {
+            "errcode": -1,
+            "errmsg": f"微信登录服务暂时不可用: {error}"
+        }
+    }
+
+async def getOpenId(code):
     appid = config.get('wechat', 'appid')
     secret = config.get('wechat', 'secret')
-    url = 'https://api.weixin.qq.com/sns/jscode2session?appid={}&secret={}&js_code={}&grant_type=authorization_code'.format(appid,secret,code)
-    req = requests.get(url)
-    data = json.loads(req.text)
-    # 包装返回数据以匹配前端期望的结构
-    return {
-        "openid": data
+    params = {
+        'appid': appid,
+        'secret': secret,
+        'js_code': code,
+        'grant_type': 'authorization_code'
     }
+    max_retries = config.getint('wechat', 'max_retries', fallback=2)
+    retry_delay = config.getfloat('wechat', 'retry_delay', fallback=0.2)
+
+    # 只对连接失败和5xx重试；微信返回的业务错误（errcode）原样交给前端
+    last_error = None
+    for attempt in range(max_retries + 1):
+        start = time.perf_counter()
+        try:
+            req = await get_http_client().get('/sns/jscode2session', params=params)
+            if req.status_code >= 500:
+                raise httpx.HTTPStatusError(f"微信接口返回{req.status_code}", request=req.request, response=req)
+            data = req.json()
+            # 包装返回数据以匹配前端期望的结构
+            return {
+                "openid": data
+            }
+        except (RETRYABLE_ERRORS + (httpx.HTTPStatusError,)) as e:
+            last_error = e
+            logging.error("微信登录接口调用失败（第%s次）: %r", attempt + 1, e)
+        except httpx.TransportError as e:
+            # 请求可能已经到达微信，code已被使用，重试也只会得到40163
+            logging.error("微信登录接口调用失败，不再重试: %r", e)
+            return error_response(e)
+        except ValueError as e:
+            logging.error("微信登录接口返回的内容无法解析: %r", e)
+            return error_response(e)
+        finally:
+            wx_latency.observe(time.perf_counter() - start)
+
+        if attempt < max_retries:
+            await asyncio.sleep(retry_delay * (2 ** attempt))
+
+    # 重试用尽
+    return error_response(last_error)
 
 @router.put("/wxAuth/")
 async def wx_login(request: WxAuthRequest):
     """
     微信小程序登录，获取OpenId
     """
-    return getOpenId(request.code)
+    return await getOpenId(request.code)
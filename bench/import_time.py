@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+导入耗时报告 -- 用 python -X importtime 导入服务，按顶层模块汇总导入耗时
+@Version: 1.0
+@Author: lordli
+@Date: 2025-07-03
+@Description: -X importtime 的原始输出有上千行，这里按顶层包（fastapi、httpx、api_chatLaw……）合并，
+              按累计耗时排序，便于找出拖慢冷启动的依赖；结果以JSON格式输出，便于回归对比。
+              在项目根目录运行（需要能读取到 config.ini）
+
+  @Launch: python bench/import_time.py --module server --repeat 3 --top 20 --output import_time.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from typing import Dict, List, Any
+
+# 项目根目录，导入服务时以它作为工作目录
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_importtime(module: str) -> List[Dict[str, Any]]:
+    """
+    在新的解释器中导入module，解析 -X importtime 的输出
+
+    Returns:
+        每个被导入模块一项：name、self_us（自身耗时，微秒）、cumulative_us（含子模块）、depth（嵌套层级）
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败:\n{proc.stderr[-2000:]}")
+
+    entries = []
+    for line in proc.stderr.splitlines():
+        # 格式：import time:  self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            entries.append({
+                "name": name.strip(),
+                "self_us": int(self_us),
+                "cumulative_us": int(cumulative_us),
+                "depth": (len(name) - len(name.lstrip())) // 2,
+            })
+        except ValueError:
+            continue
+    return entries
+
+
+def summarize(entries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    按顶层包汇总：self_ms 为该包所有模块自身耗时之和；
+    cumulative_ms 为该包被首次导入时的累计耗时（只统计最外层的导入，不重复计算）
+    """
+    packages: Dict[str, Dict[str, Any]] = {}
+    for entry in entries:
+        top = entry["name"].split(".")[0]
+        item = packages.setdefault(top, {"package": top, "self_ms": 0.0, "cumulative_ms": 0.0, "modules": 0})
+        item["self_ms"] += entry["self_us"] / 1000
+        item["modules"] += 1
+
+    # 每个包取嵌套层级最浅的那次导入的累计耗时
+    shallowest: Dict[str, int] = {}
+    for entry in entries:
+        top = entry["name"].split(".")[0]
+        if entry["name"] == top and entry["depth"] < shallowest.get(top, sys.maxsize):
+            shallowest[top] = entry["depth"]
+            packages[top]["cumulative_ms"] = entry["cumulative_us"] / 1000
+
+    for item in packages.values():
+        item["self_ms"] = round(item["self_ms"], 1)
+        item["cumulative_ms"] = round(item["cumulative_ms"], 1)
+    return sorted(packages.values(), key=lambda item: -item["self_ms"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="百变助理后台导入耗时报告")
+    parser.add_argument("--module", default="server", help="要导入的模块")
+    parser.add_argument("--repeat", type=int, default=3, help="重复次数，取总耗时最小的一次（排除磁盘缓存等干扰）")
+    parser.add_argument("--top", type=int, default=20, help="输出自身耗时最多的前N个包")
+    parser.add_argument("--output", default=None, help="JSON报告的输出文件，不指定则输出到标准输出")
+    args = parser.parse_args()
+
+    best = None
+    for _ in range(max(1, args.repeat)):
+        entries = run_importtime(args.module)
+        total = sum(entry["self_us"] for entry in entries)
+        if best is None or total < best[0]:
+            best = (total, entries)
+
+    total_us, entries = best
+    report = {
+        "module": args.module,
+        "python": platform.python_version(),
+        "total_ms": round(total_us / 1000, 1),
+        "modules": len(entries),
+        "packages": summarize(entries)[:args.top],
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
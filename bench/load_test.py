@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+端到端压测工具 -- 按指定并发驱动server.py中的各个接口，输出RPS、p50/p95/p99延迟和错误率
+@Version: 1.0
+@Author: lordli
+@Date: 2025-06-25
+@Description: 配合 bench/mock_upstream.py 使用，不消耗真实的智谱额度；结果以JSON格式输出，便于容量规划和回归对比
+
+  @Launch: python bench/load_test.py --base-url http://127.0.0.1:8000 --concurrency 1,10,100 --duration 10 --output report.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import platform
+import random
+import time
+import httpx
+from typing import Dict, List, Any, Callable
+
+# 法律示例问题，模拟热门问题被大量用户同时提交
+LEGAL_QUESTIONS = [
+    '我想跟我堂哥结婚，可以吗？',
+    '我在公司工作了5年，现在被无故辞退，我可以要求赔偿吗？',
+    '我借给朋友10万元，现在他不还钱，我该怎么办？',
+]
+
+_counter = itertools.count(1)
+
+# 压测使用的用户数，压测前通过 /addUser/ 注册，否则聊天接口只会返回 noUser
+BENCH_USERS = 1000
+
+
+def _openid() -> str:
+    return f"bench_{random.randint(1, BENCH_USERS)}"
+
+
+async def register_users(client: httpx.AsyncClient, concurrency: int):
+    """
+    注册压测用户（addUser对已存在的用户只更新设备信息，可重复执行）
+    """
+    openids = iter(range(1, BENCH_USERS + 1))
+
+    async def worker():
+        for n in openids:
+            await client.put("/addUser/", json={"openid": f"bench_{n}", "brand": "bench"})
+
+    await asyncio.gather(*[worker() for _ in range(max(1, min(concurrency, 20)))])
+
+
+# 各接口的请求构造：返回 (路径, 请求体)
+SCENARIOS: Dict[str, Callable[[], tuple]] = {
+    "getTips": lambda: ("/getTips/", None),
+    "getFunctions": lambda: ("/getFunctions/", None),
+    "getSample": lambda: ("/getSample/", None),
+    "wxAuth": lambda: ("/wxAuth/", {"code": f"code{next(_counter)}"}),
+    "checkUser": lambda: ("/checkUser/", {"openid": _openid()}),
+    "chatMultiple3": lambda: ("/chatMultiple3/", {
+        "function": "chat3",
+        "openid": _openid(),
+        "sessionid": random.randint(1, 200),
+        "userInputStr": "今天天气怎么样？",
+    }),
+    "chatMultiple4": lambda: ("/chatMultiple4/", {
+        "function": "chat4",
+        "openid": _openid(),
+        "sessionid": random.randint(1, 200),
+        "userInputStr": "帮我写一首关于秋天的短诗",
+    }),
+    "chatSingle3": lambda: ("/chatSingle3/", {
+        "function": random.choice(["translate2En", "translate2Ch", "dianping"]),
+        "openid": _openid(),
+        "userInputStr": random.choice(["你好，世界", "Good morning", "这家店的火锅很好吃"]),
+    }),
+    "chatSingle3Batch": lambda: ("/chatSingle3Batch/", {
+        "function": random.choice(["translate2En", "translate2Ch"]),
+        "openid": _openid(),
+        "userInputs": random.sample(["你好，世界", "早上好", "谢谢", "这家店的火锅很好吃", "明天见"], 3),
+    }),
+    "chatLegal": lambda: ("/chatLegal/", {
+        "function": "hunyin_law",
+        "openid": _openid(),
+        "userInputStr": random.choice(LEGAL_QUESTIONS),
+    }),
+}
+
+# 默认压测的接口
+DEFAULT_SCENARIOS = ["getTips", "getFunctions", "getSample", "wxAuth", "chatMultiple3", "chatSingle3", "chatLegal"]
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """
+    计算百分位（最近秩法），输入需已排序
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def is_error(status_code: int, body: bytes) -> bool:
+    """
+    判断一次请求是否失败：HTTP错误，接口返回的 chatResult.status 为 error / busy，或流式响应中出现error事件
+    """
+    if status_code >= 400:
+        return True
+    if status_code == 304 or not body:
+        return False
+    if body.startswith(b"event:"):
+        # 流式响应（SSE）：出现error事件即为失败
+        return b"event: error" in body
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return False
+    if isinstance(data, dict) and isinstance(data.get("chatResult"), dict):
+        return data["chatResult"].get("status") in ("error", "busy")
+    return False
+
+
+async def run_scenario(client: httpx.AsyncClient,
+                       name: str,
+                       concurrency: int,
+                       duration: float,
+                       stream: bool) -> Dict[str, Any]:
+    """
+    以固定并发持续压测一个接口
+
+    Returns:
+        Dict[str, Any]: 该接口在该并发下的统计结果
+    """
+    build = SCENARIOS[name]
+    latencies: List[float] = []
+    ttfbs: List[float] = []
+    errors = 0
+    statuses: Dict[str, int] = {}
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            path, body = build()
+            if stream and body is not None and name.startswith("chat"):
+                body = dict(body, stream=True)
+            start = time.perf_counter()
+            try:
+                async with client.stream("PUT", path, json=body) as response:
+                    ttfb = None
+                    chunks = []
+                    async for chunk in response.aiter_bytes():
+                        if ttfb is None:
+                            ttfb = time.perf_counter() - start
+                        chunks.append(chunk)
+                    elapsed = time.perf_counter() - start
+                    code = str(response.status_code)
+                    failed = is_error(response.status_code, b"".join(chunks))
+            except httpx.HTTPError as e:
+                elapsed = time.perf_counter() - start
+                ttfb = None
+                code = type(e).__name__
+                failed = True
+
+            latencies.append(elapsed)
+            if ttfb is not None:
+                ttfbs.append(ttfb)
+            statuses[code] = statuses.get(code, 0) + 1
+            if failed:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    ttfbs.sort()
+    total = len(latencies)
+    return {
+        "endpoint": name,
+        "concurrency": concurrency,
+        "stream": stream,
+        "requests": total,
+        "duration": round(wall, 3),
+        "rps": round(total / wall, 2) if wall > 0 else 0.0,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "errors": errors,
+        "status_codes": statuses,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            "mean": round(sum(latencies) / total * 1000, 2) if total else 0.0,
+        },
+        "ttfb_ms": {
+            "p50": round(percentile(ttfbs, 50) * 1000, 2),
+            "p95": round(percentile(ttfbs, 95) * 1000, 2),
+            "p99": round(percentile(ttfbs, 99) * 1000, 2),
+        },
+    }
+
+
+async def run(args) -> Dict[str, Any]:
+    concurrency_levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    scenarios = [s.strip() for s in args.endpoints.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"未知的接口: {', '.join(unknown)}，可选: {', '.join(SCENARIOS)}")
+
+    limits = httpx.Limits(max_connections=max(concurrency_levels), max_keepalive_connections=max(concurrency_levels))
+    results = []
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.timeout) as client:
+        await register_users(client, max(concurrency_levels))
+        for name in scenarios:
+            for concurrency in concurrency_levels:
+                # 先预热，避免把建立连接的时间算进结果
+                if args.warmup > 0:
+                    await run_scenario(client, name, concurrency, args.warmup, args.stream)
+                result = await run_scenario(client, name, concurrency, args.duration, args.stream)
+                results.append(result)
+                print(f"{name:<14} c={concurrency:<5} rps={result['rps']:<10} "
+                      f"p50={result['latency_ms']['p50']}ms p95={result['latency_ms']['p95']}ms "
+                      f"p99={result['latency_ms']['p99']}ms err={result['error_rate']:.2%}", flush=True)
+
+    return {
+        "base_url": args.base_url,
+        "started_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "duration_per_run": args.duration,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="百变助理后台端到端压测")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--concurrency", default="1,10,50", help="并发数列表，逗号分隔")
+    parser.add_argument("--duration", type=float, default=10.0, help="每个接口在每个并发下的压测时长（秒）")
+    parser.add_argument("--warmup", type=float, default=1.0, help="每轮压测前的预热时长（秒）")
+    parser.add_argument("--endpoints", default=",".join(DEFAULT_SCENARIOS), help=f"压测的接口，可选: {','.join(SCENARIOS)}")
+    parser.add_argument("--stream", action="store_true", help="聊天接口使用流式模式，额外统计首字节时间")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default=None, help="JSON报告的输出文件，不指定则输出到标准输出")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
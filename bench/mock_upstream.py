@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+本地模拟上游服务 -- 模拟智谱AI的chat/completions接口和微信的jscode2session接口
+@Version: 1.0
+@Author: lordli
+@Date: 2025-06-25
+@Description: 压测时替代真实的上游，不消耗智谱额度。可配置延迟分布、逐token流式输出、错误率、429注入和并发上限
+
+  @Launch: python bench/mock_upstream.py --port 9000 --latency-dist lognormal --latency-mean 1.5
+           然后在config.ini中设置：
+               [zhipu]  base_url = http://127.0.0.1:9000
+               [wechat] api_base = http://127.0.0.1:9000
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 模拟回复使用的文本，按字符逐个作为token输出
+REPLY_TEXT = "这是本地模拟服务生成的回复内容，用于压测百变助理后台的吞吐量和延迟表现。"
+
+
+class MockSettings:
+    """
+    模拟服务的运行参数（由命令行参数填充）
+    """
+    latency_dist = "fixed"      # fixed / uniform / exponential / lognormal
+    latency_mean = 1.0          # 非流式请求的平均延迟（秒）
+    latency_sigma = 0.5         # lognormal分布的sigma，uniform分布为均值上下浮动的比例
+    ttft = 0.3                  # 流式请求的首token延迟（秒）
+    token_interval = 0.02       # 流式请求每个token之间的间隔（秒）
+    reply_tokens = 40           # 每次回复的token数
+    error_rate = 0.0            # 返回500的概率
+    rate_limit_rate = 0.0       # 返回429的概率
+    max_concurrency = 0         # 同时处理的请求上限，超出返回429（0为不限制）
+    wechat_latency = 0.05       # 微信接口的延迟（秒）
+
+
+settings = MockSettings()
+app = FastAPI(title="mock upstream")
+
+# 统计数据
+stats = {
+    "requests": 0,
+    "inflight": 0,
+    "max_inflight": 0,
+    "errors": 0,
+    "rate_limited": 0,
+}
+
+
+def sample_latency() -> float:
+    """
+    按配置的分布抽样一次延迟（秒）
+    """
+    mean = settings.latency_mean
+    if settings.latency_dist == "uniform":
+        spread = mean * settings.latency_sigma
+        return max(0.0, random.uniform(mean - spread, mean + spread))
+    if settings.latency_dist == "exponential":
+        return random.expovariate(1.0 / mean) if mean > 0 else 0.0
+    if settings.latency_dist == "lognormal":
+        # 让分布的均值等于latency_mean，长尾由sigma控制
+        sigma = settings.latency_sigma
+        mu = math.log(mean) - sigma ** 2 / 2 if mean > 0 else 0.0
+        return random.lognormvariate(mu, sigma) if mean > 0 else 0.0
+    return mean
+
+
+def estimate_prompt_tokens(messages) -> int:
+    return sum(len(str(m.get("content", ""))) for m in messages)
+
+
+def error_response(status_code: int, message: str) -> JSONResponse:
+    return JSONResponse(status_code=status_code, content={"error": {"code": str(status_code), "message": message}})
+
+
+@app.post("/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+
+    # 注入错误：并发超限、随机429、随机500
+    if settings.max_concurrency and stats["inflight"] >= settings.max_concurrency:
+        stats["rate_limited"] += 1
+        return error_response(429, "并发数超过限制")
+    roll = random.random()
+    if roll < settings.rate_limit_rate:
+        stats["rate_limited"] += 1
+        return error_response(429, "请求过于频繁")
+    if roll < settings.rate_limit_rate + settings.error_rate:
+        stats["errors"] += 1
+        return error_response(500, "模拟的服务端错误")
+
+    model = body.get("model", "glm-4-flash")
+    max_tokens = int(body.get("max_tokens") or settings.reply_tokens)
+    n_tokens = max(1, min(settings.reply_tokens, max_tokens))
+    tokens = [REPLY_TEXT[i % len(REPLY_TEXT)] for i in range(n_tokens)]
+    usage = {
+        "prompt_tokens": estimate_prompt_tokens(body.get("messages", [])),
+        "completion_tokens": n_tokens,
+        "total_tokens": estimate_prompt_tokens(body.get("messages", [])) + n_tokens,
+    }
+    created = int(time.time())
+
+    if body.get("stream"):
+        async def events():
+            stats["inflight"] += 1
+            stats["max_inflight"] = max(stats["max_inflight"], stats["inflight"])
+            try:
+                await asyncio.sleep(settings.ttft)
+                for index, token in enumerate(tokens):
+                    if index:
+                        await asyncio.sleep(settings.token_interval)
+                    chunk = {
+                        "id": "mock",
+                        "created": created,
+                        "model": model,
+                        "choices": [{"index": 0, "delta": {"role": "assistant", "content": token}}],
+                    }
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                last = {
+                    "id": "mock",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "finish_reason": "stop", "delta": {"role": "assistant", "content": ""}}],
+                    "usage": usage,
+                }
+                yield f"data: {json.dumps(last, ensure_ascii=False)}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                stats["inflight"] -= 1
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    stats["inflight"] += 1
+    stats["max_inflight"] = max(stats["max_inflight"], stats["inflight"])
+    try:
+        await asyncio.sleep(sample_latency())
+    finally:
+        stats["inflight"] -= 1
+
+    return {
+        "id": "mock",
+        "created": created,
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": "".join(tokens)},
+        }],
+        "usage": usage,
+    }
+
+
+@app.get("/sns/jscode2session")
+async def jscode2session(appid: str = "", secret: str = "", js_code: str = "", grant_type: str = ""):
+    """
+    模拟微信登录接口：根据code生成固定的openid
+    """
+    await asyncio.sleep(settings.wechat_latency)
+    if not js_code:
+        return {"errcode": 40029, "errmsg": "invalid code"}
+    return {"openid": f"mock_{js_code}", "session_key": "mock_session_key"}
+
+
+@app.get("/stats")
+async def get_stats():
+    """
+    查看模拟服务收到的请求统计
+    """
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="百变助理压测用的本地模拟上游服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "exponential", "lognormal"], default=settings.latency_dist)
+    parser.add_argument("--latency-mean", type=float, default=settings.latency_mean)
+    parser.add_argument("--latency-sigma", type=float, default=settings.latency_sigma)
+    parser.add_argument("--ttft", type=float, default=settings.ttft)
+    parser.add_argument("--token-interval", type=float, default=settings.token_interval)
+    parser.add_argument("--reply-tokens", type=int, default=settings.reply_tokens)
+    parser.add_argument("--error-rate", type=float, default=settings.error_rate)
+    parser.add_argument("--rate-limit-rate", type=float, default=settings.rate_limit_rate)
+    parser.add_argument("--max-concurrency", type=int, default=settings.max_concurrency)
+    parser.add_argument("--wechat-latency", type=float, default=settings.wechat_latency)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    for name in ("latency_dist", "latency_mean", "latency_sigma", "ttft", "token_interval", "reply_tokens",
+                 "error_rate", "rate_limit_rate", "max_concurrency", "wechat_latency"):
+        setattr(settings, name, getattr(args, name))
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
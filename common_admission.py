@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+上游调用准入控制 -- 限制同时在途的AI调用数，排队时VIP优先
+@Version: 1.2
+@Author: lordli
+@Date: 2025-06-26
+@Description: 达到服务商的并发上限时，请求按 VIP等级（高者优先）、到达时间（先到先得）排队；
+              排队超时或队列已满时明确返回“繁忙”，而不是无限等待
+@Update:
+        1.0 按优先级排队的准入控制
+        1.1 不排队的 try_acquire，对冲的备份请求只使用空闲名额
+        1.2 SharedPriority：合并的请求共用一次上游调用，排队时按其中最高的优先级
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from configparser import ConfigParser
+from common_config import config
+from typing import Callable, Optional, Dict, Any
+from common_metrics import LatencyHistogram
+
+# 排队等待时间的分桶（秒）
+QUEUE_WAIT_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class AdmissionRejected(Exception):
+    """
+    未获准调用上游：queue_full（队列已满）或 timeout（排队超时）
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(f"当前使用人数较多，请稍后再试（{reason}）")
+        self.reason = reason
+
+
+class SharedPriority:
+    """
+    多个请求共用的一次上游调用（single_flight 合并）的排队优先级，取所有等待者中最高的；
+    调用正在排队时加入了优先级更高的等待者，立即按新的优先级重新排队（到达顺序不变）
+    """
+
+    def __init__(self, priority: int = 0):
+        self.priority = priority
+        self._requeue: Optional[Callable[[int], None]] = None
+
+    def raise_to(self, priority: int):
+        if priority > self.priority:
+            self.priority = priority
+            if self._requeue is not None:
+                self._requeue(priority)
+
+
+# 当前上游调用共用的排队优先级，由 SingleFlight 在执行上游调用的任务中设置
+shared_priority: contextvars.ContextVar[Optional[SharedPriority]] = contextvars.ContextVar(
+    "shared_priority", default=None)
+
+
+class AdmissionController:
+    """
+    准入控制器
+
+    - max_inflight: 同时在途的上游调用上限
+    - max_queue: 排队请求数上限，超出后直接拒绝
+    - queue_timeout: 默认的排队超时时间（秒）
+
+    只在事件循环线程中使用，不需要加锁
+    """
+
+    def __init__(self,
+                 enabled: bool = True,
+                 max_inflight: int = 50,
+                 max_queue: int = 500,
+                 queue_timeout: float = 30.0):
+        self.enabled = enabled
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self.inflight = 0
+        # 堆中的元素：(-优先级, 到达序号, future)，已取消或已分到名额的future在出堆时跳过；
+        # 提高优先级时同一个future重新入堆一次，旧的元素同样在出堆时跳过
+        self._heap = []
+        self._waiting = 0
+        self._seq = itertools.count()
+
+        # 统计计数
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.queue_wait = LatencyHistogram(QUEUE_WAIT_BUCKETS)
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, section: str = 'admission') -> "AdmissionController":
+        """
+        从config.ini读取参数创建准入控制器
+        """
+        return cls(
+            enabled=config.getboolean(section, 'enabled', fallback=True),
+            max_inflight=config.getint(section, 'max_inflight', fallback=50),
+            max_queue=config.getint(section, 'max_queue', fallback=500),
+            queue_timeout=config.getfloat(section, 'queue_timeout', fallback=30.0),
+        )
+
+    @property
+    def queue_depth(self) -> int:
+        return self._waiting
+
+    async def acquire(self, priority: int = 0, timeout: Optional[float] = None):
+        """
+        申请一个上游调用名额，名额不足时按优先级排队
+
+        Args:
+            priority (int): 优先级，取用户的VIP等级，越大越优先；
+                在 single_flight 合并的调用中取所有等待者中最高的（见 SharedPriority）
+            timeout (float): 本次请求的排队超时时间，默认使用配置值
+
+        Raises:
+            AdmissionRejected: 队列已满或排队超时
+        """
+        if not self.enabled:
+            return
+
+        shared = shared_priority.get()
+        if shared is not None:
+            priority = max(priority, shared.priority)
+
+        # 有空闲名额且无人排队时直接通过
+        if self.inflight < self.max_inflight and self._waiting == 0:
+            self.inflight += 1
+            self.admitted += 1
+            self.queue_wait.observe(0.0)
+            return
+
+        if self._waiting >= self.max_queue:
+            self.rejected_full += 1
+            raise AdmissionRejected("queue_full")
+
+        future = asyncio.get_running_loop().create_future()
+        seq = next(self._seq)
+        heapq.heappush(self._heap, (-priority, seq, future))
+        self._waiting += 1
+        start = time.perf_counter()
+        if shared is not None:
+            shared._requeue = lambda p: self._requeue(p, seq, future)
+
+        try:
+            await asyncio.wait({future}, timeout=self.queue_timeout if timeout is None else timeout)
+        except BaseException:
+            # 等待期间请求被取消：已分到名额则归还，否则放弃排队
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+                self._waiting -= 1
+            raise
+        finally:
+            if shared is not None:
+                shared._requeue = None
+
+        # 以future的状态为准：超时返回后、恢复执行前仍可能刚好分到名额
+        if not future.done():
+            future.cancel()
+            self._waiting -= 1
+            self.rejected_timeout += 1
+            self.queue_wait.observe(time.perf_counter() - start)
+            raise AdmissionRejected("timeout")
+
+        self.admitted += 1
+        self.queue_wait.observe(time.perf_counter() - start)
+
+    def _requeue(self, priority: int, seq: int, future: asyncio.Future):
+        if not future.done():
+            heapq.heappush(self._heap, (-priority, seq, future))
+
+    def try_acquire(self) -> bool:
+        """
+        不排队地申请一个名额：有空闲名额且无人排队时占用并返回True，否则返回False。
+        用于可有可无的调用（对冲的备份请求），不与排队中的请求争抢名额
+        """
+        if not self.enabled:
+            return True
+        if self.inflight < self.max_inflight and self._waiting == 0:
+            self.inflight += 1
+            self.admitted += 1
+            return True
+        return False
+
+    def release(self):
+        """
+        归还名额：优先交给排队中优先级最高、到达最早的请求
+        """
+        if not self.enabled:
+            return
+
+        while self._heap:
+            _, _, future = heapq.heappop(self._heap)
+            if future.done():
+                continue
+            # 名额直接转交，在途数不变
+            self._waiting -= 1
+            future.set_result(None)
+            return
+
+        self.inflight -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = 0, timeout: Optional[float] = None):
+        """
+        以上下文管理器的方式占用一个名额：async with admission_controller.slot(vip): ...
+        """
+        await self.acquire(priority, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        返回在途数、队列深度和排队统计
+        """
+        return {
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "queue_depth": self._waiting,
+            "admitted": self.admitted,
+            "rejected_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+            "queue_wait": self.queue_wait.snapshot(),
+        }
+
+
+# 进程内共享的准入控制器，所有上游AI调用共用
+admission_controller = AdmissionController.from_config(config)
@@ -3,20 +3,199 @@
 
 """
 通用AI聊天接口 -- 基于智谱AI GLM-4-Flash
-@Version: 1.0
+@Version: 2.2
 @Author: lordli
 @Date: 2025-06-09
 @Description: 提供通用的AI聊天功能，接收消息数组，返回AI响应字符串
+@Update:
+        1.0 构建基础服务
+        1.1 新增进程级共享的异步客户端（连接池 + keep-alive），供各路由 await 调用，不再阻塞事件循环
+        1.2 新增流式调用，逐段返回上游生成的内容
+        1.3 上游调用经过准入控制，超过并发上限时按VIP等级排队
+        1.4 错误分类（超时、429、5xx、无效请求），可重试的错误按带抖动的指数退避重试，并接入熔断器
+        1.5 可选的对冲请求：主请求超过近期延迟分位数仍未返回时，发出备份请求（可用备用模型），取先返回者
+        1.6 记录上游调用的耗时、错误类型、在途数，以及响应usage中的token数
+        1.7 collect_usage：按请求收集上游返回的token用量，用于按用户计费
+        1.8 zhipuai SDK改为创建同步客户端时才导入，缩短服务启动时间
+        1.9 记录请求的耗时分段：排队等待、每次上游调用、重试退避、流式首个token
+        2.0 对冲的备份请求另占一个准入名额，没有空闲名额时不对冲
+        2.1 不可重试的错误（无效请求等）不再记为熔断器的成功调用
+        2.2 async_chat_with_usage / async_stream_chat_with_usage：返回单次调用自己的token用量，供合并的请求共享
 """
 
+import asyncio
 import json
-from configparser import ConfigParser
-from zhipuai import ZhipuAI
-from typing import List, Dict, Any
+import random
+import time
+import httpx
+from contextvars import ContextVar
+from common_config import config
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple
+from common_admission import admission_controller
+from common_circuit_breaker import CircuitBreaker, circuit_breaker
+from common_hedge import hedge_policy
+from common_metrics import upstream_request_duration, upstream_errors_total, upstream_inflight, record_upstream_usage
+from common_tracing import record_span, span
+
+# 智谱AI开放平台默认接口地址（与zhipuai SDK保持一致）
+DEFAULT_BASE_URL = "https://open.bigmodel.cn/api/paas/v4"
+
+# 当前请求的上游token用量：由 collect_usage() 放入一个dict，派生的任务继承上下文，累加到同一个dict
+_usage_sink: ContextVar[Optional[Dict[str, int]]] = ContextVar("ai_usage_sink", default=None)
+
+
+def _new_usage() -> Dict[str, int]:
+    return {"prompt_tokens": 0, "completion_tokens": 0}
+
+
+def collect_usage() -> Dict[str, int]:
+    """
+    开始收集当前请求中上游返回的token用量（prompt_tokens / completion_tokens），返回收集用的dict
+
+    在接口函数中调用，之后本请求的上游调用（包括流式调用）都会累加进来；
+    经 single_flight 合并的调用用 async_chat_with_usage / async_stream_chat_with_usage 单独取得用量，不计入这里
+    """
+    sink = _new_usage()
+    _usage_sink.set(sink)
+    return sink
+
+
+def _record_usage(model: str, usage: Any):
+    record_upstream_usage(model, usage)
+    sink = _usage_sink.get()
+    if sink is None or not isinstance(usage, dict):
+        return
+    for kind in sink:
+        amount = usage.get(kind)
+        if isinstance(amount, (int, float)) and amount > 0:
+            sink[kind] += int(amount)
+
+
+class AIChatError(Exception):
+    """
+    AI接口调用失败（异步客户端使用的错误类型基类）
+
+    retryable 表示该类错误是否值得重试
+    """
+    retryable = False
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(f"调用AI接口失败: {message}")
+        self.status_code = status_code
+
+
+class AITimeoutError(AIChatError):
+    """
+    连接或读取超时
+    """
+    retryable = True
+
+
+class AIRateLimitError(AIChatError):
+    """
+    429：请求过于频繁或超过并发限制
+    """
+    retryable = True
+
+    def __init__(self, message: str, status_code: Optional[int] = 429, retry_after: Optional[float] = None):
+        super().__init__(message, status_code)
+        self.retry_after = retry_after
+
+
+class AIServerError(AIChatError):
+    """
+    5xx或网络连接异常
+    """
+    retryable = True
+
+
+class AIInvalidRequestError(AIChatError):
+    """
+    其他4xx：请求参数、鉴权等问题，重试无意义
+    """
+    retryable = False
+
+
+class AICircuitOpenError(AIChatError):
+    """
+    熔断中，未向上游发起调用
+    """
+    retryable = False
+
+    def __init__(self):
+        super().__init__("AI服务熔断中，请稍后再试")
+
+
+def classify_error(error: Exception) -> AIChatError:
+    """
+    将底层异常转换为分类后的AI接口错误
+    """
+    if isinstance(error, AIChatError):
+        return error
+    if isinstance(error, httpx.TimeoutException):
+        return AITimeoutError(f"请求超时 {error!r}")
+    if isinstance(error, httpx.HTTPStatusError):
+        response = error.response
+        status_code = response.status_code
+        try:
+            detail = response.text[:200]
+        except Exception:
+            detail = ""
+        message = f"HTTP {status_code} {detail}"
+        if status_code == 429:
+            retry_after = None
+            try:
+                retry_after = float(response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+            return AIRateLimitError(message, status_code, retry_after)
+        if status_code >= 500:
+            return AIServerError(message, status_code)
+        return AIInvalidRequestError(message, status_code)
+    if isinstance(error, httpx.TransportError):
+        return AIServerError(f"网络异常 {error!r}")
+    return AIChatError(str(error))
+
+
+def validate_messages(messages: List[Dict[str, str]]):
+    """
+    校验消息列表格式，同步与异步客户端共用
+
+    Raises:
+        ValueError: 当输入参数无效时
+    """
+    if not isinstance(messages, list) or len(messages) == 0:
+        raise ValueError("messages必须是非空的列表")
+
+    for msg in messages:
+        if not isinstance(msg, dict) or 'role' not in msg or 'content' not in msg:
+            raise ValueError("每个消息必须包含 'role' 和 'content' 字段")
+
+        if msg['role'] not in ['system', 'user', 'assistant']:
+            raise ValueError("role必须是 'system', 'user' 或 'assistant'")
+
+
+def build_payload(messages: List[Dict[str, str]], model: str, temperature: float, max_tokens: int) -> Dict[str, Any]:
+    """
+    构建chat/completions请求体
+
+    temperature的取值范围是 (0.0, 1.0) 开区间，这里按zhipuai SDK的规则修正，
+    保证异步客户端与原来的同步SDK行为一致
+    """
+    payload = {
+        "model": model,
+        "messages": messages,
+        "max_tokens": max_tokens,
+    }
+    if temperature is not None:
+        if temperature <= 0:
+            payload["do_sample"] = False
+            temperature = 0.01
+        if temperature >= 1:
+            temperature = 0.99
+        payload["temperature"] = temperature
+    return payload
 
-# 从本地ini中读取默认配置
-config = ConfigParser()
-config.read(r'config.ini', encoding='utf-8')
 
 class CommonAIChat:
     """
@@ -36,6 +215,9 @@ class CommonAIChat:
         self.temperature = temperature
         self.max_tokens = max_tokens
         
+        # zhipuai SDK导入耗时较长，而服务中的接口都走下面的 AsyncAIClient，只在创建同步客户端时才导入
+        from zhipuai import ZhipuAI
+
         try:
             self.client = ZhipuAI(
                 api_key=config.get('zhipu', 'zhipu_api_key')
@@ -63,23 +245,16 @@ class CommonAIChat:
         """
         
         # 验证输入参数
-        if not isinstance(messages, list) or len(messages) == 0:
-            raise ValueError("messages必须是非空的列表")
-        
-        for msg in messages:
-            if not isinstance(msg, dict) or 'role' not in msg or 'content' not in msg:
-                raise ValueError("每个消息必须包含 'role' 和 'content' 字段")
-            
-            if msg['role'] not in ['system', 'user', 'assistant']:
-                raise ValueError("role必须是 'system', 'user' 或 'assistant'")
+        validate_messages(messages)
         
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-            )
+            with span("upstream_sdk"):
+                response = self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=self.temperature,
+                    max_tokens=self.max_tokens,
+                )
             
             if response and response.choices and len(response.choices) > 0:
                 result = response.choices[0].message.content
@@ -91,12 +266,287 @@ class CommonAIChat:
             raise Exception(f"调用AI接口失败: {e}")
 
 
+class AsyncAIClient:
+    """
+    异步AI聊天客户端
+
+    整个进程共享一个实例：底层的 httpx.AsyncClient 维护连接池并保持长连接，
+    每次请求不再重新建立HTTPS连接，await期间事件循环可以继续处理其他请求
+    """
+
+    def __init__(self,
+                 api_key: str,
+                 base_url: str = DEFAULT_BASE_URL,
+                 max_connections: int = 200,
+                 max_keepalive_connections: int = 50,
+                 keepalive_expiry: float = 30.0,
+                 connect_timeout: float = 10.0,
+                 read_timeout: float = 600.0,
+                 max_retries: int = 2,
+                 retry_base_delay: float = 0.5,
+                 retry_max_delay: float = 8.0,
+                 breaker: Optional[CircuitBreaker] = None):
+        """
+        初始化异步客户端
+
+        Args:
+            api_key (str): 智谱AI的api key
+            base_url (str): 接口地址，便于切换到代理或本地模拟服务
+            max_connections (int): 连接池最大连接数（即最大并发上游请求数）
+            max_keepalive_connections (int): 连接池中保持空闲的长连接数
+            keepalive_expiry (float): 空闲长连接的保持时间（秒）
+            connect_timeout (float): 建立连接的超时时间（秒）
+            read_timeout (float): 等待上游响应的超时时间（秒）
+            max_retries (int): 可重试错误（超时、429、5xx）的最大重试次数
+            retry_base_delay (float): 首次重试的退避时间上限（秒），之后按指数递增
+            retry_max_delay (float): 单次退避时间的上限（秒）
+            breaker (CircuitBreaker): 熔断器，默认使用进程共享的实例
+        """
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.breaker = breaker if breaker is not None else circuit_breaker
+        self.client = httpx.AsyncClient(
+            base_url=base_url.rstrip('/'),
+            headers={
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+            },
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+
+    def backoff_delay(self, attempt: int, error: AIChatError) -> float:
+        """
+        计算第attempt次重试前的等待时间：带完全抖动的指数退避，429时参考上游给出的Retry-After
+        """
+        delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * (2 ** attempt)))
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after:
+            delay = max(delay, min(retry_after, self.retry_max_delay))
+        return delay
+
+    def _before_attempt(self):
+        """
+        每次调用上游前检查熔断器
+        """
+        if not self.breaker.allow():
+            raise AICircuitOpenError()
+
+    def _after_failure(self, error: Exception) -> AIChatError:
+        """
+        分类错误并记录到熔断器：只有超时、429、5xx说明上游不健康；
+        其余错误（无效请求等）不能说明上游健康，也不计入错误率，半开时不会据此恢复
+        """
+        classified = classify_error(error)
+        if classified.retryable:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_neutral()
+        return classified
+
+    @staticmethod
+    def _record_error(model: str, error: AIChatError, started: float):
+        """
+        记录一次失败的上游调用：错误类型计数和耗时
+        """
+        upstream_errors_total.labels(model, type(error).__name__).inc()
+        upstream_request_duration.labels(model, "error").observe(time.perf_counter() - started)
+
+    async def chat(self,
+                   messages: List[Dict[str, str]],
+                   model: str = 'glm-4-flash',
+                   temperature: float = 0.7,
+                   max_tokens: int = 1000) -> str:
+        """
+        发送消息到AI并获取响应（异步），可重试的错误自动重试
+
+        Returns:
+            str: AI的响应内容
+
+        Raises:
+            ValueError: 当输入参数无效时
+            AIChatError: 当API调用失败时（具体子类见 classify_error）
+        """
+        validate_messages(messages)
+        payload = build_payload(messages, model, temperature, max_tokens)
+
+        attempt = 0
+        while True:
+            self._before_attempt()
+            started = time.perf_counter()
+            retry_delay = None
+            upstream_inflight.inc()
+            try:
+                response = await self.client.post("/chat/completions", json=payload)
+                response.raise_for_status()
+                data = response.json()
+
+                choices = data.get("choices") if isinstance(data, dict) else None
+                if not choices:
+                    raise AIChatError("AI响应为空或格式异常")
+                result = choices[0]["message"]["content"]
+                _record_usage(model, data.get("usage"))
+
+            except asyncio.CancelledError:
+                self.breaker.record_cancelled()
+                upstream_request_duration.labels(model, "cancelled").observe(time.perf_counter() - started)
+                raise
+            except Exception as e:
+                error = self._after_failure(e)
+                self._record_error(model, error, started)
+                if not error.retryable or attempt >= self.max_retries:
+                    raise error from e
+                retry_delay = self.backoff_delay(attempt, error)
+            finally:
+                upstream_inflight.dec()
+                record_span("upstream_attempt", started)
+
+            # 退避等待不计入在途数
+            if retry_delay is not None:
+                with span("upstream_backoff"):
+                    await asyncio.sleep(retry_delay)
+                attempt += 1
+                continue
+
+            self.breaker.record_success()
+            upstream_request_duration.labels(model, "ok").observe(time.perf_counter() - started)
+            return result
+
+    async def stream_chat(self,
+                          messages: List[Dict[str, str]],
+                          model: str = 'glm-4-flash',
+                          temperature: float = 0.7,
+                          max_tokens: int = 1000) -> AsyncIterator[str]:
+        """
+        以流式方式发送消息，上游每生成一段内容就立即产出（异步生成器）
+
+        只有在还没有产出任何内容时才会重试，已经推送给客户端的内容无法撤回
+
+        Yields:
+            str: AI响应的增量内容
+
+        Raises:
+            ValueError: 当输入参数无效时
+            AIChatError: 当API调用失败时
+        """
+        validate_messages(messages)
+
+        payload = build_payload(messages, model, temperature, max_tokens)
+        payload["stream"] = True
+
+        attempt = 0
+        while True:
+            self._before_attempt()
+            yielded = False
+            started = time.perf_counter()
+            retry_delay = None
+            upstream_inflight.inc()
+            try:
+                async with self.client.stream("POST", "/chat/completions", json=payload) as response:
+                    if response.status_code >= 400:
+                        await response.aread()
+                        response.raise_for_status()
+
+                    # 上游按SSE格式返回：data: {...}，以 data: [DONE] 结束
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+
+                        chunk = json.loads(data)
+                        # 最后一个数据块带有本次调用的usage
+                        _record_usage(model, chunk.get("usage"))
+                        choices = chunk.get("choices")
+                        if not choices:
+                            continue
+                        delta = (choices[0].get("delta") or {}).get("content")
+                        if delta:
+                            yielded = True
+                            yield delta
+
+            except (asyncio.CancelledError, GeneratorExit):
+                self.breaker.record_cancelled()
+                upstream_request_duration.labels(model, "cancelled").observe(time.perf_counter() - started)
+                raise
+            except Exception as e:
+                error = self._after_failure(e)
+                self._record_error(model, error, started)
+                if yielded or not error.retryable or attempt >= self.max_retries:
+                    raise error from e
+                retry_delay = self.backoff_delay(attempt, error)
+            finally:
+                upstream_inflight.dec()
+                record_span("upstream_attempt", started)
+
+            # 退避等待不计入在途数
+            if retry_delay is not None:
+                with span("upstream_backoff"):
+                    await asyncio.sleep(retry_delay)
+                attempt += 1
+                continue
+
+            self.breaker.record_success()
+            upstream_request_duration.labels(model, "ok").observe(time.perf_counter() - started)
+            return
+
+    async def aclose(self):
+        """
+        关闭连接池
+        """
+        await self.client.aclose()
+
+
+# 进程级共享的异步客户端，首次使用时创建
+_async_client: Optional[AsyncAIClient] = None
+
+
+def get_async_client() -> AsyncAIClient:
+    """
+    获取进程级共享的异步客户端，连接池参数从config.ini的[zhipu]段读取
+    """
+    global _async_client
+    if _async_client is None:
+        try:
+            _async_client = AsyncAIClient(
+                api_key=config.get('zhipu', 'zhipu_api_key'),
+                base_url=config.get('zhipu', 'base_url', fallback=DEFAULT_BASE_URL),
+                max_connections=config.getint('zhipu', 'pool_max_connections', fallback=200),
+                max_keepalive_connections=config.getint('zhipu', 'pool_max_keepalive', fallback=50),
+                keepalive_expiry=config.getfloat('zhipu', 'pool_keepalive_expiry', fallback=30.0),
+                connect_timeout=config.getfloat('zhipu', 'connect_timeout', fallback=10.0),
+                read_timeout=config.getfloat('zhipu', 'read_timeout', fallback=600.0),
+                max_retries=config.getint('zhipu', 'max_retries', fallback=2),
+                retry_base_delay=config.getfloat('zhipu', 'retry_base_delay', fallback=0.5),
+                retry_max_delay=config.getfloat('zhipu', 'retry_max_delay', fallback=8.0),
+            )
+        except Exception as e:
+            raise Exception(f"初始化异步AI客户端失败: {e}")
+    return _async_client
+
+
+async def close_async_client():
+    """
+    关闭共享的异步客户端（在服务关闭时调用）
+    """
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
 def chat_with_ai(messages: List[Dict[str, str]], 
                  model: str = 'glm-4-flash', 
                  temperature: float = 0.7, 
                  max_tokens: int = 1000) -> str:
     """
-    便捷函数：直接调用AI聊天接口
+    便捷函数：直接调用AI聊天接口（同步版本，会阻塞调用线程，仅供脚本使用）
     
     Args:
         messages (List[Dict[str, str]]): 消息列表
@@ -111,6 +561,140 @@ def chat_with_ai(messages: List[Dict[str, str]],
     return ai_chat.chat(messages)
 
 
+async def async_chat_with_ai(messages: List[Dict[str, str]],
+                             model: str = 'glm-4-flash',
+                             temperature: float = 0.7,
+                             max_tokens: int = 1000,
+                             priority: int = 0) -> str:
+    """
+    便捷函数：异步调用AI聊天接口，各路由统一使用此函数
+
+    Args:
+        messages (List[Dict[str, str]]): 消息列表
+        model (str): 模型名称
+        temperature (float): 温度参数
+        max_tokens (int): 最大token数量
+        priority (int): 排队优先级（用户的VIP等级），超过上游并发上限时高者优先
+
+    Returns:
+        str: AI响应内容
+
+    Raises:
+        AdmissionRejected: 排队队列已满或排队超时
+    """
+    queued = time.perf_counter()
+    async with admission_controller.slot(priority):
+        record_span("admission_wait", queued)
+        client = get_async_client()
+        if not hedge_policy.enabled:
+            return await client.chat(
+                messages,
+                model=model,
+                temperature=temperature,
+                max_tokens=max_tokens
+            )
+
+        # 对冲模式：主请求过慢时发出备份请求，取先返回的结果；备份请求另占一个名额，没有空闲名额时不对冲
+        backup_model = hedge_policy.fallback_model or model
+        return await hedge_policy.run(
+            lambda: client.chat(messages, model=model, temperature=temperature, max_tokens=max_tokens),
+            lambda: client.chat(messages, model=backup_model, temperature=temperature, max_tokens=max_tokens),
+            try_acquire=admission_controller.try_acquire,
+            release=admission_controller.release,
+        )
+
+
+async def async_stream_chat_with_ai(messages: List[Dict[str, str]],
+                                    model: str = 'glm-4-flash',
+                                    temperature: float = 0.7,
+                                    max_tokens: int = 1000,
+                                    priority: int = 0) -> AsyncIterator[str]:
+    """
+    便捷函数：以流式方式调用AI聊天接口，流结束前一直占用上游调用名额
+
+    Args:
+        messages (List[Dict[str, str]]): 消息列表
+        model (str): 模型名称
+        temperature (float): 温度参数
+        max_tokens (int): 最大token数量
+        priority (int): 排队优先级（用户的VIP等级）
+
+    Yields:
+        str: AI响应的增量内容
+    """
+    queued = time.perf_counter()
+    async with admission_controller.slot(priority):
+        record_span("admission_wait", queued)
+        started = time.perf_counter()
+        first = True
+        async for delta in get_async_client().stream_chat(
+            messages,
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens
+        ):
+            if first:
+                record_span("upstream_first_token", started)
+                first = False
+            yield delta
+
+
+async def async_chat_with_usage(messages: List[Dict[str, str]],
+                                model: str = 'glm-4-flash',
+                                temperature: float = 0.7,
+                                max_tokens: int = 1000,
+                                priority: int = 0) -> Tuple[str, Dict[str, int]]:
+    """
+    与 async_chat_with_ai 相同，另外返回这一次调用的上游token用量（不计入请求的 collect_usage）
+
+    经 single_flight 合并时所有等待者拿到同一个结果，各自按这次调用的实际用量计费
+
+    Returns:
+        Tuple[str, Dict[str, int]]: AI响应内容，token用量（prompt_tokens / completion_tokens）
+    """
+    usage = _new_usage()
+    token = _usage_sink.set(usage)
+    try:
+        reply = await async_chat_with_ai(
+            messages,
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            priority=priority
+        )
+    finally:
+        _usage_sink.reset(token)
+    return reply, usage
+
+
+def async_stream_chat_with_usage(messages: List[Dict[str, str]],
+                                 model: str = 'glm-4-flash',
+                                 temperature: float = 0.7,
+                                 max_tokens: int = 1000,
+                                 priority: int = 0) -> Tuple[AsyncIterator[str], Dict[str, int]]:
+    """
+    与 async_stream_chat_with_ai 相同，另外返回收集这一次调用token用量的dict（流结束时填好）
+
+    返回值即 single_flight.stream 的 factory 所需的格式；迭代器在独立的任务中消费，
+    用量只记入返回的dict，不计入请求的 collect_usage
+    """
+    usage = _new_usage()
+
+    async def chunks() -> AsyncIterator[str]:
+        # 在消费迭代器的任务的上下文中设置，不影响其他请求
+        _usage_sink.set(usage)
+        async for delta in async_stream_chat_with_ai(
+            messages,
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            priority=priority
+        ):
+            yield delta
+
+    return chunks(), usage
+
+
 if __name__ == "__main__":
     # 测试示例
     test_messages = [
@@ -124,4 +708,4 @@ if __name__ == "__main__":
         result = chat_with_ai(test_messages, temperature=0, max_tokens=50)
         print(f"AI响应: {result}")
     except Exception as e:
-        print(f"测试失败: {e}")
\ No newline at end of file
+        print(f"测试失败: {e}")
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+熔断器 -- 上游错误率过高时快速失败，定时放行少量探测请求
+@Version: 1.1
+@Author: lordli
+@Date: 2025-06-27
+@Description: 服务商故障期间，请求不再挂在超时上等待，直接返回失败，避免占满工作名额
+@Update:
+        1.0 滑动窗口错误率熔断
+        1.1 record_neutral：请求本身无效（400等）的调用既不算成功也不算失败，不会让半开的熔断器恢复
+"""
+
+import time
+from collections import deque
+from configparser import ConfigParser
+from common_config import config
+from typing import Dict, Any
+
+# 熔断器状态
+STATE_CLOSED = "closed"        # 正常放行
+STATE_OPEN = "open"            # 熔断中，直接失败
+STATE_HALF_OPEN = "half_open"  # 半开，放行少量探测请求
+
+
+class CircuitBreaker:
+    """
+    基于滑动时间窗口错误率的熔断器
+
+    - window: 统计错误率的时间窗口（秒）
+    - min_requests: 窗口内请求数达到该值后才判断错误率，避免少量请求误触发
+    - error_rate_threshold: 错误率达到该值即熔断
+    - open_duration: 熔断持续时间（秒），之后进入半开状态
+    - half_open_max_calls: 半开状态下同时放行的探测请求数
+
+    只在事件循环线程中使用，不需要加锁
+    """
+
+    def __init__(self,
+                 enabled: bool = True,
+                 window: float = 30.0,
+                 min_requests: int = 20,
+                 error_rate_threshold: float = 0.5,
+                 open_duration: float = 15.0,
+                 half_open_max_calls: int = 3):
+        self.enabled = enabled
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate_threshold = error_rate_threshold
+        self.open_duration = open_duration
+        self.half_open_max_calls = half_open_max_calls
+
+        self.state = STATE_CLOSED
+        self._opened_at = 0.0
+        self._half_open_calls = 0
+        # 窗口内的调用结果：(时间, 是否失败)
+        self._outcomes = deque()
+        self._failures = 0
+
+        # 统计计数
+        self.opened_count = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, section: str = 'circuit_breaker') -> "CircuitBreaker":
+        """
+        从config.ini读取参数创建熔断器
+        """
+        return cls(
+            enabled=config.getboolean(section, 'enabled', fallback=True),
+            window=config.getfloat(section, 'window', fallback=30.0),
+            min_requests=config.getint(section, 'min_requests', fallback=20),
+            error_rate_threshold=config.getfloat(section, 'error_rate_threshold', fallback=0.5),
+            open_duration=config.getfloat(section, 'open_duration', fallback=15.0),
+            half_open_max_calls=config.getint(section, 'half_open_max_calls', fallback=3),
+        )
+
+    def allow(self) -> bool:
+        """
+        判断本次调用是否放行；放行后必须调用 record_success、record_failure、record_neutral 或 record_cancelled
+        """
+        if not self.enabled:
+            return True
+
+        if self.state == STATE_OPEN:
+            if time.monotonic() - self._opened_at < self.open_duration:
+                self.rejected += 1
+                return False
+            # 熔断时间已过，进入半开状态
+            self.state = STATE_HALF_OPEN
+            self._half_open_calls = 0
+
+        if self.state == STATE_HALF_OPEN:
+            if self._half_open_calls >= self.half_open_max_calls:
+                self.rejected += 1
+                return False
+            self._half_open_calls += 1
+
+        return True
+
+    def record_success(self):
+        """
+        记录一次成功调用
+        """
+        if not self.enabled:
+            return
+        if self.state == STATE_HALF_OPEN:
+            # 探测成功，恢复正常，重新开始统计
+            self.state = STATE_CLOSED
+            self._outcomes.clear()
+            self._failures = 0
+            return
+        self._record(False)
+
+    def record_failure(self):
+        """
+        记录一次失败调用（仅统计超时、429、5xx等说明上游不健康的错误）
+        """
+        if not self.enabled:
+            return
+        if self.state == STATE_HALF_OPEN:
+            # 探测失败，重新熔断
+            self._open()
+            return
+        self._record(True)
+        total = len(self._outcomes)
+        if total >= self.min_requests and self._failures / total >= self.error_rate_threshold:
+            self._open()
+
+    def record_neutral(self):
+        """
+        记录一次不能说明上游是否健康的调用（请求本身无效、鉴权失败等），不计入错误率窗口；
+        半开状态下归还探测名额，由之后的调用继续探测
+        """
+        if self.enabled and self.state == STATE_HALF_OPEN and self._half_open_calls > 0:
+            self._half_open_calls -= 1
+
+    def record_cancelled(self):
+        """
+        放行后调用被取消（如对冲请求中输掉的一方），既不算成功也不算失败，归还半开状态的探测名额
+        """
+        self.record_neutral()
+
+    def _record(self, failed: bool):
+        now = time.monotonic()
+        self._outcomes.append((now, failed))
+        if failed:
+            self._failures += 1
+        # 移出窗口外的记录
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            _, old_failed = self._outcomes.popleft()
+            if old_failed:
+                self._failures -= 1
+
+    def _open(self):
+        self.state = STATE_OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self._failures = 0
+        self.opened_count += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        返回熔断器状态和统计
+        """
+        total = len(self._outcomes)
+        return {
+            "state": self.state,
+            "window_requests": total,
+            "window_error_rate": round(self._failures / total, 4) if total else 0.0,
+            "opened_count": self.opened_count,
+            "rejected": self.rejected,
+        }
+
+
+# 进程内共享的熔断器，保护上游AI调用
+circuit_breaker = CircuitBreaker.from_config(config)
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+配置文件 -- 进程内只解析一次 config.ini，各模块共享同一个 ConfigParser
+@Version: 1.0
+@Author: lordli
+@Date: 2025-07-03
+@Description: 以前每个模块导入时都各自读取并解析一遍 config.ini；改为在这里解析一次，
+              其他模块 from common_config import config
+"""
+
+from configparser import ConfigParser
+
+# 配置文件路径（相对于服务的工作目录）
+CONFIG_FILE = 'config.ini'
+
+config = ConfigParser()
+config.read(CONFIG_FILE, encoding='utf-8')
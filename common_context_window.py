@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+多轮对话上下文裁剪 -- 按token预算选择发送给AI的历史消息
+@Version: 1.2
+@Author: lordli
+@Date: 2025-06-21
+@Description: 始终保留系统提示（及会话的滚动摘要），从最新的对话轮次往前选取，直到用完prompt的token预算
+@Update:
+        1.0 构建基础服务
+        1.1 会话中的消息是紧凑的 Message 记录，选中的消息在这里才转换为发送给AI的dict
+        1.2 开头连续的系统消息（系统提示和摘要）都始终保留
+"""
+
+import logging
+from common_config import config
+from typing import List, Dict, Tuple, Optional
+
+# 每条消息的格式开销（role标记、分隔符等），按经验估算
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# 累计节省的prompt token数（进程内统计）
+total_saved_tokens = 0
+
+
+def is_cjk(ch: str) -> bool:
+    """
+    判断是否为中日韩文字或全角标点
+    """
+    code = ord(ch)
+    return (0x4E00 <= code <= 0x9FFF        # 中日韩统一表意文字
+            or 0x3400 <= code <= 0x4DBF     # 扩展A
+            or 0x3000 <= code <= 0x303F     # 中文标点
+            or 0xFF00 <= code <= 0xFFEF     # 全角字符
+            or 0x3040 <= code <= 0x30FF     # 日文假名
+            or 0xAC00 <= code <= 0xD7AF)    # 韩文
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算文本的token数，不依赖分词器
+
+    中日韩文字大致每个字1个token，其余字符（英文、数字、空白）大致每4个字符1个token
+    """
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if is_cjk(ch))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+
+def estimate_message_tokens(message: Dict[str, str]) -> int:
+    """
+    估算一条消息的token数（含格式开销）
+    """
+    return MESSAGE_OVERHEAD_TOKENS + estimate_tokens(message.get("content") or "")
+
+
+def get_prompt_budget(max_tokens: int) -> int:
+    """
+    计算本次请求可用的prompt token预算
+
+    取配置的prompt预算，与模型上下文窗口减去max_completion_tokens后的余量，两者中较小的一个
+    """
+    prompt_budget = config.getint('session', 'prompt_token_budget', fallback=4000)
+    context_window = config.getint('session', 'context_window_tokens', fallback=128000)
+    return max(0, min(prompt_budget, context_window - max_tokens))
+
+
+def select_context(messages: List[Dict[str, str]],
+                   max_tokens: int,
+                   prompt_budget: Optional[int] = None) -> Tuple[List[Dict[str, str]], int]:
+    """
+    按token预算选择发送给AI的消息
+
+    - 开头的系统提示始终保留（会话有滚动摘要时，摘要是紧随其后的系统消息，同样保留）
+    - 最后一轮（当前用户输入）始终保留
+    - 其余历史以“轮”为单位（user开头，包含其后的assistant回复），从新到旧选取，
+      遇到放不下的一轮即停止，保证上下文连续
+
+    Args:
+        messages (List[Dict[str, str]]): 完整的会话消息（含本轮用户输入），dict 或会话存储中的 Message 记录
+        max_tokens (int): 本次请求的max_completion_tokens
+        prompt_budget (int): prompt的token预算，默认按配置计算
+
+    Returns:
+        Tuple[List[Dict[str, str]], int]: 选中的消息（均为dict，可直接发送给AI），以及相对发送完整历史节省的token数
+    """
+    global total_saved_tokens
+
+    if prompt_budget is None:
+        prompt_budget = get_prompt_budget(max_tokens)
+
+    pinned_count = 0
+    while pinned_count < len(messages) and messages[pinned_count].get("role") == "system":
+        pinned_count += 1
+    pinned = messages[:pinned_count]
+    history = messages[pinned_count:]
+
+    # 按轮次分组：每个user消息开始新的一轮
+    turns = []
+    for message in history:
+        if message.get("role") == "user" or not turns:
+            turns.append([message])
+        else:
+            turns[-1].append(message)
+
+    used = sum(estimate_message_tokens(m) for m in pinned)
+    selected_turns = []
+    dropped_tokens = 0
+    for index in range(len(turns) - 1, -1, -1):
+        turn_tokens = sum(estimate_message_tokens(m) for m in turns[index])
+        # 最后一轮是本次的用户输入，无论如何都要发送
+        if index == len(turns) - 1 or used + turn_tokens <= prompt_budget:
+            selected_turns.append(turns[index])
+            used += turn_tokens
+        else:
+            dropped_tokens = sum(estimate_message_tokens(m) for turn in turns[:index + 1] for m in turn)
+            break
+
+    selected = list(pinned)
+    for turn in reversed(selected_turns):
+        selected.extend(turn)
+    selected = [m if isinstance(m, dict) else m.to_dict() for m in selected]
+
+    if dropped_tokens > 0:
+        total_saved_tokens += dropped_tokens
+        logging.info("上下文裁剪: 发送%s/%s条消息，约%s个token，节省约%s个prompt token",
+                     len(selected), len(messages), used, dropped_tokens)
+
+    return selected, dropped_tokens
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+功能注册表 -- 各聊天接口的function（系统提示、温度、max_tokens、模型、适用接口）统一在 functions.json 中配置
+@Version: 1.1
+@Author: lordli
+@Date: 2025-07-02
+@Description: 取代各接口模块中分别定义的 FUNCTION_CONFIGS；加载时把每个function的参数和config.ini中的默认值
+              合并成不可变的查找表，请求中只做一次字典查找，不再读取配置；
+              文件修改后自动重新加载，修改提示词不需要重启服务；getFunctions的导航列表也由它生成
+@Update:
+        1.0 构建基础服务
+        1.1 加载时规整系统提示：去掉缩进、每行开头结尾的空白和首尾空行，减少prompt token
+"""
+
+import json
+import logging
+import os
+import textwrap
+import time
+from common_config import config
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Dict, FrozenSet, Mapping, Optional, Tuple
+
+# 各聊天接口的名称，function的 endpoints 取这些值
+ENDPOINTS = ("chatMultiple3", "chatMultiple4", "chatSingle3", "chatLegal")
+
+
+def normalize_prompt(text: str) -> str:
+    """
+    规整系统提示：缩进和行首行尾的空白对模型没有意义，只会占用token（每次请求都要发送）
+    """
+    return "\n".join(line.strip() for line in textwrap.dedent(text).strip().splitlines())
+
+
+@dataclass(frozen=True)
+class FunctionSpec:
+    """
+    一个function在某个接口上的完整参数（已用config.ini的默认值补齐）
+    """
+    name: str
+    system_prompt: str
+    temperature: float
+    max_tokens: int
+    model: str
+    endpoints: FrozenSet[str]
+    title: str = ""
+    icon: str = ""
+    tag: str = ""
+
+
+class _Snapshot:
+    """
+    一次加载的结果，加载完成后不再修改，重新加载时整体替换
+    """
+
+    def __init__(self,
+                 functions: Mapping[str, FunctionSpec],
+                 aliases: Mapping[str, str],
+                 defaults: Mapping[str, FunctionSpec],
+                 order: Tuple[str, ...]):
+        self.functions = functions
+        self.aliases = aliases
+        self.defaults = defaults
+        self.order = order
+        # 每个接口可用的function名称（含别名），供指标按function统计时限定标签
+        self.names: Mapping[str, FrozenSet[str]] = MappingProxyType({
+            endpoint: frozenset(
+                [name for name, spec in functions.items() if endpoint in spec.endpoints] +
+                [alias for alias, name in aliases.items() if endpoint in functions[name].endpoints]
+            )
+            for endpoint in ENDPOINTS
+        })
+
+
+class FunctionRegistry:
+    """
+    功能注册表
+
+    - path: function配置文件（JSON）
+    - check_interval: 检查文件修改时间的最小间隔（秒），避免每次请求都访问文件系统
+
+    重新加载失败（文件格式错误等）时继续使用上一次的配置
+    """
+
+    def __init__(self, path: str = 'functions.json', check_interval: float = 5.0):
+        self.path = path
+        self.check_interval = check_interval
+
+        self._mtime = None
+        self._last_check = 0.0
+        self._snapshot = self._load()
+
+    def _load(self) -> _Snapshot:
+        self._mtime = self._file_mtime()
+        self._last_check = time.monotonic()
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+
+        default_model = config.get('zhipu', 'model', fallback='glm-4-flash')
+        default_temperature = config.getfloat('zhipu', 'temperature', fallback=1.0)
+        default_max_tokens = config.getint('zhipu', 'max_completion_tokens', fallback=1000)
+
+        def build(name: str, item: Dict[str, Any], endpoints) -> FunctionSpec:
+            return FunctionSpec(
+                name=name,
+                system_prompt=normalize_prompt(item['system_prompt']),
+                temperature=float(item.get('temperature', default_temperature)),
+                max_tokens=int(item.get('max_tokens', default_max_tokens)),
+                model=item.get('model') or default_model,
+                endpoints=frozenset(endpoints),
+                title=item.get('title', ''),
+                icon=item.get('icon', ''),
+                tag=item.get('tag', ''),
+            )
+
+        functions = {}
+        aliases = {}
+        for name, item in data.get('functions', {}).items():
+            endpoints = item.get('endpoints') or ()
+            unknown = set(endpoints) - set(ENDPOINTS)
+            if unknown:
+                raise ValueError(f"function {name} 的 endpoints 无效: {sorted(unknown)}")
+            functions[name] = build(name, item, endpoints)
+            for alias in item.get('aliases', ()):
+                aliases[alias] = name
+
+        defaults = {}
+        for endpoint in ENDPOINTS:
+            item = data.get('defaults', {}).get(endpoint)
+            if item is None:
+                raise ValueError(f"缺少接口 {endpoint} 的默认配置")
+            defaults[endpoint] = build("default", item, (endpoint,))
+
+        return _Snapshot(MappingProxyType(functions), MappingProxyType(aliases),
+                         MappingProxyType(defaults), tuple(functions))
+
+    def _file_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _refresh_if_changed(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        if self._file_mtime() != self._mtime:
+            try:
+                self._snapshot = self._load()
+                logging.warning("function配置已重新加载: %s", self.path)
+            except Exception as e:
+                logging.exception("function配置重新加载失败，继续使用旧配置: %s", e)
+
+    def resolve(self, function: str, endpoint: str) -> FunctionSpec:
+        """
+        查找function在该接口上的参数；未知的function，或不适用于该接口的function，使用接口的默认配置
+        """
+        self._refresh_if_changed()
+        snapshot = self._snapshot
+        spec = snapshot.functions.get(snapshot.aliases.get(function, function))
+        if spec is None or endpoint not in spec.endpoints:
+            return snapshot.defaults[endpoint]
+        return spec
+
+    def names(self, endpoint: str) -> FrozenSet[str]:
+        """
+        该接口可用的function名称（含别名）
+        """
+        self._refresh_if_changed()
+        return self._snapshot.names[endpoint]
+
+    def navigation(self) -> list:
+        """
+        小程序首页的导航列表：按文件中的顺序，只包含配置了标题的function
+
+        只在getFunctions的响应重新生成时调用，此时总是检查文件，避免生成的列表落后于文件
+        """
+        self._refresh_if_changed(force=True)
+        items = []
+        for name in self._snapshot.order:
+            spec = self._snapshot.functions[name]
+            if not spec.title:
+                continue
+            item = {'icon': spec.icon, 'title': spec.title, 'navigateMark': name}
+            if spec.tag:
+                item['Tag'] = spec.tag
+            items.append(item)
+        return items
+
+
+# 进程内共享的功能注册表
+function_registry = FunctionRegistry(
+    config.get('functions', 'path', fallback='functions.json'),
+    check_interval=config.getfloat('functions', 'check_interval', fallback=5.0),
+)
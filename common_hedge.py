@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+对冲请求 -- 主请求迟迟不返回时，再发一个备份请求，取先返回的结果
+@Version: 1.1
+@Author: lordli
+@Date: 2025-06-28
+@Description: 等待时间取最近延迟的指定分位数，备份请求可使用同一模型或配置的备用模型；
+              用预算限制备份请求的比例，避免成本翻倍
+@Update:
+        1.0 按延迟分位数发出备份请求
+        1.1 备份请求单独占用一个上游调用名额，没有空闲名额时不对冲，在途调用数不超过准入控制的上限
+"""
+
+import asyncio
+import time
+from collections import deque
+from configparser import ConfigParser
+from common_config import config
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# 每记录多少次延迟后重新计算一次分位数
+RECOMPUTE_EVERY = 20
+
+
+class HedgePolicy:
+    """
+    对冲策略
+
+    - percentile: 主请求超过最近延迟的该分位数仍未返回时发出备份请求
+    - min_delay: 发出备份请求前的最短等待时间（秒）
+    - fallback_model: 备份请求使用的模型，为空则与主请求相同
+    - budget_ratio: 备份请求数占主请求数的比例上限
+    - min_samples: 延迟样本数不足时不对冲
+    - window: 保留的延迟样本数
+
+    只在事件循环线程中使用，不需要加锁
+    """
+
+    def __init__(self,
+                 enabled: bool = False,
+                 percentile: float = 95.0,
+                 min_delay: float = 0.5,
+                 fallback_model: str = '',
+                 budget_ratio: float = 0.05,
+                 min_samples: int = 50,
+                 window: int = 500):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.fallback_model = fallback_model
+        self.budget_ratio = budget_ratio
+        self.min_samples = min_samples
+
+        self._latencies = deque(maxlen=window)
+        self._since_recompute = 0
+        self._delay: Optional[float] = None
+        # 对冲预算：每个主请求积累 budget_ratio，发出一个备份请求消耗 1
+        self._budget = 0.0
+
+        # 统计计数
+        self.primaries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.budget_exhausted = 0
+        self.no_slot = 0
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, section: str = 'hedge') -> "HedgePolicy":
+        """
+        从config.ini读取参数创建对冲策略
+        """
+        return cls(
+            enabled=config.getboolean(section, 'enabled', fallback=False),
+            percentile=config.getfloat(section, 'percentile', fallback=95.0),
+            min_delay=config.getfloat(section, 'min_delay', fallback=0.5),
+            fallback_model=config.get(section, 'fallback_model', fallback=''),
+            budget_ratio=config.getfloat(section, 'budget_ratio', fallback=0.05),
+            min_samples=config.getint(section, 'min_samples', fallback=50),
+            window=config.getint(section, 'window', fallback=500),
+        )
+
+    def record_latency(self, seconds: float):
+        """
+        记录一次成功调用的延迟
+        """
+        self._latencies.append(seconds)
+        self._since_recompute += 1
+        if self._delay is None or self._since_recompute >= RECOMPUTE_EVERY:
+            self._recompute()
+
+    def _recompute(self):
+        self._since_recompute = 0
+        if len(self._latencies) < self.min_samples:
+            self._delay = None
+            return
+        ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100.0))
+        self._delay = max(self.min_delay, ordered[index])
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        发出备份请求前的等待时间，样本不足时返回None（不对冲）
+        """
+        return self._delay
+
+    def _reserve_backup(self, try_acquire: Optional[Callable[[], bool]]) -> bool:
+        if self._budget < 1.0:
+            self.budget_exhausted += 1
+            return False
+        if try_acquire is not None and not try_acquire():
+            self.no_slot += 1
+            return False
+        self._budget -= 1.0
+        return True
+
+    async def run(self,
+                  primary: Callable[[], Awaitable[Any]],
+                  backup: Callable[[], Awaitable[Any]],
+                  try_acquire: Optional[Callable[[], bool]] = None,
+                  release: Optional[Callable[[], None]] = None) -> Any:
+        """
+        执行主请求，必要时发出备份请求，返回先成功的结果并取消另一个
+
+        Args:
+            primary (Callable): 创建主请求协程的函数
+            backup (Callable): 创建备份请求协程的函数
+            try_acquire (Callable): 为备份请求不排队地申请上游调用名额，返回False时不对冲
+            release (Callable): 备份请求结束（包括被取消）时归还名额
+
+        Returns:
+            先成功返回的结果；两个都失败时抛出主请求的异常
+        """
+        self.primaries += 1
+        # 预算上限为几个备份请求，避免长时间空闲后积累过多
+        self._budget = min(self._budget + self.budget_ratio, max(1.0, self.budget_ratio * 100))
+
+        start = time.perf_counter()
+        primary_task = asyncio.ensure_future(primary())
+        backup_task = None
+        try:
+            delay = self.hedge_delay() if self.enabled else None
+            if delay is not None:
+                await asyncio.wait({primary_task}, timeout=delay)
+
+            if not primary_task.done() and delay is not None and self._reserve_backup(try_acquire):
+                self.hedges += 1
+                backup_task = asyncio.ensure_future(backup())
+                if release is not None:
+                    # 尚未开始执行就被取消的任务不会执行协程中的 finally，在任务结束时归还
+                    backup_task.add_done_callback(lambda _: release())
+                pending = {primary_task, backup_task}
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if not task.cancelled() and task.exception() is None:
+                            if task is backup_task:
+                                self.hedge_wins += 1
+                            # 备份请求胜出时，已等待的时间是主请求延迟的下限，同样计入样本，避免分位数被低估
+                            self.record_latency(time.perf_counter() - start)
+                            return task.result()
+                # 两个请求都失败，以主请求的异常为准
+                return primary_task.result()
+
+            result = await primary_task
+            self.record_latency(time.perf_counter() - start)
+            return result
+        finally:
+            # 取消尚未完成的请求（输掉的一方，或调用方被取消时的全部请求）
+            for task in (primary_task, backup_task):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        返回对冲统计
+        """
+        return {
+            "enabled": self.enabled,
+            "hedge_delay": self._delay,
+            "primaries": self.primaries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "budget_exhausted": self.budget_exhausted,
+            "no_slot": self.no_slot,
+        }
+
+
+# 进程内共享的对冲策略
+hedge_policy = HedgePolicy.from_config(config)
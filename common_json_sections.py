@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+分段JSON的增量解析 -- 边接收AI的流式输出边解析 {"字段": "文本", ...} 形式的回答
+@Version: 1.1
+@Author: lordli
+@Date: 2025-07-06
+@Description: 要求模型按固定字段输出JSON（例如法律咨询的 answer / statutes / analysis）时，
+              不必等整个回复生成完：每个字段的文本一边生成一边解码推送，字段结束时立即得到完整内容。
+              只支持一层对象、值均为字符串（模型的分段回答就是这种形式），允许外面包一层 ```json 代码块；
+              其他形式（模型没有按格式输出）标记为失败，由调用方退回原来的解析方式
+@Update:
+        1.0 分段JSON的增量解析
+        1.1 代码块标记与 { 之间只允许空白，JSON前面有其他文字时标记为失败
+"""
+
+import json
+import re
+from typing import Dict, List, Optional, Tuple
+
+# 字符串中无需特殊处理的连续字符
+_PLAIN = re.compile(r'[^"\\]+')
+_SPACE = " \t\r\n"
+# JSON之前允许出现的代码块标记（与 { 之间只能有空白）
+_FENCES = ("```json", "```")
+
+# 解析状态
+_PREAMBLE, _KEY_OR_END, _KEY, _COLON, _VALUE, _STRING, _COMMA_OR_END, _DONE, _FAILED = range(9)
+
+
+def _valid_preamble(preamble: str) -> bool:
+    """
+    { 之前的内容是否可能合法：空白、代码块标记（可能尚未接收完整），或代码块标记之后的空白
+    """
+    head = preamble.lstrip().lower()
+    for fence in _FENCES:
+        if fence.startswith(head):
+            return True
+        if head.startswith(fence) and not head[len(fence):].strip():
+            return True
+    return False
+
+
+class JsonSectionParser:
+    """
+    增量解析器：feed 每段输出，返回新产生的事件
+
+    - ("delta", 字段, 文本)：字段值中新解码出的一段文本
+    - ("section", 字段, 完整文本)：字段结束
+
+    sections 为已结束的字段；failed 为True时输出不是预期的格式，之后的输入不再解析
+    """
+
+    def __init__(self):
+        self.sections: Dict[str, str] = {}
+        self._state = _PREAMBLE
+        self._preamble = ""
+        self._key = ""
+        self._parts: List[str] = []
+        self._escape = ""
+
+    @property
+    def failed(self) -> bool:
+        return self._state == _FAILED
+
+    @property
+    def done(self) -> bool:
+        return self._state == _DONE
+
+    def partial(self) -> Optional[Tuple[str, str]]:
+        """
+        正在输出、尚未结束的字段及其已有内容（回复被 max_tokens 截断时使用）
+        """
+        if self._state == _STRING and self._key is not None:
+            return self._key, "".join(self._parts)
+        return None
+
+    def feed(self, text: str) -> List[Tuple[str, str, str]]:
+        events = []
+        index = 0
+        length = len(text)
+        while index < length and self._state not in (_DONE, _FAILED):
+            ch = text[index]
+            state = self._state
+
+            if state == _STRING:
+                if self._escape:
+                    self._escape += ch
+                    index += 1
+                    decoded = self._decode_escape()
+                    if decoded:
+                        self._emit(decoded, events)
+                    continue
+                if ch == "\\":
+                    self._escape = ch
+                    index += 1
+                    continue
+                if ch == '"':
+                    index += 1
+                    self._close_string(events)
+                    continue
+                match = _PLAIN.match(text, index)
+                self._emit(match.group(), events)
+                index = match.end()
+                continue
+
+            index += 1
+            if state == _PREAMBLE:
+                if ch == "{":
+                    self._state = _KEY_OR_END
+                else:
+                    self._preamble += ch
+                    if not _valid_preamble(self._preamble):
+                        self._state = _FAILED
+            elif ch in _SPACE:
+                continue
+            elif state == _KEY_OR_END:
+                if ch == '"':
+                    self._start_string(None)
+                elif ch == "}" and not self.sections:
+                    self._state = _DONE
+                else:
+                    self._state = _FAILED
+            elif state == _COLON:
+                self._state = _VALUE if ch == ":" else _FAILED
+            elif state == _VALUE:
+                if ch == '"':
+                    self._start_string(self._key)
+                else:
+                    # 值不是字符串
+                    self._state = _FAILED
+            elif state == _COMMA_OR_END:
+                if ch == ",":
+                    self._state = _KEY_OR_END
+                elif ch == "}":
+                    self._state = _DONE
+                else:
+                    self._state = _FAILED
+        return events
+
+    def _start_string(self, key: Optional[str]):
+        # key为None表示正在读取字段名
+        self._key = key
+        self._parts = []
+        self._state = _STRING
+
+    def _emit(self, text: str, events: List[Tuple[str, str, str]]):
+        self._parts.append(text)
+        if self._key is not None:
+            events.append(("delta", self._key, text))
+
+    def _close_string(self, events: List[Tuple[str, str, str]]):
+        value = "".join(self._parts)
+        if self._key is None:
+            self._key = value
+            self._state = _COLON
+            return
+        self.sections[self._key] = value
+        events.append(("section", self._key, value))
+        self._state = _COMMA_OR_END
+
+    def _decode_escape(self) -> str:
+        """
+        转义序列完整时解码并返回，否则返回空串继续等待；\\u 形式的代理对要等到低位部分一起解码
+        """
+        escape = self._escape
+        if escape[1] == "u":
+            if len(escape) < 6:
+                return ""
+            try:
+                high_surrogate = 0xD800 <= int(escape[2:6], 16) <= 0xDBFF
+            except ValueError:
+                high_surrogate = False
+            if high_surrogate and len(escape) < 12:
+                # 高位代理后面必须紧跟 \uXXXX，否则视为格式错误
+                if not "\\u".startswith(escape[6:8]):
+                    self._state = _FAILED
+                return ""
+        self._escape = ""
+        return self._loads(escape)
+
+    def _loads(self, escape: str) -> str:
+        try:
+            return json.loads(f'"{escape}"')
+        except ValueError:
+            self._state = _FAILED
+            return ""
+
+
+def parse_json_sections(text: str) -> Optional[Dict[str, str]]:
+    """
+    解析完整的分段JSON回复；不是预期的格式、或者一个字段也没有时返回None。
+    回复被截断（没有结束的 }）时，返回已结束的字段和正在输出的字段已有的内容
+    """
+    parser = JsonSectionParser()
+    parser.feed(text)
+    if parser.failed:
+        return None
+    sections = dict(parser.sections)
+    partial = parser.partial()
+    if partial is not None:
+        sections[partial[0]] = partial[1]
+    return sections or None
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+非阻塞日志 -- 日志由后台线程写出，请求中只把日志记录放入队列；访问日志为结构化记录，高并发时抽样
+@Version: 1.0
+@Author: lordli
+@Date: 2025-07-08
+@Description: 原来uvicorn的访问日志和各接口的 logging.error 都在事件循环中同步写标准输出，
+              输出被日志采集阻塞时所有请求一起变慢。start() 之后所有日志经队列交给后台线程写出，
+              事件循环中只有创建日志记录和一次入队；队列积压超过 max_pending 条时丢弃新的INFO及以下日志
+              （计数，/metrics 中可见），WARNING及以上的日志从不丢弃。
+              输出格式可选 text 或 json（每行一个JSON对象，带请求ID等字段，便于日志系统采集）。
+              访问日志取代uvicorn的访问日志：每个请求一条记录（路由、function、openid哈希、耗时、状态），
+              每秒前 access_full_rps 条全部记录，超出的部分按 access_sample_rate 抽样；
+              出错、繁忙和慢请求总是记录
+"""
+
+import hashlib
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+from configparser import ConfigParser
+from common_config import config
+from common_tracing import RequestTrace, current_request_id
+from typing import Dict, Optional
+
+LOG_FMT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# 日志记录中附加的结构化字段（通过 extra 传入），json格式时输出
+RECORD_FIELDS = ("request_id", "method", "route", "status_code", "latency_ms",
+                 "function", "openid_hash", "status", "sample_rate")
+
+# 聊天接口返回这些status时总是记录访问日志
+ALWAYS_LOGGED_STATUSES = frozenset(("error", "busy"))
+
+
+def hash_openid(openid: Optional[str]) -> Optional[str]:
+    """
+    openid的哈希前缀：日志中可以关联同一用户的请求，但不记录openid本身
+    """
+    if not openid:
+        return None
+    return hashlib.sha256(openid.encode("utf-8")).hexdigest()[:16]
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    每条日志输出为一行JSON：时间、级别、logger、消息，以及记录中带有的结构化字段和异常堆栈
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))}.{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in RECORD_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            data["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    把日志记录放入队列，不做格式化（格式化在写日志的线程中进行）
+
+    队列本身不限长度，保证WARNING及以上的日志一定能放入；积压超过 max_pending 条时丢弃INFO及以下的日志
+    """
+
+    def __init__(self, log_queue: queue.SimpleQueue, max_pending: int):
+        super().__init__(log_queue)
+        self.max_pending = max_pending
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 请求ID在ContextVar中，只能在产生日志的线程里读取
+        if getattr(record, "request_id", None) is None:
+            record.request_id = current_request_id()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if record.levelno < logging.WARNING and self.queue.qsize() >= self.max_pending:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+
+class LogShipper:
+    """
+    经队列和后台线程写出日志
+
+    - enabled: 关闭时保持原来的同步输出
+    - fmt: text 或 json
+    - level: 根logger的日志级别
+    - path: 输出文件，为空时输出到标准输出
+    - max_pending: 队列中INFO及以下日志的积压上限
+    - replace_uvicorn_access: 使用本模块的访问日志时，关闭uvicorn自带的访问日志（否则每个请求两条）
+
+    start() 在服务启动时调用（uvicorn配置完它的日志之后），stop() 在服务关闭的最后调用，写出队列中剩余的日志
+    """
+
+    def __init__(self,
+                 enabled: bool = True,
+                 fmt: str = 'json',
+                 level: str = 'WARNING',
+                 path: str = '',
+                 max_pending: int = 10000,
+                 replace_uvicorn_access: bool = True):
+        self.enabled = enabled
+        self.fmt = fmt.lower()
+        self.level = level.upper()
+        self.path = path
+        self.max_pending = max_pending
+        self.replace_uvicorn_access = replace_uvicorn_access
+
+        self._handler: Optional[_QueueHandler] = None
+        self._output: Optional[logging.Handler] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, section: str = 'logging') -> "LogShipper":
+        """
+        从config.ini读取参数创建日志输出
+        """
+        return cls(
+            enabled=config.getboolean(section, 'enabled', fallback=True),
+            fmt=config.get(section, 'format', fallback='json'),
+            level=config.get(section, 'level', fallback='WARNING'),
+            path=config.get(section, 'path', fallback=''),
+            max_pending=config.getint(section, 'max_pending', fallback=10000),
+            replace_uvicorn_access=config.getboolean(section, 'access_log', fallback=True),
+        )
+
+    def _build_output(self) -> logging.Handler:
+        if self.path:
+            handler = logging.handlers.WatchedFileHandler(self.path, encoding="utf-8")
+        else:
+            handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JsonFormatter() if self.fmt == 'json' else logging.Formatter(LOG_FMT))
+        return handler
+
+    def start(self):
+        if not self.enabled or self._listener is not None:
+            return
+        log_queue = queue.SimpleQueue()
+        self._output = self._build_output()
+        self._handler = _QueueHandler(log_queue, self.max_pending)
+        self._listener = logging.handlers.QueueListener(log_queue, self._output)
+        self._listener.start()
+
+        root = logging.getLogger()
+        root.handlers = [self._handler]
+        root.setLevel(self.level)
+        # uvicorn的日志原本有自己的同步输出，改为交给根logger（经过队列）
+        for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+            logger = logging.getLogger(name)
+            logger.handlers = []
+            logger.propagate = True
+        if self.replace_uvicorn_access:
+            logging.getLogger("uvicorn.access").disabled = True
+
+    def stop(self):
+        """
+        写出队列中剩余的日志；之后的日志（关闭过程的最后几条）直接同步输出
+        """
+        if self._listener is None:
+            return
+        logging.getLogger().handlers = [self._output]
+        self._listener.stop()
+        self._listener = None
+
+    def stats(self) -> Dict[str, int]:
+        """
+        返回日志队列的统计
+        """
+        handler = self._handler
+        return {
+            "pending": handler.queue.qsize() if handler is not None else 0,
+            "dropped": handler.dropped if handler is not None else 0,
+        }
+
+
+class AccessLog:
+    """
+    结构化的访问日志，由 TracingMiddleware 在每个请求结束时调用
+
+    - enabled: 是否记录
+    - full_rps: 每秒前多少条全部记录
+    - sample_rate: 超出 full_rps 后的抽样比例（抽中的记录带有 sample_rate 字段，统计时按比例还原）
+    - slow_threshold: 超过该耗时（秒）的请求总是记录，0为不按耗时判断
+
+    只在事件循环线程中调用
+    """
+
+    def __init__(self,
+                 enabled: bool = True,
+                 full_rps: int = 50,
+                 sample_rate: float = 0.1,
+                 slow_threshold: float = 3.0):
+        self.enabled = enabled
+        self.full_rps = full_rps
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.logger = logging.getLogger("access")
+        self.logger.setLevel(logging.INFO)
+
+        self._window = 0
+        self._count = 0
+
+        # 统计
+        self.logged = 0
+        self.sampled_out = 0
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, section: str = 'logging') -> "AccessLog":
+        """
+        从config.ini读取参数创建访问日志；慢请求阈值与 [tracing] 相同
+        """
+        return cls(
+            enabled=config.getboolean(section, 'access_log', fallback=True),
+            full_rps=config.getint(section, 'access_full_rps', fallback=50),
+            sample_rate=config.getfloat(section, 'access_sample_rate', fallback=0.1),
+            slow_threshold=config.getfloat('tracing', 'slow_threshold_ms', fallback=3000) / 1000,
+        )
+
+    def _sample_rate(self, always: bool) -> Optional[float]:
+        """
+        返回None表示不记录，1.0为全部记录，否则为抽样比例
+        """
+        second = int(time.monotonic())
+        if second != self._window:
+            self._window = second
+            self._count = 0
+        self._count += 1
+        if always or self._count <= self.full_rps:
+            return 1.0
+        if random.random() < self.sample_rate:
+            return self.sample_rate
+        return None
+
+    def __call__(self, trace: RequestTrace, route: str, status_code: int, duration: float):
+        tags = trace.tags
+        always = (status_code >= 500 or tags.get("status") in ALWAYS_LOGGED_STATUSES or
+                  bool(self.slow_threshold and duration >= self.slow_threshold))
+        rate = self._sample_rate(always)
+        if rate is None:
+            self.sampled_out += 1
+            return
+        self.logged += 1
+        latency_ms = round(duration * 1000, 1)
+        self.logger.info(
+            "%s %s %s %sms", trace.method, route, status_code, latency_ms,
+            extra={
+                "request_id": trace.request_id,
+                "method": trace.method,
+                "route": route,
+                "status_code": status_code,
+                "latency_ms": latency_ms,
+                "function": tags.get("function"),
+                "openid_hash": tags.get("openid_hash"),
+                "status": tags.get("status"),
+                "sample_rate": rate if rate < 1.0 else None,
+            },
+        )
+
+    def stats(self) -> Dict[str, int]:
+        """
+        返回访问日志的统计
+        """
+        return {"logged": self.logged, "sampled_out": self.sampled_out}
+
+
+# 进程内共享的日志输出和访问日志
+log_shipper = LogShipper.from_config(config)
+access_log = AccessLog.from_config(config)
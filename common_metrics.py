@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+运行指标 -- 轻量的计数器、仪表和延迟直方图，以Prometheus文本格式导出
+@Version: 1.4
+@Author: lordli
+@Date: 2025-06-23
+@Description: 记录外部接口调用的耗时分布，只做计数累加，不加锁，适合在事件循环中频繁调用
+@Update:
+        1.0 延迟直方图
+        1.1 带标签的计数器、仪表和直方图，指标注册表，接口请求指标中间件和聊天接口的结果统计
+        1.2 聊天接口的结果统计支持NDJSON流式响应（批量接口）；track_chat 记录端点函数的耗时分段
+        1.3 track_chat 把function、openid哈希和返回的status附加到请求的访问日志
+        1.4 CallbackCounter：抓取时读取的累计计数以counter类型导出，rate()/increase() 能正确处理进程重启
+"""
+
+import bisect
+import functools
+import json
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+from common_logging import hash_openid
+from common_tracing import ENDPOINT_SPAN, RequestTrace, current_trace, span
+
+# 默认的延迟分桶（秒）
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 聊天接口和上游调用的延迟分桶（秒），AI回复通常在秒级
+CHAT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+
+
+class LatencyHistogram:
+    """
+    延迟直方图
+
+    每个桶记录落在该上界内（不累计）的次数，最后一个桶为 +Inf
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        """
+        记录一次耗时（秒）
+        """
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def snapshot(self) -> Dict[str, object]:
+        """
+        返回直方图的快照：各桶的累计次数、总耗时和总次数
+        """
+        cumulative = {}
+        running = 0
+        for bound, count in zip(self.buckets, self.counts):
+            running += count
+            cumulative[str(bound)] = running
+        cumulative["+Inf"] = running + self.counts[-1]
+        return {
+            "buckets": cumulative,
+            "sum": self.total,
+            "count": self.count,
+        }
+
+
+class _Value:
+    """
+    计数器/仪表的单个取值
+    """
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class _Family:
+    """
+    同名指标按标签值区分的一组取值
+
+    标签值组合到取值对象的映射只在第一次出现时创建，之后热路径上只有一次字典查找和一次加法；
+    所有指标都只在事件循环线程中更新，不需要加锁
+    """
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        return _Value()
+
+    def labels(self, *values) -> Any:
+        """
+        按标签值取得对应的取值对象，可以缓存返回值以省去查找
+        """
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}，实际为 {key}")
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _label_text(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in list(self._children.items()):
+            lines.append(f"{self.name}{self._label_text(key)} {_format(child.value)}")
+        return lines
+
+
+class Counter(_Family):
+    """
+    只增不减的计数器
+    """
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0):
+        self._children[()].inc(amount)
+
+
+class Gauge(_Family):
+    """
+    可增可减的仪表（如在途请求数）
+    """
+    kind = "gauge"
+
+    def inc(self, amount: float = 1.0):
+        self._children[()].inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self._children[()].dec(amount)
+
+    def set(self, value: float):
+        self._children[()].set(value)
+
+
+class Histogram(_Family):
+    """
+    带标签的延迟直方图
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child(self):
+        return LatencyHistogram(self.buckets)
+
+    def observe(self, seconds: float):
+        self._children[()].observe(seconds)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in list(self._children.items()):
+            running = 0
+            for bound, count in zip(child.buckets, child.counts):
+                running += count
+                lines.append(f"{self.name}_bucket{self._label_text(key, 'le=' + _quote(bound))} {running}")
+            lines.append(f"{self.name}_bucket{self._label_text(key, 'le=' + _quote('+Inf'))} {child.count}")
+            lines.append(f"{self.name}_sum{self._label_text(key)} {_format(child.total)}")
+            lines.append(f"{self.name}_count{self._label_text(key)} {child.count}")
+        return lines
+
+
+class CallbackGauge:
+    """
+    抓取时才读取的仪表，用于导出各模块已有的统计（队列深度、熔断器状态等），热路径上没有任何开销
+
+    callback 返回一个数值，或 {标签值元组: 数值} 的字典
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, callback: Callable[[], Any], labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        value = self.callback()
+        if isinstance(value, dict):
+            for key, number in value.items():
+                key = key if isinstance(key, tuple) else (key,)
+                labels = ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(self.labelnames, key))
+                lines.append(f"{self.name}{{{labels}}} {_format(number)}")
+        else:
+            lines.append(f"{self.name} {_format(value)}")
+        return lines
+
+
+class CallbackCounter(CallbackGauge):
+    """
+    抓取时才读取的计数器，用于导出各模块已有的只增不减的累计计数（拒绝数、命中数等），名称以 _total 结尾
+
+    callback 的返回值与 CallbackGauge 相同
+    """
+    kind = "counter"
+
+
+def _quote(value: Any) -> str:
+    return '"' + str(value) + '"'
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(value: float) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    """
+    指标注册表：同名指标只创建一次，render 时按注册顺序输出Prometheus文本格式
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def callback_gauge(self, name: str, help_text: str, callback: Callable[[], Any],
+                       labelnames: Sequence[str] = ()) -> CallbackGauge:
+        return self._register(CallbackGauge(name, help_text, callback, labelnames))
+
+    def callback_counter(self, name: str, help_text: str, callback: Callable[[], Any],
+                         labelnames: Sequence[str] = ()) -> CallbackCounter:
+        return self._register(CallbackCounter(name, help_text, callback, labelnames))
+
+    def render(self) -> str:
+        """
+        导出全部指标（Prometheus文本格式 0.0.4）
+        """
+        lines: List[str] = []
+        for metric in list(self._metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                # 单个回调出错不影响其余指标的导出
+                continue
+        return "\n".join(lines) + "\n"
+
+
+# 进程内共享的指标注册表
+metrics = MetricsRegistry()
+
+# 接口请求
+http_requests_total = metrics.counter(
+    "http_requests_total", "接口请求数", ("route", "method", "status_code"))
+http_request_duration = metrics.histogram(
+    "http_request_duration_seconds", "接口请求耗时（流式响应计到最后一个字节）", ("route",), CHAT_LATENCY_BUCKETS)
+http_requests_inflight = metrics.gauge(
+    "http_requests_inflight", "正在处理的接口请求数")
+
+# 聊天接口按function和业务状态统计
+chat_requests_total = metrics.counter(
+    "chat_requests_total", "聊天接口的请求数，按function和返回的status（OK、noUser、runOut、noMoney、error、busy等）",
+    ("route", "function", "status"))
+chat_request_duration = metrics.histogram(
+    "chat_request_duration_seconds", "聊天接口按function统计的耗时", ("route", "function"), CHAT_LATENCY_BUCKETS)
+chat_requests_inflight = metrics.gauge(
+    "chat_requests_inflight", "正在处理的聊天请求数（流式响应直到推送结束）", ("route",))
+
+# 上游AI调用（每次尝试单独计数，重试会多次计入）
+upstream_request_duration = metrics.histogram(
+    "upstream_request_duration_seconds", "上游AI接口单次调用耗时", ("model", "outcome"), CHAT_LATENCY_BUCKETS)
+upstream_errors_total = metrics.counter(
+    "upstream_errors_total", "上游AI接口调用失败次数，按错误类型", ("model", "error"))
+upstream_tokens_total = metrics.counter(
+    "upstream_tokens_total", "上游返回的usage中的token数", ("model", "kind"))
+upstream_inflight = metrics.gauge(
+    "upstream_requests_inflight", "正在进行的上游AI调用数")
+
+
+def record_upstream_usage(model: str, usage: Optional[Dict[str, Any]]):
+    """
+    累加上游响应中 usage 的 prompt_tokens / completion_tokens
+    """
+    if not isinstance(usage, dict):
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        amount = usage.get(kind)
+        if isinstance(amount, (int, float)) and amount > 0:
+            upstream_tokens_total.labels(model, kind[:-len("_tokens")]).inc(amount)
+
+
+class MetricsMiddleware:
+    """
+    ASGI中间件：按路由模板（而不是原始路径）统计请求数、耗时和在途数，避免标签基数失控
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        http_requests_inflight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_inflight.dec()
+            # 路由匹配后scope中才有route，未匹配的请求（如扫描）统一记为unmatched
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            http_requests_total.labels(route, scope.get("method", ""), status_code).inc()
+            http_request_duration.labels(route).observe(time.perf_counter() - start)
+
+
+def _chat_status(result: Any) -> Optional[str]:
+    if isinstance(result, dict):
+        chat_result = result.get("chatResult")
+        if isinstance(chat_result, dict):
+            return str(chat_result.get("status", ""))
+    return None
+
+
+def _sse_status(last_event: str) -> str:
+    """
+    从流式响应的最后一个事件（done / error）中取出业务状态；NDJSON流的最后一行本身就是结果
+    """
+    for line in last_event.splitlines():
+        if line.startswith("data:"):
+            try:
+                return _chat_status(json.loads(line[5:])) or "unknown"
+            except ValueError:
+                break
+        elif line.startswith("{"):
+            try:
+                return _chat_status(json.loads(line)) or "unknown"
+            except ValueError:
+                break
+    return "unknown"
+
+
+def track_chat(route: str, functions: Union[Iterable[str], Callable[[], Iterable[str]]] = ()):
+    """
+    聊天接口的装饰器：按function统计耗时和返回的status
+
+    流式响应在最后一个事件推送完成后才计入，耗时为整个流的时长；
+    不在 functions 中的function统一记为 other，避免任意输入撑大标签。
+    functions 可以是一个返回名称集合的函数，每次请求时调用，配置热更新后新的function随之生效
+
+    用法：
+        @router.put("/chatSingle3/")
+        @track_chat("chatSingle3", lambda: function_registry.names("chatSingle3"))
+        async def chat_single3(request: ChatSingle3Request): ...
+    """
+    known = functions if callable(functions) else (lambda names=frozenset(functions): names)
+
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            request = kwargs.get("request", args[0] if args else None)
+            function = getattr(request, "function", "") or ""
+            if function not in known():
+                function = "other"
+            trace = current_trace()
+            if trace is not None:
+                trace.tags["function"] = function
+                trace.tags["openid_hash"] = hash_openid(getattr(request, "openid", None))
+
+            inflight = chat_requests_inflight.labels(route)
+            inflight.inc()
+            try:
+                with span(ENDPOINT_SPAN):
+                    result = await endpoint(*args, **kwargs)
+            except BaseException:
+                inflight.dec()
+                raise
+
+            body = getattr(result, "body_iterator", None)
+            if body is not None:
+                # 流式响应：推送结束时再计入
+                result.body_iterator = _track_stream(body, route, function, start, inflight, trace)
+                return result
+
+            inflight.dec()
+            status = _chat_status(result) or "unknown"
+            if trace is not None:
+                trace.tags["status"] = status
+            chat_requests_total.labels(route, function, status).inc()
+            chat_request_duration.labels(route, function).observe(time.perf_counter() - start)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+async def _track_stream(body, route: str, function: str, start: float, inflight: _Value,
+                        trace: Optional[RequestTrace]):
+    last_event = ""
+    status = "cancelled"
+    try:
+        async for chunk in body:
+            last_event = chunk if isinstance(chunk, str) else ""
+            yield chunk
+        status = _sse_status(last_event)
+    finally:
+        inflight.dec()
+        if trace is not None:
+            trace.tags["status"] = status
+        chat_requests_total.labels(route, function, status).inc()
+        chat_request_duration.labels(route, function).observe(time.perf_counter() - start)
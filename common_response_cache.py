@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+AI响应缓存 -- 相同输入的确定性单轮请求直接返回缓存结果
+@Version: 1.1
+@Author: lordli
+@Date: 2025-06-22
+@Description: 以 (模型, 系统提示, 用户输入, 温度, max_tokens) 的哈希为key，LRU + TTL淘汰，可选落盘，重启后仍然有效
+@Update:
+        1.0 构建基础服务
+        1.1 缓存条目同时保存生成该回复时上游的token用量，命中缓存的请求按该用量计费
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from configparser import ConfigParser
+from common_config import config
+from typing import NamedTuple, Optional, Dict
+
+
+class CachedResponse(NamedTuple):
+    """
+    缓存的回复，以及生成它时上游的token用量
+    """
+    text: str
+    usage: Dict[str, int]
+
+
+class ResponseCache:
+    """
+    AI响应缓存
+
+    - enabled_functions: 无论温度多少都允许缓存的function（如翻译类）
+    - max_temperature: 温度不高于该值的function也允许缓存（输出基本确定）
+    - max_entries: 最多缓存的条数，超出后淘汰最久未使用的（LRU）
+    - ttl: 缓存有效期（秒）
+    - persist_path: 落盘文件路径，为空则只缓存在内存中
+    """
+
+    def __init__(self,
+                 enabled: bool = True,
+                 enabled_functions=(),
+                 max_temperature: float = 0.3,
+                 max_entries: int = 5000,
+                 ttl: float = 86400,
+                 persist_path: Optional[str] = None):
+        self.enabled = enabled
+        self.enabled_functions = frozenset(enabled_functions)
+        self.max_temperature = max_temperature
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist_path = persist_path
+
+        # key -> (过期时间戳, 响应内容, token用量)，最久未使用的在最前面
+        # 使用墙上时间而不是单调时钟，落盘后重启仍能判断是否过期
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+        # 统计计数
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, section: str = 'cache') -> "ResponseCache":
+        """
+        从config.ini读取参数创建响应缓存
+        """
+        functions = config.get(section, 'functions', fallback='translate2En,translate2Ch')
+        return cls(
+            enabled=config.getboolean(section, 'enabled', fallback=True),
+            enabled_functions=[f.strip() for f in functions.split(',') if f.strip()],
+            max_temperature=config.getfloat(section, 'max_temperature', fallback=0.3),
+            max_entries=config.getint(section, 'max_entries', fallback=5000),
+            ttl=config.getfloat(section, 'ttl', fallback=86400),
+            persist_path=config.get(section, 'persist_path', fallback='') or None,
+        )
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, user_input: str, temperature: float, max_tokens: int) -> str:
+        """
+        生成缓存key：对请求中影响输出的参数做哈希
+        """
+        raw = json.dumps([model, system_prompt, user_input, temperature, max_tokens], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def is_cacheable(self, function: str, temperature: float) -> bool:
+        """
+        判断某个function的请求是否允许缓存
+        """
+        if not self.enabled:
+            return False
+        return function in self.enabled_functions or temperature <= self.max_temperature
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """
+        读取缓存，不存在或已过期时返回None
+        """
+        item = self._entries.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        expire_at, value, usage = item
+        if expire_at < time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return CachedResponse(value, usage)
+
+    def put(self, key: str, value: str, usage: Dict[str, int]):
+        """
+        写入缓存，超出容量时淘汰最久未使用的条目；usage 为生成该回复时上游的token用量
+        """
+        self._entries[key] = (time.time() + self.ttl, value, usage)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        返回缓存条数和命中/未命中/淘汰统计
+        """
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def load(self):
+        """
+        从落盘文件恢复缓存（跳过已过期的条目）
+        """
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, 'r', encoding='utf-8') as f:
+                items = json.load(f)
+            now = time.time()
+            for key, expire_at, value, usage in items:
+                if expire_at >= now:
+                    self._entries[key] = (expire_at, value, usage)
+            # 文件中按LRU顺序保存，只保留最近使用的部分
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            logging.info("响应缓存已恢复: %s条", len(self._entries))
+        except Exception as e:
+            logging.exception("响应缓存恢复失败: %s", e)
+
+    def save(self):
+        """
+        将缓存写入落盘文件（先写临时文件再替换，避免写到一半时文件损坏）
+        """
+        if not self.persist_path:
+            return
+        try:
+            items = [[key, expire_at, value, usage] for key, (expire_at, value, usage) in self._entries.items()]
+            tmp_path = self.persist_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(items, f, ensure_ascii=False)
+            os.replace(tmp_path, self.persist_path)
+        except Exception as e:
+            logging.exception("响应缓存保存失败: %s", e)
+
+
+# 进程内共享的响应缓存
+response_cache = ResponseCache.from_config(config)
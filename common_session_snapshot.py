@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+会话快照 -- 定时把进程内会话增量写入磁盘，重启后恢复，部署或崩溃不再丢失对话上下文
+@Version: 1.2
+@Author: lordli
+@Date: 2025-07-04
+@Description: 快照是一个SQLite文件，每个会话一行（消息列表JSON经zlib压缩，role用单个字符表示，
+              系统提示只保存引用，内容在 snapshot_prompts 中只保存一份）。
+              每次只写入上次快照以来修改过的会话并删除已过期的会话，序列化和写入都在后台线程中完成；
+              启动时只预加载最近访问的一部分会话，其余的在首次访问时按需加载，大快照不会拖慢启动。
+              只用于进程内存储（[session] backend = memory），sqlite存储本身已经落盘
+@Update:
+        1.0 构建基础服务
+        1.1 紧凑格式：系统提示按标识引用，role编码为单个字符
+        1.2 保存会话的滚动摘要、原始对话轮数和摘要的token数
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from common_config import config
+from common_session_store import Message, SessionRecord, SessionStore, prompt_id, session_store
+from typing import Dict, List, Optional, Set, Tuple
+
+SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS session_snapshot (
+    session_key TEXT PRIMARY KEY,
+    last_access REAL NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS session_snapshot_last_access ON session_snapshot (last_access);
+CREATE TABLE IF NOT EXISTS snapshot_prompts (
+    prompt_id TEXT PRIMARY KEY,
+    content TEXT NOT NULL
+);
+"""
+
+# 快照中role的编码，未列出的role原样保存
+ROLE_CODES = {"system": "s", "user": "u", "assistant": "a"}
+CODE_ROLES = {code: role for role, code in ROLE_CODES.items()}
+
+
+def encode_session(pid: Optional[str], record: SessionRecord) -> bytes:
+    data = {"p": pid, "m": [[ROLE_CODES.get(m.role, m.role), m.content] for m in record.messages]}
+    if record.turns:
+        data["t"] = record.turns
+    if record.summary is not None:
+        data["s"] = record.summary
+        data["k"] = record.summary_tokens
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def decode_session(data: bytes, last_access: float) -> Tuple[Optional[str], SessionRecord]:
+    """
+    返回 (系统提示的标识, 会话内容)，会话内容中的系统提示为None，由调用者按标识补上
+    """
+    data = json.loads(zlib.decompress(data).decode("utf-8"))
+    messages = [Message(CODE_ROLES.get(role, role), content) for role, content in data["m"]]
+    return data["p"], SessionRecord(None, messages, last_access, data.get("s"), data.get("t", 0), data.get("k", 0))
+
+
+class SessionSnapshot:
+    """
+    会话快照
+
+    - path: 快照文件
+    - interval: 增量快照的间隔（秒）
+    - eager_entries: 启动时预加载的会话数（按最后访问时间从新到旧），其余的按需加载
+
+    写入在单独的线程中执行，事件循环线程上只做取出变更（复制消息列表的引用）和按需加载单个会话（主键查询）
+    """
+
+    def __init__(self,
+                 store: SessionStore,
+                 path: str = 'sessions.snapshot',
+                 enabled: bool = True,
+                 interval: float = 30.0,
+                 eager_entries: int = 2000):
+        self.store = store
+        self.path = path
+        self.enabled = enabled
+        self.interval = interval
+        self.eager_entries = eager_entries
+
+        # 写入线程使用的连接，只在该线程中访问
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-snapshot")
+        self._writer: Optional[sqlite3.Connection] = None
+        # 事件循环线程中按需加载使用的只读连接
+        self._reader: Optional[sqlite3.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock: Optional[asyncio.Lock] = None
+        # 系统提示：内容 -> 标识（写入线程）、标识 -> 内容（两个线程共用，只增不改）
+        self._prompt_ids: Dict[str, str] = {}
+        self._prompt_texts: Dict[str, str] = {}
+
+        # 统计
+        self.snapshots = 0
+        self.written = 0
+        self.deleted = 0
+        self.restored = 0
+        self.errors = 0
+        self.last_duration = 0.0
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, store, section: str = 'session') -> "SessionSnapshot":
+        """
+        从config.ini读取参数创建会话快照；会话存储不是进程内存储时不启用
+        """
+        return cls(
+            store,
+            path=config.get(section, 'snapshot_path', fallback='sessions.snapshot'),
+            enabled=config.getboolean(section, 'snapshot_enabled', fallback=True) and isinstance(store, SessionStore),
+            interval=config.getfloat(section, 'snapshot_interval', fallback=30.0),
+            eager_entries=config.getint(section, 'snapshot_eager_entries', fallback=2000),
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SNAPSHOT_SCHEMA)
+        return conn
+
+    def _writer_connection(self) -> sqlite3.Connection:
+        if self._writer is None:
+            self._writer = self._connect()
+        return self._writer
+
+    async def _in_thread(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _decode(self, conn: sqlite3.Connection, data: bytes, last_access: float) -> SessionRecord:
+        pid, record = decode_session(data, last_access)
+        if pid is not None:
+            prompt = self._prompt_texts.get(pid)
+            if prompt is None:
+                row = conn.execute("SELECT content FROM snapshot_prompts WHERE prompt_id = ?", (pid,)).fetchone()
+                prompt = self._prompt_texts[pid] = row[0] if row is not None else None
+            record = record._replace(prompt=prompt)
+        return record
+
+    def _load_recent(self, limit: int) -> List[Tuple[str, SessionRecord]]:
+        """
+        （后台线程）读取最近访问且未过期的会话，从新到旧
+        """
+        conn = self._writer_connection()
+        rows = conn.execute(
+            "SELECT session_key, data, last_access FROM session_snapshot WHERE last_access >= ? "
+            "ORDER BY last_access DESC LIMIT ?",
+            (time.time() - self.store.idle_ttl, limit)
+        ).fetchall()
+        return [(key, self._decode(conn, data, last_access)) for key, data, last_access in rows]
+
+    def page_in(self, key: str) -> Optional[SessionRecord]:
+        """
+        （事件循环线程）按需加载单个会话，会话存储未命中时调用
+        """
+        try:
+            if self._reader is None:
+                self._reader = self._connect()
+            row = self._reader.execute(
+                "SELECT data, last_access FROM session_snapshot WHERE session_key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            return self._decode(self._reader, row[0], row[1])
+        except sqlite3.Error as e:
+            logging.exception("从会话快照加载失败: %s", e)
+            return None
+
+    def _write(self, changed: Dict[str, SessionRecord], removed: Set[str]) -> int:
+        """
+        （后台线程）在一个事务中写入变更，并清理已过期的会话；返回删除的行数
+        """
+        conn = self._writer_connection()
+        new_prompts = []
+        rows = []
+        for key, record in changed.items():
+            pid = None
+            if record.prompt is not None:
+                pid = self._prompt_ids.get(record.prompt)
+                if pid is None:
+                    pid = prompt_id(record.prompt)
+                    new_prompts.append((pid, record.prompt))
+            rows.append((key, record.last_access, encode_session(pid, record)))
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO snapshot_prompts (prompt_id, content) VALUES (?, ?)", new_prompts)
+            # 先删除再写入：会话被删除后又以同一个key重新创建时，保留新的内容
+            conn.executemany("DELETE FROM session_snapshot WHERE session_key = ?", [(key,) for key in removed])
+            conn.executemany(
+                "INSERT OR REPLACE INTO session_snapshot (session_key, last_access, data) VALUES (?, ?, ?)", rows
+            )
+            expired = conn.execute(
+                "DELETE FROM session_snapshot WHERE last_access < ?", (time.time() - self.store.idle_ttl,)
+            ).rowcount
+        # 提交后才记为已保存，写入失败时下次重新保存
+        for pid, prompt in new_prompts:
+            self._prompt_ids[prompt] = pid
+        return len(removed) + expired
+
+    async def snapshot(self):
+        """
+        写入一次增量快照
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            start = time.perf_counter()
+            changed, removed = self.store.take_changes()
+            succeeded = False
+            try:
+                if changed or removed:
+                    self.deleted += await self._in_thread(self._write, changed, removed)
+                    self.written += len(changed)
+                succeeded = True
+            except Exception as e:
+                self.errors += 1
+                logging.exception("会话快照写入失败，下次重试: %s", e)
+            finally:
+                self.store.finish_changes(changed, succeeded)
+            self.snapshots += 1
+            self.last_duration = time.perf_counter() - start
+
+    async def restore(self):
+        """
+        启动时预加载最近访问的会话，并开启按需加载
+        """
+        self.store.enable_change_tracking(self.page_in)
+        try:
+            recent = await self._in_thread(self._load_recent, self.eager_entries)
+        except Exception as e:
+            logging.exception("读取会话快照失败，跳过预加载: %s", e)
+            return
+        for key, record in recent:
+            self.store.restore(key, record)
+        self.restored = len(recent)
+        if recent:
+            logging.warning("已从快照恢复 %s 个最近的会话，其余会话在访问时加载", len(recent))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.snapshot()
+            except Exception as e:
+                logging.exception("会话快照异常: %s", e)
+
+    async def start(self):
+        """
+        恢复会话并启动定时快照（在服务启动时调用）
+        """
+        if not self.enabled or self._task is not None:
+            return
+        await self.restore()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        停止定时快照，写入最后一次快照并关闭文件（在服务关闭时调用）
+        """
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.snapshot()
+        if self._writer is not None:
+            await self._in_thread(self._writer.close)
+            self._writer = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def stats(self) -> Dict[str, float]:
+        """
+        返回快照统计
+        """
+        return {
+            "snapshots": self.snapshots,
+            "written": self.written,
+            "deleted": self.deleted,
+            "restored": self.restored,
+            "paged_in": self.store.paged_in if self.enabled else 0,
+            "errors": self.errors,
+            "last_duration": self.last_duration,
+        }
+
+
+# 进程内共享的会话快照
+session_snapshot = SessionSnapshot.from_config(config, session_store)
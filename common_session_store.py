@@ -0,0 +1,947 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+会话存储 -- 带容量上限、内存上限、空闲过期和LRU淘汰的多轮对话历史存储
+@Version: 1.5
+@Author: lordli
+@Date: 2025-06-20
+@Description: 替代各多轮对话模块中的全局sessions字典，所有多轮对话接口共用一个实例
+@Update:
+        1.0 进程内存储（SessionStore）
+        1.1 新增SQLite（WAL）存储，同一台机器上的多个worker进程共享会话；在config.ini的[session]中选择
+        1.2 SessionStore记录变更的会话供增量快照使用，未命中时可从快照中按需加载，见 common_session_snapshot
+        1.3 紧凑的会话表示：消息改为 __slots__ 记录、role驻留；系统提示只保存一份，各会话引用同一个对象，
+            SQLite存储中按提示的哈希引用
+        1.4 滚动摘要：最早的若干轮对话可以替换为一条固定在系统提示之后的摘要（见 common_session_summary），
+            会话记录原始的对话轮数和摘要的token数
+        1.5 SQLite存储的写事务在专用的写入线程中执行，接口中 await extend_async / apply_summary_async，
+            多个进程争用写锁时不阻塞事件循环
+"""
+
+import asyncio
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from common_config import config
+from typing import Any, Callable, Iterable, List, Dict, NamedTuple, Optional, Set, Tuple, Union
+
+
+class Message:
+    """
+    会话中的一条消息：比dict小得多，role驻留为共享的字符串；
+    提供与dict相同的 get / [] 读取方式，发送给AI前再用 to_dict 转换
+    """
+    __slots__ = ("role", "content")
+
+    def __init__(self, role: str, content: str):
+        self.role = sys.intern(role)
+        self.content = content
+
+    def get(self, name: str, default=None):
+        if name == "role":
+            return self.role
+        if name == "content":
+            return self.content
+        return default
+
+    def __getitem__(self, name: str):
+        if name == "role":
+            return self.role
+        if name == "content":
+            return self.content
+        raise KeyError(name)
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content}
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (Message, dict)):
+            return self.role == other.get("role") and self.content == other.get("content")
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"Message({self.role!r}, {self.content!r})"
+
+
+MessageLike = Union[Message, Dict[str, str]]
+
+
+def as_message(message: MessageLike) -> Message:
+    return message if isinstance(message, Message) else Message(message["role"], message["content"])
+
+
+# 系统提示内容 -> 共享的消息记录；提示只来自功能注册表，数量很少
+_shared_prompts: Dict[str, Message] = {}
+
+
+def shared_prompt(content: str) -> Message:
+    """
+    内容相同的系统提示在进程内共用一个消息记录，各会话只保存引用
+    """
+    prompt = _shared_prompts.get(content)
+    if prompt is None:
+        prompt = _shared_prompts[content] = Message("system", content)
+    return prompt
+
+
+def prompt_id(prompt: str) -> str:
+    """
+    系统提示的标识（内容的哈希），持久化时用它引用只保存一份的提示
+    """
+    return hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+
+
+# 每条消息除内容外的固定开销（消息记录本身及列表中的引用），用于估算内存占用
+MESSAGE_OVERHEAD_BYTES = sys.getsizeof(Message("user", "")) + 8
+# 每个会话的固定开销（key、列表和索引结构）
+SESSION_OVERHEAD_BYTES = 256
+
+
+def estimate_message_bytes(message: MessageLike) -> int:
+    """
+    估算一条消息占用的内存（字节）
+    """
+    return MESSAGE_OVERHEAD_BYTES + sys.getsizeof(message.get("content") or "")
+
+
+class SessionRecord(NamedTuple):
+    """
+    持久化（快照）用的会话内容；last_access 为时间戳
+    """
+    prompt: Optional[str]
+    messages: List[Message]
+    last_access: float
+    summary: Optional[str] = None
+    turns: int = 0
+    summary_tokens: int = 0
+
+
+def fold_boundary(messages: List[MessageLike], keep_messages: int) -> int:
+    """
+    摘要时折叠的消息数：保留最近 keep_messages 条，边界后移到下一条用户消息，
+    保留的部分总是从完整的一轮开始；没有可折叠的完整轮次时返回0
+    """
+    index = max(len(messages) - keep_messages, 0)
+    while index < len(messages) and messages[index].get("role") != "user":
+        index += 1
+    return index if index < len(messages) else 0
+
+
+class _SessionEntry:
+    """
+    单个会话：系统提示（共享的消息记录）、滚动摘要、其余消息、估算的内存占用和最后访问时间，
+    以及原始的对话轮数（含已折叠进摘要和已截断的）和摘要的token数
+    """
+    __slots__ = ("prompt", "summary", "messages", "size", "last_access", "turns", "summary_tokens")
+
+    def __init__(self, now: float):
+        self.prompt: Optional[Message] = None
+        self.summary: Optional[Message] = None
+        self.messages: List[Message] = []
+        self.size = SESSION_OVERHEAD_BYTES
+        self.last_access = now
+        self.turns = 0
+        self.summary_tokens = 0
+
+    def pinned(self) -> List[Message]:
+        return [m for m in (self.prompt, self.summary) if m is not None]
+
+    def all_messages(self) -> List[Message]:
+        return self.pinned() + self.messages
+
+
+class SessionStore:
+    """
+    多轮对话会话存储
+
+    - max_entries: 最多保存的会话数，超出后淘汰最久未访问的会话（LRU）
+    - max_bytes: 所有会话估算的内存上限，超出后同样按LRU淘汰
+    - idle_ttl: 会话空闲超过该秒数即过期
+    - max_messages: 单个会话最多保留的消息条数（系统提示和摘要始终保留）
+
+    所有操作都在事件循环线程中同步完成，不需要加锁。
+
+    会话开头的系统提示不单独保存：相同内容的提示在进程内只有一个消息记录，各会话引用它，
+    不计入会话的内存占用（几KB的人设提示不会在每个会话中各占一份）。
+
+    开启变更记录（enable_change_tracking）后，会记录自上次快照以来修改过和删除的会话；
+    被容量淘汰、尚未写入快照的会话暂存到下次快照，之后仍可从快照中按需加载
+    """
+
+    def __init__(self,
+                 max_entries: int = 10000,
+                 max_bytes: int = 256 * 1024 * 1024,
+                 idle_ttl: float = 3600,
+                 max_messages: int = 100):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.max_messages = max_messages
+
+        # 按访问时间排序，最久未访问的在最前面
+        self._entries: "OrderedDict[str, _SessionEntry]" = OrderedDict()
+        self._total_bytes = 0
+
+        # 统计计数
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.paged_in = 0
+
+        # 增量快照：修改过的会话、已删除（过期）的会话、被淘汰但尚未写入快照的会话
+        self._track_changes = False
+        self._dirty: Set[str] = set()
+        self._removed: Set[str] = set()
+        self._paged_out: Dict[str, _SessionEntry] = {}
+        # 正在写入快照的被淘汰会话和已删除的key
+        self._writing: Tuple[Dict[str, _SessionEntry], Set[str]] = ({}, set())
+        # 未命中时从快照加载会话：key -> SessionRecord 或 None
+        self._page_in: Optional[Callable[[str], Optional[SessionRecord]]] = None
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, section: str = 'session') -> "SessionStore":
+        """
+        从config.ini读取参数创建会话存储
+        """
+        return cls(
+            max_entries=config.getint(section, 'max_entries', fallback=10000),
+            max_bytes=config.getint(section, 'max_memory_mb', fallback=256) * 1024 * 1024,
+            idle_ttl=config.getfloat(section, 'idle_ttl', fallback=3600),
+            max_messages=config.getint(section, 'max_messages', fallback=100),
+        )
+
+    @staticmethod
+    def make_key(namespace: str, openid: str, sessionid: int) -> str:
+        """
+        生成会话key，namespace区分不同的聊天接口
+        """
+        return f"{namespace}:{openid}_{sessionid}"
+
+    def get(self, key: str) -> Optional[List[Message]]:
+        """
+        获取会话的消息列表（新建的列表，系统提示和摘要在最前面），不存在或已过期时返回None
+        """
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is None and self._track_changes:
+            entry = self._load_paged_out(key, now)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if now - entry.last_access > self.idle_ttl:
+            self._remove(key)
+            self._mark_removed(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        entry.last_access = now
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.all_messages()
+
+    def append(self, key: str, role: str, content: str):
+        """
+        向会话追加一条消息，会话不存在时自动创建
+        """
+        self.extend(key, [Message(role, content)])
+
+    def extend(self, key: str, messages: Iterable[MessageLike]):
+        """
+        向会话追加多条消息（Message 或 dict），会话不存在时自动创建
+        """
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is None and self._track_changes:
+            entry = self._load_paged_out(key, now)
+        if entry is None:
+            entry = _SessionEntry(now)
+            self._entries[key] = entry
+            self._total_bytes += entry.size
+        else:
+            self._entries.move_to_end(key)
+        entry.last_access = now
+        if self._track_changes:
+            self._dirty.add(key)
+
+        for message in messages:
+            message = as_message(message)
+            if message.role == "system" and entry.prompt is None and not entry.messages:
+                entry.prompt = shared_prompt(message.content)
+                continue
+            if message.role == "user":
+                entry.turns += 1
+            entry.messages.append(message)
+            size = estimate_message_bytes(message)
+            entry.size += size
+            self._total_bytes += size
+
+        # 限制会话历史长度，避免占用过多内存；开头的系统提示和摘要始终保留
+        # 发送给AI的上下文另按token预算选择，见 common_context_window
+        pinned = len(entry.pinned())
+        if len(entry.messages) + pinned > self.max_messages:
+            keep = max(self.max_messages - pinned, 0)
+            dropped = entry.messages[:len(entry.messages) - keep]
+            entry.messages = entry.messages[len(entry.messages) - keep:]
+            freed = sum(estimate_message_bytes(m) for m in dropped)
+            entry.size -= freed
+            self._total_bytes -= freed
+
+        self._expire(now)
+        self._evict()
+
+    def compaction_candidate(self,
+                             key: str,
+                             trigger_messages: int,
+                             keep_messages: int) -> Optional[Tuple[Optional[str], List[Message], Any]]:
+        """
+        会话（不含系统提示和摘要）超过 trigger_messages 条时，返回需要摘要的内容：
+        (已有的摘要, 最早的若干轮消息, 交给 apply_summary 的校验标记)；否则返回None。不更新访问时间
+        """
+        entry = self._entries.get(key)
+        if entry is None or len(entry.messages) <= trigger_messages:
+            return None
+        count = fold_boundary(entry.messages, keep_messages)
+        if count == 0:
+            return None
+        folded = entry.messages[:count]
+        summary = entry.summary.content if entry.summary is not None else None
+        return summary, folded, (entry.summary, folded)
+
+    def apply_summary(self, key: str, token: Any, summary: str, summary_tokens: int) -> bool:
+        """
+        用摘要替换 compaction_candidate 返回的那几轮消息，其后追加的消息不受影响；
+        期间会话被删除、截断或已被另一次摘要替换时放弃，返回False
+        """
+        entry = self._entries.get(key)
+        previous, folded = token
+        if (entry is None or entry.summary is not previous or len(entry.messages) < len(folded)
+                or any(a is not b for a, b in zip(entry.messages, folded))):
+            return False
+        summary_message = Message("system", summary)
+        freed = sum(estimate_message_bytes(m) for m in folded)
+        if previous is not None:
+            freed += estimate_message_bytes(previous)
+        delta = estimate_message_bytes(summary_message) - freed
+        entry.messages = entry.messages[len(folded):]
+        entry.summary = summary_message
+        entry.summary_tokens = summary_tokens
+        entry.size += delta
+        self._total_bytes += delta
+        if self._track_changes:
+            self._dirty.add(key)
+        return True
+
+    async def extend_async(self, key: str, messages: Iterable[MessageLike]):
+        """
+        与 extend 相同，供事件循环中调用（与 SqliteSessionStore 的接口一致，内存操作直接完成）
+        """
+        self.extend(key, messages)
+
+    async def apply_summary_async(self, key: str, token: Any, summary: str, summary_tokens: int) -> bool:
+        """
+        与 apply_summary 相同，供事件循环中调用
+        """
+        return self.apply_summary(key, token, summary, summary_tokens)
+
+    def info(self, key: str) -> Optional[Dict[str, int]]:
+        """
+        会话概况：保留的消息条数、原始的对话轮数、摘要的token数；不在内存中时返回None
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return {"messages": len(entry.messages), "turns": entry.turns, "summary_tokens": entry.summary_tokens}
+
+    def delete(self, key: str):
+        """
+        删除会话
+        """
+        if key in self._entries:
+            self._remove(key)
+        self._paged_out.pop(key, None)
+        self._mark_removed(key)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        返回当前的容量和命中/未命中/淘汰统计
+        """
+        return {
+            "entries": len(self._entries),
+            "bytes": self._total_bytes,
+            "prompts": len(_shared_prompts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "paged_in": self.paged_in,
+        }
+
+    def enable_change_tracking(self, page_in: Callable[[str], Optional[SessionRecord]]):
+        """
+        开启变更记录，page_in 用于未命中时从快照中加载会话
+        """
+        self._track_changes = True
+        self._page_in = page_in
+
+    def take_changes(self) -> Tuple[Dict[str, SessionRecord], Set[str]]:
+        """
+        取出自上次快照以来的变更：(修改过的会话 key -> SessionRecord（消息为列表副本）, 已删除的key)
+
+        写入快照期间，被淘汰的会话仍从内存中加载、已删除的会话不会从快照中加载；
+        写入结束后必须调用 finish_changes
+        """
+        offset = time.time() - time.monotonic()
+        changed = {}
+        for key in self._dirty:
+            entry = self._entries.get(key) or self._paged_out.get(key)
+            if entry is not None:
+                changed[key] = SessionRecord(
+                    entry.prompt.content if entry.prompt is not None else None,
+                    list(entry.messages),
+                    entry.last_access + offset,
+                    entry.summary.content if entry.summary is not None else None,
+                    entry.turns,
+                    entry.summary_tokens,
+                )
+        self._writing = (self._paged_out, self._removed)
+        self._dirty = set()
+        self._removed = set()
+        self._paged_out = {}
+        return changed, self._writing[1]
+
+    def finish_changes(self, changed: Dict[str, SessionRecord], succeeded: bool):
+        """
+        快照写入结束；失败时放回变更，下次快照重试
+        """
+        paged_out, removed = self._writing
+        self._writing = ({}, set())
+        if succeeded:
+            return
+        for key, entry in paged_out.items():
+            if key not in self._entries and key not in self._removed:
+                self._paged_out.setdefault(key, entry)
+        for key in changed:
+            if key in self._entries or key in self._paged_out:
+                self._dirty.add(key)
+        self._removed |= removed - self._dirty
+
+    def restore(self, key: str, record: SessionRecord):
+        """
+        载入快照中的会话（启动时预加载用）；不记为修改
+        """
+        if key in self._entries:
+            return
+        entry = self._new_entry(record)
+        if time.monotonic() - entry.last_access > self.idle_ttl:
+            return
+        self._entries[key] = entry
+        self._entries.move_to_end(key, last=False)
+        self._total_bytes += entry.size
+        self._evict()
+
+    def _new_entry(self, record: SessionRecord) -> _SessionEntry:
+        entry = _SessionEntry(time.monotonic() - max(time.time() - record.last_access, 0.0))
+        entry.prompt = shared_prompt(record.prompt) if record.prompt is not None else None
+        entry.summary = Message("system", record.summary) if record.summary is not None else None
+        entry.messages = record.messages
+        entry.turns = record.turns
+        entry.summary_tokens = record.summary_tokens
+        entry.size += sum(estimate_message_bytes(m) for m in entry.messages)
+        if entry.summary is not None:
+            entry.size += estimate_message_bytes(entry.summary)
+        return entry
+
+    def _load_paged_out(self, key: str, now: float) -> Optional[_SessionEntry]:
+        """
+        会话不在内存中时，从尚未写入快照的淘汰会话或快照文件中加载
+        """
+        writing_paged_out, writing_removed = self._writing
+        entry = self._paged_out.pop(key, None) or writing_paged_out.get(key)
+        if entry is None and self._page_in is not None and key not in self._removed and key not in writing_removed:
+            loaded = self._page_in(key)
+            if loaded is None:
+                return None
+            entry = self._new_entry(loaded)
+            self.paged_in += 1
+        if entry is None:
+            return None
+        self._entries[key] = entry
+        self._total_bytes += entry.size
+        return entry
+
+    def _mark_removed(self, key: str):
+        if self._track_changes:
+            self._dirty.discard(key)
+            self._removed.add(key)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._total_bytes -= entry.size
+
+    def _expire(self, now: float):
+        """
+        清理过期会话：最久未访问的会话排在最前面，遇到第一个未过期的即可停止
+        """
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry.last_access <= self.idle_ttl:
+                break
+            self._remove(key)
+            self._mark_removed(key)
+            self.expirations += 1
+
+    def _evict(self):
+        """
+        超出会话数或内存上限时，淘汰最久未访问的会话
+        """
+        while self._entries and (len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes):
+            key = next(iter(self._entries))
+            if key in self._dirty:
+                # 尚未写入快照，暂存到下次快照
+                self._paged_out[key] = self._entries[key]
+            self._remove(key)
+            self.evictions += 1
+
+    def close(self):
+        """
+        进程内存储没有需要释放的资源，与 SqliteSessionStore 保持相同的接口
+        """
+
+
+# SQLite会话存储的表结构：sessions 记录每个会话的元数据、系统提示的引用和滚动摘要，
+# session_messages 按序号保存其余消息，session_prompts 中每个系统提示只保存一份
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_key TEXT PRIMARY KEY,
+    last_access REAL NOT NULL,
+    size INTEGER NOT NULL,
+    message_count INTEGER NOT NULL,
+    next_seq INTEGER NOT NULL,
+    prompt_id TEXT,
+    summary TEXT,
+    summary_tokens INTEGER NOT NULL DEFAULT 0,
+    turns INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access);
+CREATE TABLE IF NOT EXISTS session_messages (
+    session_key TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (session_key, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS session_prompts (
+    prompt_id TEXT PRIMARY KEY,
+    content TEXT NOT NULL
+);
+"""
+
+
+class SqliteSessionStore:
+    """
+    跨进程共享的多轮对话会话存储（SQLite，WAL模式）
+
+    用 uvicorn --workers 启动多个进程时，同一用户的下一轮对话可能落到另一个进程，
+    进程内的 SessionStore 会丢失历史；各进程打开同一个数据库文件即可共享会话。
+
+    - path: 数据库文件，同一台机器上的各worker进程使用同一个文件
+    - max_entries / max_bytes / idle_ttl / max_messages: 与 SessionStore 相同
+    - cleanup_interval: 清理过期会话、按LRU淘汰超量会话的最小间隔（秒），
+      两次清理之间会话数和容量可能暂时超过上限
+
+    接口与 SessionStore 相同。每次追加在一个 BEGIN IMMEDIATE 事务中完成：
+    写入消息、截断超长历史、更新访问时间，多个进程同时追加同一会话时不会交错或丢失。
+    读取不更新访问时间（随后的追加会更新），避免每轮对话多一次写事务。
+    写事务（追加、摘要替换、删除、清理）都在专用的写入线程中按提交顺序执行，使用自己的连接：
+    其他进程持有写锁时最多等待 busy_timeout 秒，只阻塞写入线程，事件循环中 await extend_async。
+    读取在调用线程中使用只读连接直接执行（WAL模式下读不等待写）
+    """
+
+    def __init__(self,
+                 path: str = 'sessions.db',
+                 max_entries: int = 10000,
+                 max_bytes: int = 256 * 1024 * 1024,
+                 idle_ttl: float = 3600,
+                 max_messages: int = 100,
+                 cleanup_interval: float = 60.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.max_messages = max_messages
+        self.cleanup_interval = cleanup_interval
+
+        # 写入线程使用的连接，只在该线程中访问；事件循环线程中读取使用的连接
+        self._writer: Optional[sqlite3.Connection] = None
+        self._reader: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid = None
+        self._last_cleanup = 0.0
+        # 已读取或写入过的系统提示：提示标识 -> 共享的消息记录
+        self._prompts: Dict[str, Message] = {}
+
+        # 统计计数（本进程）
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, section: str = 'session') -> "SqliteSessionStore":
+        """
+        从config.ini读取参数创建会话存储
+        """
+        return cls(
+            path=config.get(section, 'sqlite_path', fallback='sessions.db'),
+            max_entries=config.getint(section, 'max_entries', fallback=10000),
+            max_bytes=config.getint(section, 'max_memory_mb', fallback=256) * 1024 * 1024,
+            idle_ttl=config.getfloat(section, 'idle_ttl', fallback=3600),
+            max_messages=config.getint(section, 'max_messages', fallback=100),
+            cleanup_interval=config.getfloat(section, 'cleanup_interval', fallback=60.0),
+        )
+
+    make_key = staticmethod(SessionStore.make_key)
+
+    def _check_process(self):
+        # fork出的worker进程不能沿用父进程的连接和线程
+        if self._pid != os.getpid():
+            self._writer = self._reader = self._executor = None
+            self._pid = os.getpid()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SQLITE_SCHEMA)
+        return conn
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        读取使用的连接，首次使用时连接
+        """
+        self._check_process()
+        if self._reader is None:
+            self._reader = self._connect()
+        return self._reader
+
+    def _writer_connection(self) -> sqlite3.Connection:
+        # 只在写入线程中调用
+        if self._writer is None:
+            self._writer = self._connect()
+        return self._writer
+
+    def _write_executor(self) -> ThreadPoolExecutor:
+        self._check_process()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-store")
+        return self._executor
+
+    def _write(self, func, *args):
+        """
+        在写入线程中执行并等待结果（阻塞调用线程，事件循环中使用 _write_async）
+        """
+        return self._write_executor().submit(func, *args).result()
+
+    async def _write_async(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._write_executor(), func, *args)
+
+    def _transaction(self, mode: str = ""):
+        # 写事务使用写入线程的连接
+        return _Transaction(self._writer_connection() if mode else self._connection(), mode)
+
+    def _load_prompt(self, conn: sqlite3.Connection, pid: str) -> Optional[Message]:
+        prompt = self._prompts.get(pid)
+        if prompt is None:
+            row = conn.execute("SELECT content FROM session_prompts WHERE prompt_id = ?", (pid,)).fetchone()
+            if row is None:
+                return None
+            prompt = self._prompts[pid] = shared_prompt(row[0])
+        return prompt
+
+    def _save_prompt(self, conn: sqlite3.Connection, content: str) -> str:
+        # 只在创建会话时执行；不依赖缓存判断是否已保存，事务回滚后不会留下无效的引用
+        pid = prompt_id(content)
+        conn.execute("INSERT OR IGNORE INTO session_prompts (prompt_id, content) VALUES (?, ?)", (pid, content))
+        return pid
+
+    def get(self, key: str) -> Optional[List[Message]]:
+        """
+        获取会话的消息列表（新建的列表，系统提示和摘要在最前面），不存在或已过期时返回None
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT last_access, prompt_id, summary FROM sessions WHERE session_key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[0] <= self.idle_ttl:
+                rows = conn.execute(
+                    "SELECT role, content FROM session_messages WHERE session_key = ? ORDER BY seq", (key,)
+                ).fetchall()
+                prompt = self._load_prompt(conn, row[1]) if row[1] is not None else None
+                self.hits += 1
+                messages = [Message(role, content) for role, content in rows]
+                if row[2] is not None:
+                    # 摘要紧随系统提示
+                    messages.insert(0, Message("system", row[2]))
+                return [prompt] + messages if prompt is not None else messages
+
+        if row is not None:
+            # 排在之后的追加之前执行，过期的历史不会被接着追加
+            self._write_executor().submit(self._delete, key)
+            self.expirations += 1
+        self.misses += 1
+        return None
+
+    def append(self, key: str, role: str, content: str):
+        """
+        向会话追加一条消息，会话不存在时自动创建
+        """
+        self.extend(key, [Message(role, content)])
+
+    def extend(self, key: str, messages: Iterable[MessageLike]):
+        """
+        向会话追加多条消息（Message 或 dict），会话不存在时自动创建；追加和截断在同一个事务中完成。
+        等待写入完成，会阻塞调用线程，事件循环中使用 extend_async
+        """
+        self._write(self._extend, key, [as_message(m) for m in messages])
+
+    async def extend_async(self, key: str, messages: Iterable[MessageLike]):
+        """
+        与 extend 相同，在写入线程中执行，不阻塞事件循环
+        """
+        await self._write_async(self._extend, key, [as_message(m) for m in messages])
+
+    def _extend(self, key: str, messages: List[Message]):
+        now = time.time()
+        with self._transaction("IMMEDIATE") as conn:
+            row = conn.execute(
+                "SELECT size, message_count, next_seq, prompt_id, summary, summary_tokens, turns "
+                "FROM sessions WHERE session_key = ?", (key,)
+            ).fetchone()
+            size, count, next_seq, pid, summary, summary_tokens, turns = (
+                row if row is not None else (SESSION_OVERHEAD_BYTES, 0, 0, None, None, 0, 0)
+            )
+
+            # 新会话开头的系统提示只保存引用
+            if messages and messages[0].role == "system" and pid is None and count == 0:
+                pid = self._save_prompt(conn, messages[0].content)
+                messages = messages[1:]
+
+            conn.executemany(
+                "INSERT INTO session_messages (session_key, seq, role, content) VALUES (?, ?, ?, ?)",
+                [(key, next_seq + i, m.role, m.content) for i, m in enumerate(messages)]
+            )
+            next_seq += len(messages)
+            count += len(messages)
+            size += sum(estimate_message_bytes(m) for m in messages)
+            turns += sum(1 for m in messages if m.role == "user")
+
+            # 限制会话历史长度；系统提示和摘要不在 session_messages 中，始终保留
+            pinned = (1 if pid is not None else 0) + (1 if summary is not None else 0)
+            if count + pinned > self.max_messages:
+                cutoff = next_seq - max(self.max_messages - pinned, 0)
+                dropped = conn.execute(
+                    "SELECT role, content FROM session_messages WHERE session_key = ? AND seq < ?",
+                    (key, cutoff)
+                ).fetchall()
+                conn.execute("DELETE FROM session_messages WHERE session_key = ? AND seq < ?", (key, cutoff))
+                count -= len(dropped)
+                size -= sum(estimate_message_bytes({"role": role, "content": content}) for role, content in dropped)
+
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_key, last_access, size, message_count, next_seq, prompt_id, "
+                "summary, summary_tokens, turns) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, now, size, count, next_seq, pid, summary, summary_tokens, turns)
+            )
+
+        if now - self._last_cleanup >= self.cleanup_interval:
+            self._last_cleanup = now
+            self._cleanup(now)
+
+    def compaction_candidate(self,
+                             key: str,
+                             trigger_messages: int,
+                             keep_messages: int) -> Optional[Tuple[Optional[str], List[Message], Any]]:
+        """
+        与 SessionStore.compaction_candidate 相同；校验标记为被折叠消息的序号范围和已有的摘要
+        """
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT message_count, summary FROM sessions WHERE session_key = ?", (key,)
+        ).fetchone()
+        if row is None or row[0] <= trigger_messages:
+            return None
+        rows = conn.execute(
+            "SELECT seq, role, content FROM session_messages WHERE session_key = ? ORDER BY seq", (key,)
+        ).fetchall()
+        messages = [Message(role, content) for _, role, content in rows]
+        count = fold_boundary(messages, keep_messages)
+        if count == 0:
+            return None
+        return row[1], messages[:count], (rows[0][0], rows[count - 1][0], count, row[1])
+
+    def apply_summary(self, key: str, token: Any, summary: str, summary_tokens: int) -> bool:
+        """
+        与 SessionStore.apply_summary 相同；在一个 BEGIN IMMEDIATE 事务中校验并替换，多个进程同时摘要同一会话时只有一个生效。
+        等待写入完成，事件循环中使用 apply_summary_async
+        """
+        return self._write(self._apply_summary, key, token, summary, summary_tokens)
+
+    async def apply_summary_async(self, key: str, token: Any, summary: str, summary_tokens: int) -> bool:
+        """
+        与 apply_summary 相同，在写入线程中执行，不阻塞事件循环
+        """
+        return await self._write_async(self._apply_summary, key, token, summary, summary_tokens)
+
+    def _apply_summary(self, key: str, token: Any, summary: str, summary_tokens: int) -> bool:
+        first_seq, last_seq, count, previous = token
+        with self._transaction("IMMEDIATE") as conn:
+            row = conn.execute(
+                "SELECT size, message_count, summary FROM sessions WHERE session_key = ?", (key,)
+            ).fetchone()
+            if row is None or row[2] != previous:
+                return False
+            folded = conn.execute(
+                "SELECT role, content FROM session_messages WHERE session_key = ? AND seq >= ? AND seq <= ?",
+                (key, first_seq, last_seq)
+            ).fetchall()
+            # 期间被截断的会话，范围内的消息已不完整
+            if len(folded) != count:
+                return False
+            conn.execute("DELETE FROM session_messages WHERE session_key = ? AND seq >= ? AND seq <= ?",
+                         (key, first_seq, last_seq))
+            freed = sum(estimate_message_bytes({"role": role, "content": content}) for role, content in folded)
+            if previous is not None:
+                freed += estimate_message_bytes({"role": "system", "content": previous})
+            size = row[0] + estimate_message_bytes({"role": "system", "content": summary}) - freed
+            conn.execute(
+                "UPDATE sessions SET size = ?, message_count = ?, summary = ?, summary_tokens = ? WHERE session_key = ?",
+                (size, row[1] - count, summary, summary_tokens, key)
+            )
+        return True
+
+    def info(self, key: str) -> Optional[Dict[str, int]]:
+        """
+        会话概况：保留的消息条数、原始的对话轮数、摘要的token数；不存在时返回None
+        """
+        row = self._connection().execute(
+            "SELECT message_count, turns, summary_tokens FROM sessions WHERE session_key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"messages": row[0], "turns": row[1], "summary_tokens": row[2]}
+
+    def delete(self, key: str):
+        """
+        删除会话（等待写入完成）
+        """
+        self._write(self._delete, key)
+
+    def _delete(self, key: str):
+        with self._transaction("IMMEDIATE") as conn:
+            conn.execute("DELETE FROM session_messages WHERE session_key = ?", (key,))
+            conn.execute("DELETE FROM sessions WHERE session_key = ?", (key,))
+
+    def _cleanup(self, now: float):
+        """
+        清理过期会话；超出会话数或容量上限时，按最后访问时间淘汰最旧的会话
+        """
+        with self._transaction("IMMEDIATE") as conn:
+            deadline = now - self.idle_ttl
+            conn.execute(
+                "DELETE FROM session_messages WHERE session_key IN "
+                "(SELECT session_key FROM sessions WHERE last_access < ?)", (deadline,)
+            )
+            self.expirations += conn.execute("DELETE FROM sessions WHERE last_access < ?", (deadline,)).rowcount
+
+            entries, total_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM sessions").fetchone()
+            if entries <= self.max_entries and total_bytes <= self.max_bytes:
+                return
+            evicted = []
+            for key, size in conn.execute("SELECT session_key, size FROM sessions ORDER BY last_access"):
+                if entries <= self.max_entries and total_bytes <= self.max_bytes:
+                    break
+                evicted.append((key,))
+                entries -= 1
+                total_bytes -= size
+            conn.executemany("DELETE FROM session_messages WHERE session_key = ?", evicted)
+            conn.executemany("DELETE FROM sessions WHERE session_key = ?", evicted)
+            self.evictions += len(evicted)
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        返回当前的容量（所有进程共享）和命中/未命中/淘汰统计（本进程）
+        """
+        entries, total_bytes = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM sessions"
+        ).fetchone()
+        return {
+            "entries": entries,
+            "bytes": total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def close(self):
+        """
+        等待尚未完成的写入，关闭数据库连接（在服务关闭时调用）
+        """
+        if self._pid == os.getpid():
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            for conn in (self._writer, self._reader):
+                if conn is not None:
+                    conn.close()
+        self._writer = self._reader = self._executor = None
+
+
+class _Transaction:
+    """
+    显式事务：正常退出时提交，异常时回滚
+    """
+
+    def __init__(self, conn: sqlite3.Connection, mode: str):
+        self.conn = conn
+        self.mode = mode
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute(f"BEGIN {self.mode}")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        return False
+
+
+def create_session_store(config: ConfigParser, section: str = 'session'):
+    """
+    按config.ini中的 backend 创建会话存储：memory（默认，单进程）或 sqlite（多个worker进程共享）
+    """
+    backend = config.get(section, 'backend', fallback='memory').lower()
+    if backend == 'sqlite':
+        return SqliteSessionStore.from_config(config, section)
+    if backend != 'memory':
+        raise ValueError(f"不支持的会话存储: {backend}，可选 memory / sqlite")
+    return SessionStore.from_config(config, section)
+
+
+# 进程内共享的会话存储，所有多轮对话接口共用
+session_store = create_session_store(config)
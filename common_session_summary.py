@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+会话滚动摘要 -- 长对话超过阈值后，在后台把最早的若干轮对话压缩成一条摘要，固定在系统提示之后
+@Version: 1.0
+@Author: lordli
+@Date: 2025-07-05
+@Description: 长时间的人设聊天（lonely、MJPrompt等）会话越来越长，超过上限后最早的对话直接被截断丢弃。
+              开启后，每轮对话保存完成时检查会话长度，超过 trigger_messages 条即在后台调用模型，
+              把最近 keep_messages 条之前的对话（连同已有的摘要）合并成新的摘要，替换掉这些对话。
+              摘要调用不在请求路径上，以最低的排队优先级执行，不计入用户的用量；
+              调用期间会话被截断、删除或已被另一次摘要替换时放弃本次结果，之后追加的消息不受影响。
+              每次请求的prompt大致稳定在“系统提示 + 摘要 + 最近几轮”，不再随对话增长直到被截断
+"""
+
+import asyncio
+import contextvars
+import logging
+from configparser import ConfigParser
+from common_ai_chat import async_chat_with_ai
+from common_config import config
+from common_context_window import estimate_tokens
+from common_session_store import Message, session_store
+from typing import Dict, List, Optional, Set
+
+# 摘要在会话中的开头，发送给AI时说明这是之前对话的概要
+SUMMARY_HEADER = "以下是与用户此前对话的摘要，请在接下来的回复中延续其中的设定和信息：\n"
+
+SUMMARY_INSTRUCTION = (
+    "你是对话摘要助手。请把下面的对话记录（以及已有的摘要）合并成一段简洁的中文摘要，"
+    "保留用户的身份信息、偏好、双方已确定的事实和约定、角色设定以及尚未结束的话题，"
+    "去掉寒暄和重复内容，不要添加对话中没有的信息。摘要不超过{max_chars}字，直接输出摘要正文。"
+)
+
+# 对话记录中各角色的称呼
+ROLE_NAMES = {"user": "用户", "assistant": "助理"}
+
+# 排队优先级：低于所有用户（VIP等级从0开始），上游繁忙时最后执行
+SUMMARY_PRIORITY = -1
+
+
+def build_summary_request(summary: Optional[str], messages: List[Message], max_chars: int) -> List[Dict[str, str]]:
+    """
+    生成摘要调用的消息：说明 + 已有的摘要和需要折叠的对话记录
+    """
+    parts = []
+    if summary:
+        if summary.startswith(SUMMARY_HEADER):
+            summary = summary[len(SUMMARY_HEADER):]
+        parts.append("已有的摘要：\n" + summary)
+    parts.append("对话记录：\n" + "\n".join(f"{ROLE_NAMES.get(m.role, m.role)}：{m.content}" for m in messages))
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTION.format(max_chars=max_chars)},
+        {"role": "user", "content": "\n\n".join(parts)},
+    ]
+
+
+class SessionSummarizer:
+    """
+    会话滚动摘要
+
+    - enabled: 是否开启（每次摘要都是一次额外的模型调用）
+    - trigger_messages: 会话（不含系统提示和摘要）超过该条数时摘要
+    - keep_messages: 摘要后保留的最近消息条数（向后对齐到完整的一轮）
+    - model / temperature / max_tokens: 摘要调用的参数
+    - max_concurrent: 同时进行的摘要调用数
+    - max_pending: 等待摘要的会话数上限，超出后新的会话本轮不摘要（下一轮再检查）
+
+    每个会话同时只有一个摘要任务；所有操作在事件循环线程中完成
+    """
+
+    def __init__(self,
+                 store,
+                 enabled: bool = False,
+                 trigger_messages: int = 40,
+                 keep_messages: int = 10,
+                 model: str = 'glm-4-flash',
+                 temperature: float = 0.3,
+                 max_tokens: int = 600,
+                 max_concurrent: int = 2,
+                 max_pending: int = 1000):
+        self.store = store
+        self.enabled = enabled
+        self.trigger_messages = trigger_messages
+        self.keep_messages = keep_messages
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.max_concurrent = max_concurrent
+        self.max_pending = max_pending
+
+        self._pending: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+        # 统计
+        self.summarized = 0
+        self.folded_messages = 0
+        self.discarded = 0
+        self.failed = 0
+        self.skipped = 0
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, store, section: str = 'summary') -> "SessionSummarizer":
+        """
+        从config.ini读取参数创建会话摘要
+        """
+        return cls(
+            store,
+            enabled=config.getboolean(section, 'enabled', fallback=False),
+            trigger_messages=config.getint(section, 'trigger_messages', fallback=40),
+            keep_messages=config.getint(section, 'keep_messages', fallback=10),
+            model=config.get(section, 'model', fallback=None) or config.get('zhipu', 'model', fallback='glm-4-flash'),
+            temperature=config.getfloat(section, 'temperature', fallback=0.3),
+            max_tokens=config.getint(section, 'max_tokens', fallback=600),
+            max_concurrent=config.getint(section, 'max_concurrent', fallback=2),
+            max_pending=config.getint(section, 'max_pending', fallback=1000),
+        )
+
+    def maybe_schedule(self, key: str):
+        """
+        会话保存后调用：超过阈值时安排一次后台摘要，不等待其完成
+        """
+        if not self.enabled or key in self._pending:
+            return
+        candidate = self.store.compaction_candidate(key, self.trigger_messages, self.keep_messages)
+        if candidate is None:
+            return
+        if len(self._pending) >= self.max_pending:
+            self.skipped += 1
+            return
+        self._pending.add(key)
+        # 在空白的上下文中执行：摘要调用不计入当前请求的用量
+        task = asyncio.create_task(self._summarize(key, *candidate), context=contextvars.Context())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _summarize(self, key: str, summary: Optional[str], messages: List[Message], token):
+        try:
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self.max_concurrent)
+            async with self._semaphore:
+                # 按字数限制摘要长度，给模型留出余量（中文大致每个字1个token）
+                text = await async_chat_with_ai(
+                    build_summary_request(summary, messages, max(self.max_tokens * 2 // 3, 50)),
+                    model=self.model,
+                    temperature=self.temperature,
+                    max_tokens=self.max_tokens,
+                    priority=SUMMARY_PRIORITY,
+                )
+            text = (text or "").strip()
+            if not text:
+                self.failed += 1
+                return
+            content = SUMMARY_HEADER + text
+            if await self.store.apply_summary_async(key, token, content, estimate_tokens(content)):
+                self.summarized += 1
+                self.folded_messages += len(messages)
+                logging.info("会话摘要: %s 折叠%s条消息，摘要约%s个token", key, len(messages), estimate_tokens(content))
+            else:
+                self.discarded += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 失败时保持原样，下一轮对话保存后会再次尝试
+            self.failed += 1
+            logging.warning("会话摘要失败: %s: %s", key, e)
+        finally:
+            self._pending.discard(key)
+
+    async def stop(self):
+        """
+        取消尚未完成的摘要（在服务关闭时、写入最后一次会话快照之前调用）
+        """
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        # 尚未开始执行就被取消的任务不会清理自己的标记
+        self._pending.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        返回摘要统计
+        """
+        return {
+            "pending": len(self._pending),
+            "summarized": self.summarized,
+            "folded_messages": self.folded_messages,
+            "discarded": self.discarded,
+            "failed": self.failed,
+            "skipped": self.skipped,
+        }
+
+
+# 进程内共享的会话摘要
+session_summarizer = SessionSummarizer.from_config(config, session_store)
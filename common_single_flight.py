@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+相同请求合并 -- 同一时刻key相同的上游请求只发送一次
+@Version: 1.2
+@Author: lordli
+@Date: 2025-06-22
+@Description: 热门问题（如/getSample/中的法律示例）被大量用户同时提交时，只向AI发起一次调用，所有等待者共享结果或异常
+@Update:
+        1.0 合并非流式调用
+        1.1 stream：合并流式调用，后加入的等待者先重放已收到的内容，再跟随后续内容
+        1.2 priority：合并的调用在准入控制中按所有等待者中最高的优先级排队，
+            VIP加入普通用户发起的调用时不再跟着按普通用户的优先级等待
+"""
+
+import asyncio
+import contextvars
+from common_admission import SharedPriority, shared_priority
+from common_config import config
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+class _StreamFlight:
+    """
+    一次在途的流式调用：已收到的增量内容、结束状态，以及通知等待者有新内容的future
+    """
+
+    def __init__(self, meta: Any, priority: SharedPriority):
+        self.meta = meta
+        self.priority = priority
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self.changed = asyncio.get_running_loop().create_future()
+
+    def notify(self):
+        self.changed.set_result(None)
+        self.changed = asyncio.get_running_loop().create_future()
+
+
+class SingleFlight:
+    """
+    在途请求合并
+
+    第一个请求创建上游调用任务，之后key相同的请求直接等待该任务；任务结束后立即移除，
+    不缓存结果，因此不存在数据过期的问题。上游调用在独立的Task中执行，
+    即使发起它的客户端断开连接，其他等待者也能拿到结果
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+        self._priorities: Dict[str, SharedPriority] = {}
+
+        # 统计计数：实际发起的上游调用数，以及被合并掉的调用数
+        self.calls = 0
+        self.folded = 0
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]], priority: int = 0) -> Any:
+        """
+        执行或加入key对应的在途调用
+
+        Args:
+            key (str): 请求的唯一标识（与响应缓存的key相同）
+            factory (Callable): 创建上游调用协程的函数，只在没有在途调用时执行
+            priority (int): 本请求的排队优先级（用户的VIP等级），上游调用按所有等待者中最高的排队
+
+        Returns:
+            上游调用的结果，异常同样会抛给所有等待者
+        """
+        if not self.enabled:
+            self.calls += 1
+            return await factory()
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.folded += 1
+            self._priorities[key].raise_to(priority)
+        else:
+            self.calls += 1
+            shared = SharedPriority(priority)
+            task = asyncio.create_task(self._call(factory), context=self._context(shared))
+            self._inflight[key] = task
+            self._priorities[key] = shared
+            task.add_done_callback(lambda t: self._done(key, t))
+
+        # shield：单个等待者被取消时不影响上游调用和其他等待者
+        return await asyncio.shield(task)
+
+    @staticmethod
+    def _context(shared: SharedPriority) -> contextvars.Context:
+        # 上游调用的任务在当前上下文的副本中执行，另外带上共用的排队优先级
+        context = contextvars.copy_context()
+        context.run(shared_priority.set, shared)
+        return context
+
+    @staticmethod
+    async def _call(factory: Callable[[], Awaitable[Any]]) -> Any:
+        return await factory()
+
+    def _done(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            del self._priorities[key]
+        # 读取一次异常，避免所有等待者都已取消时出现 "exception was never retrieved" 警告
+        if not task.cancelled():
+            task.exception()
+
+    def stream(self, key: str,
+               factory: Callable[[], Tuple[AsyncIterator[Any], Any]],
+               priority: int = 0) -> Tuple[AsyncIterator[Any], Any]:
+        """
+        执行或加入key对应的在途流式调用
+
+        上游的流由独立的Task读取并保存，每个等待者先从头重放已收到的内容，再跟随后续内容；
+        所有等待者都断开时取消上游调用
+
+        Args:
+            key (str): 请求的唯一标识（与非流式调用分开合并）
+            factory (Callable): 返回 (上游增量内容的异步迭代器, 附加信息) 的函数，只在没有在途调用时执行；
+                附加信息（如token用量）由迭代器在流结束前填好，所有等待者共享同一个对象
+            priority (int): 本请求的排队优先级，与 do 相同
+
+        Returns:
+            Tuple: 本等待者的增量内容迭代器，附加信息；上游异常在迭代时抛给所有等待者
+        """
+        flight = self._streams.get(key) if self.enabled else None
+        if flight is not None:
+            self.folded += 1
+            flight.priority.raise_to(priority)
+        else:
+            self.calls += 1
+            chunks, meta = factory()
+            flight = _StreamFlight(meta, SharedPriority(priority))
+            if self.enabled:
+                self._streams[key] = flight
+            flight.task = asyncio.create_task(self._pump(key, flight, chunks),
+                                              context=self._context(flight.priority))
+        flight.subscribers += 1
+        return self._follow(key, flight), flight.meta
+
+    async def _pump(self, key: str, flight: _StreamFlight, chunks: AsyncIterator[Any]):
+        try:
+            async for chunk in chunks:
+                flight.chunks.append(chunk)
+                flight.notify()
+        except asyncio.CancelledError:
+            # 所有等待者都已断开
+            flight.error = asyncio.CancelledError()
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            if self._streams.get(key) is flight:
+                del self._streams[key]
+            flight.notify()
+            # 关闭上游的流，释放准入名额和连接
+            aclose = getattr(chunks, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    async def _follow(self, key: str, flight: _StreamFlight) -> AsyncIterator[Any]:
+        index = 0
+        try:
+            while True:
+                if index < len(flight.chunks):
+                    chunk = flight.chunks[index]
+                    index += 1
+                    yield chunk
+                    continue
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                # shield：单个等待者被取消时不影响其他等待者正在等的future
+                await asyncio.shield(flight.changed)
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # 先移除，之后相同的请求重新发起调用，不会加入正在取消的调用
+                if self._streams.get(key) is flight:
+                    del self._streams[key]
+                flight.task.cancel()
+
+    def __len__(self) -> int:
+        return len(self._inflight) + len(self._streams)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        返回在途调用数和合并统计
+        """
+        return {
+            "inflight": len(self._inflight) + len(self._streams),
+            "calls": self.calls,
+            "folded": self.folded,
+        }
+
+
+# 进程内共享的请求合并器
+single_flight = SingleFlight(enabled=config.getboolean('single_flight', 'enabled', fallback=True))
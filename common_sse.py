@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+流式响应工具 -- Server-Sent Events
+@Version: 1.1
+@Author: lordli
+@Date: 2025-06-20
+@Description: 将AI的流式输出转换为SSE事件推送给小程序，各聊天接口的流式模式共用
+@Update:
+        1.0 SSE事件流
+        1.1 on_complete 可以是异步函数（例如等待会话历史写入）
+"""
+
+import inspect
+import json
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, Any, Union
+from fastapi.responses import StreamingResponse
+
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    """
+    构造一条SSE事件
+
+    Args:
+        event (str): 事件名称，delta / done / error
+        data (Dict[str, Any]): 事件数据，序列化为一行JSON
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def sse_chat_stream(chunks: AsyncIterator[str],
+                          on_complete: Callable[[str], Union[Dict[str, Any], Awaitable[Dict[str, Any]]]],
+                          on_error: Callable[[Exception], Dict[str, Any]]) -> AsyncIterator[str]:
+    """
+    把AI的增量输出包装成SSE事件流
+
+    每段增量内容以 delta 事件立即推送；流结束后，用拼接好的完整回复调用 on_complete
+    （例如保存会话历史），其返回值作为 done 事件推送；出错时推送 on_error 的返回值
+
+    Args:
+        chunks (AsyncIterator[str]): AI响应的增量内容
+        on_complete (Callable[[str], Dict]): 流结束时的回调，参数为完整回复，返回最终结果（可以是异步函数）
+        on_error (Callable[[Exception], Dict]): 出错时的回调，返回错误结果
+    """
+    parts = []
+    try:
+        async for delta in chunks:
+            parts.append(delta)
+            yield sse_event("delta", {"content": delta})
+    except Exception as e:
+        logging.exception("AI流式调用失败: %s", e)
+        yield sse_event("error", on_error(e))
+        return
+
+    result = on_complete("".join(parts))
+    if inspect.isawaitable(result):
+        result = await result
+    yield sse_event("done", result)
+
+
+async def iter_text(text: str) -> AsyncIterator[str]:
+    """
+    把完整文本包装成只有一段的增量输出（例如命中缓存时），以便复用 sse_chat_stream
+    """
+    yield text
+
+
+def sse_response(events: AsyncIterator[str]) -> StreamingResponse:
+    """
+    以 text/event-stream 返回SSE事件流，并关闭代理缓冲，保证首字节尽快到达客户端
+    """
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+启动耗时报告 -- 记录服务启动各阶段（导入各路由模块、恢复缓存、初始化存储等）的耗时
+@Version: 1.1
+@Author: lordli
+@Date: 2025-07-03
+@Description: 扩容时新进程越快就绪越好；server.py 最先导入本模块，用 phase() 包住各启动步骤，
+              启动完成时输出一行汇总日志，/metrics 中也可以看到各阶段的耗时。
+              要看每个第三方包的导入耗时，用 bench/import_time.py
+@Update:
+        1.0 构建基础服务
+        1.1 汇总日志改为INFO级别，common_startup logger 单独设置为INFO，不受根logger的WARNING级别过滤
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+
+class StartupReport:
+    """
+    启动各阶段的耗时（秒），按发生的顺序记录；同名的阶段累加
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.ready_after = None
+        # 根logger的级别通常为WARNING，汇总日志是INFO，本logger单独设置级别
+        self.logger = logging.getLogger("common_startup")
+        self.logger.setLevel(logging.INFO)
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        记录一个启动阶段的耗时
+
+        用法：
+            with startup_report.phase("import api_chatLaw"):
+                from api_chatLaw import router as ChatLawRouter
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def mark_ready(self):
+        """
+        启动完成、开始接收请求时调用，输出汇总日志
+        """
+        self.ready_after = time.perf_counter() - self.started
+        self.phases["total"] = self.ready_after
+        self.logger.info(self.summary())
+
+    def summary(self) -> str:
+        """
+        一行汇总：就绪总耗时，以及耗时最多的阶段在前的各阶段耗时（毫秒）
+        """
+        total = self.ready_after if self.ready_after is not None else time.perf_counter() - self.started
+        parts = [
+            f"{name} {seconds * 1000:.0f}ms"
+            for name, seconds in sorted(self.phases.items(), key=lambda item: -item[1])
+            if name != "total"
+        ]
+        return f"服务启动完成，耗时 {total * 1000:.0f}ms：" + "，".join(parts)
+
+
+# 进程内共享的启动耗时报告，从本模块被导入时开始计时
+startup_report = StartupReport()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+静态数据响应 -- 预先序列化的JSON响应，支持ETag / 304
+@Version: 1.1
+@Author: lordli
+@Date: 2025-06-24
+@Description: getTips、getFunctions、getSample等固定数据在启动时序列化一次，之后直接返回字节；
+              客户端带上 If-None-Match 且内容未变时返回304；依赖的配置文件变化后自动重新生成
+@Update:
+        1.0 预先序列化和ETag
+        1.1 默认不监视文件：只有builder每次都重新读取的文件才值得监视（config.ini只在启动时解析一次）
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, Any, Optional, Sequence
+from fastapi import Request, Response
+
+
+def serialize_payload(data: Dict[str, Any]) -> bytes:
+    """
+    序列化为JSON字节，格式与FastAPI默认的JSONResponse一致
+    """
+    return json.dumps(data, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+class StaticPayload:
+    """
+    预先序列化的静态响应
+
+    - builder: 生成响应数据的函数
+    - watch_files: builder每次都会重新读取的文件，文件修改时间变化后重新生成；为空时不检查，只在 invalidate 时重新生成
+    - check_interval: 检查文件修改时间的最小间隔（秒），避免每次请求都访问文件系统
+    """
+
+    def __init__(self,
+                 builder: Callable[[], Dict[str, Any]],
+                 watch_files: Sequence[str] = (),
+                 check_interval: float = 5.0):
+        self.builder = builder
+        self.watch_files = tuple(watch_files)
+        self.check_interval = check_interval
+
+        self.body = b""
+        self.etag = ""
+        self._mtimes = ()
+        self._last_check = 0.0
+        self._build()
+
+    def _file_mtimes(self):
+        mtimes = []
+        for path in self.watch_files:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def _build(self):
+        """
+        调用builder生成数据，序列化并计算ETag
+        """
+        self._mtimes = self._file_mtimes()
+        self._last_check = time.monotonic()
+        self.body = serialize_payload(self.builder())
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:32] + '"'
+
+    def invalidate(self):
+        """
+        立即重新生成（例如数据来源在代码中被修改后）
+        """
+        self._build()
+
+    def _refresh_if_changed(self):
+        if not self.watch_files:
+            return
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        if self._file_mtimes() != self._mtimes:
+            try:
+                self._build()
+            except Exception as e:
+                # 重新生成失败时继续使用旧数据
+                logging.exception("静态数据重新生成失败: %s", e)
+
+    def _not_modified(self, if_none_match: Optional[str]) -> bool:
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == self.etag:
+                return True
+        return False
+
+    def response(self, request: Request) -> Response:
+        """
+        返回预先序列化的响应；客户端缓存的ETag与当前一致时返回304
+        """
+        self._refresh_if_changed()
+        headers = {
+            "ETag": self.etag,
+            # 允许客户端缓存，但每次使用前都要带ETag确认
+            "Cache-Control": "no-cache",
+        }
+        if self._not_modified(request.headers.get("if-none-match")):
+            return Response(status_code=304, headers=headers)
+        return Response(content=self.body, media_type="application/json", headers=headers)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+请求耗时分段 -- 记录每个请求在各阶段（校验、余额检查、会话读取、排队、上游调用、编码响应……）花费的时间
+@Version: 1.1
+@Author: lordli
+@Date: 2025-07-07
+@Description: 聊天请求慢的时候，/metrics 只能看到总耗时。中间件为每个请求创建一个 RequestTrace
+              （请求ID取自请求头 X-Request-ID，没有则生成，并在响应头中返回），各接口和AI客户端用 span()
+              记录各阶段的耗时；超过 slow_threshold_ms 的请求输出一行慢请求日志，列出全部分段。
+              不在请求中调用 span() 时什么也不做，开销只是一次 ContextVar 读取
+@Update:
+        1.0 构建基础服务
+        1.1 请求结束时调用访问日志（access_log），接口可在 tags 中附加 function、openid哈希等字段
+"""
+
+import logging
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from configparser import ConfigParser
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# 端点函数本身的分段名，track_chat 记录；中间件据此推算校验请求和编码响应的耗时
+ENDPOINT_SPAN = "endpoint"
+
+# 客户端传入的请求ID只接受这些字符，避免把任意内容写进日志和响应头
+_REQUEST_ID = re.compile(r"^[A-Za-z0-9._\-]{1,64}$")
+
+_current_trace: ContextVar[Optional["RequestTrace"]] = ContextVar("request_trace", default=None)
+
+# 进程内的统计，/metrics 中输出
+tracing_stats = {"slow_requests": 0}
+
+
+class RequestTrace:
+    """
+    一个请求的各分段：(名称, 相对请求开始的时间, 耗时)，单位秒，按结束的先后记录；
+    tags 为接口附加的字段（function、openid哈希、返回的status），写入访问日志
+    """
+    __slots__ = ("request_id", "method", "path", "started", "response_started", "spans", "tags")
+
+    def __init__(self, request_id: str, method: str, path: str):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.response_started: Optional[float] = None
+        self.spans: List[Tuple[str, float, float]] = []
+        self.tags: Dict[str, Any] = {}
+
+    def add(self, name: str, start: float, end: float):
+        self.spans.append((name, start - self.started, end - start))
+
+    def finish(self, now: float) -> List[Tuple[str, float, float]]:
+        """
+        请求结束：补上由端点分段推算出的阶段，返回按开始时间排序的全部分段
+
+        - before_endpoint: 读取请求体、路由匹配和pydantic校验
+        - encode_response: 端点返回后到开始发送响应（序列化响应）
+        - send_response: 开始发送响应到发送完毕（流式响应为整个流的时长）
+        """
+        spans = list(self.spans)
+        endpoint = next((s for s in spans if s[0] == ENDPOINT_SPAN), None)
+        response_offset = self.response_started - self.started if self.response_started is not None else None
+        if endpoint is not None:
+            spans.append(("before_endpoint", 0.0, endpoint[1]))
+            endpoint_end = endpoint[1] + endpoint[2]
+            if response_offset is not None and response_offset >= endpoint_end:
+                spans.append(("encode_response", endpoint_end, response_offset - endpoint_end))
+        if response_offset is not None and now - self.response_started > 0.001:
+            spans.append(("send_response", response_offset, now - self.response_started))
+        spans.sort(key=lambda s: s[1])
+        return spans
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+
+def current_request_id() -> Optional[str]:
+    """
+    当前请求的ID，不在请求中时为None
+    """
+    trace = _current_trace.get()
+    return trace.request_id if trace is not None else None
+
+
+@contextmanager
+def span(name: str):
+    """
+    记录一个阶段的耗时，可用于同步和异步代码
+
+    用法：
+        with span("check_user_balance"):
+            balance_ok, balance_status = await check_user_balance(request.openid)
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, start, time.perf_counter())
+
+
+def record_span(name: str, start: float, end: Optional[float] = None):
+    """
+    记录一个已知开始时间（time.perf_counter）的阶段，用于不方便包成 with 块的场合（如排队等待）
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, start, end if end is not None else time.perf_counter())
+
+
+def format_spans(spans: List[Tuple[str, float, float]]) -> str:
+    return "，".join(f"{name} {duration * 1000:.0f}ms@{offset * 1000:.0f}" for name, offset, duration in spans)
+
+
+class TracingMiddleware:
+    """
+    ASGI中间件：为每个请求创建耗时分段记录，在响应头中返回请求ID，慢请求输出分段日志
+
+    - header: 请求ID的请求头/响应头
+    - slow_threshold: 慢请求阈值（秒），0为不输出
+    - access_log: 请求结束时调用 access_log(trace, 路由, HTTP状态码, 耗时)，为None时不记录
+    """
+
+    def __init__(self, app, enabled: bool = True, header: str = "X-Request-ID", slow_threshold: float = 3.0,
+                 access_log: Optional[Callable[[RequestTrace, str, int, float], None]] = None):
+        self.app = app
+        self.enabled = enabled
+        self.header = header.lower().encode("latin-1")
+        self.slow_threshold = slow_threshold
+        self.access_log = access_log
+
+    @classmethod
+    def options_from_config(cls, config: ConfigParser, section: str = 'tracing') -> Dict[str, Any]:
+        """
+        从config.ini读取中间件参数，用于 app.add_middleware(TracingMiddleware, **options)
+        """
+        return {
+            "enabled": config.getboolean(section, 'enabled', fallback=True),
+            "header": config.get(section, 'header', fallback='X-Request-ID'),
+            "slow_threshold": config.getfloat(section, 'slow_threshold_ms', fallback=3000) / 1000,
+        }
+
+    def _request_id(self, scope) -> str:
+        for name, value in scope.get("headers", ()):
+            if name == self.header:
+                value = value.decode("latin-1")
+                if _REQUEST_ID.match(value):
+                    return value
+                break
+        return uuid.uuid4().hex
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace(self._request_id(scope), scope.get("method", ""), scope.get("path", ""))
+        token = _current_trace.set(trace)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                trace.response_started = time.perf_counter()
+                status_code = message["status"]
+                message = dict(message)
+                message["headers"] = list(message.get("headers", ())) + [
+                    (self.header, trace.request_id.encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_trace.reset(token)
+            now = time.perf_counter()
+            total = now - trace.started
+            route = getattr(scope.get("route"), "path", None) or trace.path
+            if self.slow_threshold and total >= self.slow_threshold:
+                tracing_stats["slow_requests"] += 1
+                logging.warning(
+                    f"慢请求 {trace.request_id} {trace.method} {route} {status_code} 耗时{total * 1000:.0f}ms："
+                    f"{format_spans(trace.finish(now))}"
+                )
+            if self.access_log is not None:
+                self.access_log(trace, route, status_code, total)
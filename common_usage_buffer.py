@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+用量写后缓冲 -- 按用户累计token用量和余额扣减，定时批量写入数据库
+@Version: 1.3
+@Author: lordli
+@Date: 2025-07-01
+@Description: 每轮对话都UPDATE一次用户表会压垮数据库；用量先在内存中按 openid 合并，
+              到达时间间隔或条数阈值时在一个事务中批量写入。每条用量同时追加到本地日志，
+              进程崩溃后重启时补写；批次号与用量在同一事务中落库，补写不会重复扣费
+@Update:
+        1.0 构建基础服务
+        1.1 多个worker进程时，每个进程启动时锁定一个独立的日志文件（usage.journal、usage.journal-1 ……）
+        1.2 批量接口的一批对话合计为一次用量（只扣一次费）
+        1.3 命中缓存、与其他请求合并的对话按生成回复的上游调用的用量计费，只在没有用量时估算
+"""
+
+import asyncio
+import glob
+import json
+import logging
+import os
+import time
+import uuid
+from configparser import ConfigParser
+try:
+    import fcntl
+except ImportError:  # Windows：不支持文件锁，只能单进程部署
+    fcntl = None
+from common_config import config
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from common_context_window import estimate_tokens, estimate_message_tokens
+from common_user_store import UserStore, user_store
+
+# 模型档位对应的用量字段：chat3类接口记入usedToken3，chat4记入usedToken4
+TIER_FIELDS = {"3": "usedToken3", "4": "usedToken4"}
+
+# 已写入的批次号保留的天数，只用于崩溃后补写时判断是否重复
+BATCH_RETENTION = 7 * 24 * 3600
+
+# 多进程部署时最多的日志文件数（即worker进程数上限）
+MAX_JOURNAL_SLOTS = 64
+
+
+def chat_tokens(usage: Dict[str, int], messages: Sequence[Dict[str, str]], reply: str) -> Tuple[int, int]:
+    """
+    一次对话的 (prompt_tokens, completion_tokens)：上游没有返回用量时按文本估算
+    """
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    if not prompt_tokens and not completion_tokens:
+        prompt_tokens = sum(estimate_message_tokens(m) for m in messages)
+        completion_tokens = estimate_tokens(reply)
+    return prompt_tokens, completion_tokens
+
+
+class UsageBuffer:
+    """
+    用量写后缓冲
+
+    - flush_interval: 定时写入的间隔（秒）
+    - flush_threshold: 累计的用量条数达到该值时提前写入
+    - debit_per_call: 每次对话扣减的余额，0为不扣减（免费试用期间）
+    - journal_path: 本地日志文件，未写入数据库的用量都在其中；多个worker进程时，
+      每个进程启动时锁定一个独立的文件（journal_path、journal_path-1 ……），进程退出后锁随之释放，
+      下一个启动的进程接手该文件并补写遗留的用量
+    - journal_fsync: 每条用量写入日志后是否fsync（更安全，但每次对话多一次磁盘同步）
+
+    只在事件循环线程中使用，不需要加锁
+    """
+
+    def __init__(self,
+                 store: UserStore,
+                 enabled: bool = True,
+                 flush_interval: float = 5.0,
+                 flush_threshold: int = 1000,
+                 debit_per_call: int = 0,
+                 journal_path: str = 'usage.journal',
+                 journal_fsync: bool = False):
+        self.store = store
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.debit_per_call = debit_per_call
+        self.journal_path = journal_path
+        self._journal_base = journal_path
+        self.journal_fsync = journal_fsync
+
+        # openid -> {字段名: 增量}，尚未开始写入的用量
+        self._pending: Dict[str, Dict[str, int]] = {}
+        # 已切分成批次、尚未确认写入数据库的用量：批次号 -> (日志路径, 用量, 是否已尝试写入过)
+        # 确认写入前读取时仍要叠加
+        self._batches: Dict[str, List[Any]] = {}
+        self._records = 0
+        self._journal = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._tables_ready = False
+        self._slot_lock = None
+
+        # 统计计数
+        self.recorded = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_errors = 0
+
+        store.set_pending_source(self.pending_delta)
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, store: UserStore, section: str = 'usage') -> "UsageBuffer":
+        """
+        从config.ini读取参数创建用量缓冲
+        """
+        return cls(
+            store,
+            enabled=config.getboolean(section, 'enabled', fallback=True),
+            flush_interval=config.getfloat(section, 'flush_interval', fallback=5.0),
+            flush_threshold=config.getint(section, 'flush_threshold', fallback=1000),
+            debit_per_call=config.getint(section, 'debit_per_call', fallback=0),
+            journal_path=config.get(section, 'journal_path', fallback='usage.journal'),
+            journal_fsync=config.getboolean(section, 'journal_fsync', fallback=False),
+        )
+
+    def record(self, openid: str, tier: str, prompt_tokens: int, completion_tokens: int):
+        """
+        记录一次对话的用量：先追加到日志，再累加到内存，不访问数据库
+
+        Args:
+            openid (str): 用户的openid
+            tier (str): 模型档位，"3" 或 "4"
+            prompt_tokens (int): 输入的token数
+            completion_tokens (int): 输出的token数
+        """
+        if not self.enabled:
+            return
+
+        delta = {TIER_FIELDS.get(tier, "usedToken3"): int(prompt_tokens) + int(completion_tokens)}
+        if self.debit_per_call:
+            delta["balanceAmount"] = -self.debit_per_call
+
+        self._append_journal({"openid": openid, "delta": delta})
+        pending = self._pending.setdefault(openid, {})
+        for field, amount in delta.items():
+            pending[field] = pending.get(field, 0) + amount
+
+        self.recorded += 1
+        self._records += 1
+        if self._records >= self.flush_threshold and self._wakeup is not None:
+            self._wakeup.set()
+
+    def record_chat(self,
+                    openid: str,
+                    tier: str,
+                    usage: Dict[str, int],
+                    messages: Sequence[Dict[str, str]],
+                    reply: str):
+        """
+        记录一次对话：使用生成该回复的上游调用返回的usage（命中缓存、与其他请求合并时也是如此）；
+        上游未返回usage时按文本估算
+        """
+        self.record(openid, tier, *chat_tokens(usage, messages, reply))
+
+    def record_chats(self,
+                     openid: str,
+                     tier: str,
+                     chats: Iterable[Tuple[Dict[str, int], Sequence[Dict[str, str]], str]]):
+        """
+        记录一批对话（批量接口）：每条 (usage, messages, reply) 按 record_chat 的方式计算，合计为一次用量
+        """
+        prompt_tokens = completion_tokens = 0
+        for usage, messages, reply in chats:
+            prompt, completion = chat_tokens(usage, messages, reply)
+            prompt_tokens += prompt
+            completion_tokens += completion
+        self.record(openid, tier, prompt_tokens, completion_tokens)
+
+    def pending_delta(self, openid: str) -> Optional[Dict[str, int]]:
+        """
+        该用户尚未写入数据库的增量（包括正在写入的批次）
+        """
+        parts = [batch[1][openid] for batch in self._batches.values() if openid in batch[1]]
+        pending = self._pending.get(openid)
+        if pending is not None:
+            parts.append(pending)
+        if len(parts) <= 1:
+            return parts[0] if parts else None
+        merged: Dict[str, int] = {}
+        for part in parts:
+            for field, amount in part.items():
+                merged[field] = merged.get(field, 0) + amount
+        return merged
+
+    def _append_journal(self, entry: Dict[str, Any]):
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        # 一条用量一行，写入后立即交给操作系统，进程崩溃不会丢失
+        self._journal.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._journal.flush()
+        if self.journal_fsync:
+            os.fsync(self._journal.fileno())
+
+    def _rotate_journal(self) -> Optional[str]:
+        """
+        把当前日志改名为带批次号的文件，之后的用量写入新日志；返回改名后的路径
+        """
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if not os.path.exists(self.journal_path):
+            return None
+        batch_path = f"{self.journal_path}.{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        os.replace(self.journal_path, batch_path)
+        return batch_path
+
+    async def _ensure_tables(self):
+        if self._tables_ready:
+            return
+        await self.store.open()
+        await self.store.pool.execute(
+            "CREATE TABLE IF NOT EXISTS usage_batches (\n"
+            "    batch_id VARCHAR(128) PRIMARY KEY,\n"
+            "    applied_at REAL\n"
+            ")"
+        )
+        self._tables_ready = True
+
+    async def _apply(self, batch_id: str, deltas: Dict[str, Dict[str, int]]):
+        """
+        在一个事务中写入一个批次的用量，并记录批次号
+        """
+        rows = [
+            (delta.get("usedToken3", 0), delta.get("usedToken4", 0), delta.get("balanceAmount", 0), openid)
+            for openid, delta in deltas.items()
+        ]
+        await self.store.pool.execute_batch([
+            ("UPDATE users SET usedToken3 = usedToken3 + ?, usedToken4 = usedToken4 + ?, "
+             "balanceAmount = balanceAmount + ? WHERE openid = ?", rows),
+            ("INSERT INTO usage_batches (batch_id, applied_at) VALUES (?, ?)", [(batch_id, time.time())]),
+        ])
+
+    async def flush(self):
+        """
+        把内存中的用量切分成一个批次，按顺序批量写入数据库；
+        写入失败的批次保留在内存和磁盘上，下次以同一个批次号重试
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if self._pending:
+                batch_path = self._rotate_journal()
+                batch_id = os.path.basename(batch_path) if batch_path else f"mem-{uuid.uuid4().hex}"
+                self._batches[batch_id] = [batch_path, self._pending, False]
+                self._pending = {}
+                self._records = 0
+
+            for batch_id in list(self._batches):
+                batch_path, deltas, attempted = self._batches[batch_id]
+                try:
+                    await self._ensure_tables()
+                    # 重试的批次可能已经提交成功（例如提交后连接断开），先按批次号确认
+                    if not attempted or not await self._is_applied(batch_id):
+                        self._batches[batch_id][2] = True
+                        await self._apply(batch_id, deltas)
+                except Exception as e:
+                    self.flush_errors += 1
+                    logging.exception("用量写入数据库失败，稍后重试: %s", e)
+                    return
+
+                del self._batches[batch_id]
+                self.flushes += 1
+                self.flushed_rows += len(deltas)
+                # 数据库已更新，缓存中的旧余额失效
+                self.store.invalidate(*deltas)
+                if batch_path:
+                    os.remove(batch_path)
+
+    async def _is_applied(self, batch_id: str) -> bool:
+        rows = await self.store.pool.fetch("SELECT batch_id FROM usage_batches WHERE batch_id = ?", (batch_id,))
+        return bool(rows)
+
+    async def recover(self):
+        """
+        启动时补写上次未写入数据库的日志（进程崩溃或写入失败时遗留）
+        """
+        if not self.enabled:
+            return
+        await self._ensure_tables()
+        if os.path.exists(self.journal_path):
+            self._rotate_journal()
+
+        for batch_path in sorted(glob.glob(glob.escape(self.journal_path) + ".*")):
+            if batch_path.endswith(".lock"):
+                continue
+            batch_id = os.path.basename(batch_path)
+            if not await self._is_applied(batch_id):
+                deltas = self._read_journal(batch_path)
+                if deltas:
+                    await self._apply(batch_id, deltas)
+                    self.store.invalidate(*deltas)
+                logging.warning("已补写上次未完成的用量日志: %s，%s 个用户", batch_path, len(deltas))
+            os.remove(batch_path)
+
+        await self.store.pool.execute("DELETE FROM usage_batches WHERE applied_at < ?", (time.time() - BATCH_RETENTION,))
+
+    @staticmethod
+    def _read_journal(path: str) -> Dict[str, Dict[str, int]]:
+        deltas: Dict[str, Dict[str, int]] = {}
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 崩溃时写了一半的最后一行
+                    continue
+                pending = deltas.setdefault(entry["openid"], {})
+                for field, amount in entry["delta"].items():
+                    pending[field] = pending.get(field, 0) + amount
+        return deltas
+
+    def _acquire_journal_slot(self):
+        """
+        锁定一个其他进程没有使用的日志文件：第一个进程使用 journal_path，之后的进程依次使用 journal_path-1、-2 ……
+        """
+        if fcntl is None or self._slot_lock is not None:
+            return
+        base = self._journal_base
+        for slot in range(MAX_JOURNAL_SLOTS):
+            path = base if slot == 0 else f"{base}-{slot}"
+            lock = open(f"{path}.lock", "a")
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                continue
+            self._slot_lock = lock
+            self.journal_path = path
+            return
+        raise RuntimeError(f"用量日志文件已全部被其他进程占用（最多 {MAX_JOURNAL_SLOTS} 个进程）")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.exception("用量写入异常: %s", e)
+
+    async def start(self):
+        """
+        补写遗留日志并启动定时写入任务（在服务启动时调用）
+        """
+        if not self.enabled or self._task is not None:
+            return
+        self._acquire_journal_slot()
+        await self.recover()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        停止定时写入并写入剩余用量（在服务关闭时调用）
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if self._slot_lock is not None:
+            self._slot_lock.close()
+            self._slot_lock = None
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        返回缓冲统计
+        """
+        return {
+            "pending_users": len(self._pending),
+            "unflushed_batches": len(self._batches),
+            "pending_records": self._records,
+            "recorded": self.recorded,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "flush_errors": self.flush_errors,
+        }
+
+
+# 进程内共享的用量缓冲
+usage_buffer = UsageBuffer.from_config(config, user_store)
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+用户存储 -- 用户信息的持久化（MySQL / SQLite）和余额检查的读穿透缓存
+@Version: 1.1
+@Author: lordli
+@Date: 2025-06-30
+@Description: 取代各聊天接口中复制的模拟 get_user_info；数据库访问经过固定大小的连接池，
+              在专用线程池中执行，不阻塞事件循环。每个聊天请求都要检查余额，
+              因此用户信息在内存中缓存几秒，写入时立即失效
+@Update:
+        1.0 用户表、连接池和余额检查的读穿透缓存
+        1.1 批量写入（单个事务），读取时叠加尚未写入数据库的增量（用量写后缓冲）
+"""
+
+import asyncio
+import queue
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from common_config import config
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from common_single_flight import SingleFlight
+
+# 用户表的字段：(字段名, 列类型, 默认值)，字段名与接口返回的字段保持一致
+USER_COLUMNS: Sequence[Tuple[str, str, Any]] = (
+    ("nickName", "VARCHAR(64)", "User"),
+    ("mobileNo", "VARCHAR(32)", None),
+    ("inviter", "VARCHAR(64)", "Lord"),
+    ("notice", "INTEGER", 0),
+    ("vip", "INTEGER", 1),
+    ("balanceAmount", "INTEGER", 99),
+    ("topupAmount", "INTEGER", 99),
+    ("freeTry", "INTEGER", 0),
+    ("usedToken3", "INTEGER", 0),
+    ("usedToken4", "INTEGER", 0),
+    ("settings", "VARCHAR(16)", "E"),
+    ("sysContent3", "VARCHAR(1024)", "你是一个得力的助手"),
+    ("sysContent4", "VARCHAR(1024)", "你是一个得力的助手"),
+    ("temperature3", "REAL", 1),
+    ("temperature4", "REAL", 1),
+    ("brand", "VARCHAR(64)", "Unknown"),
+    ("model", "VARCHAR(64)", "Unknown"),
+    ("wxVer", "VARCHAR(32)", "Unknown"),
+    ("wxLang", "VARCHAR(16)", "zh"),
+    ("osVer", "VARCHAR(64)", "Unknown"),
+    ("platform", "VARCHAR(32)", "unknown"),
+    ("wxFontSize", "VARCHAR(16)", "无"),
+    ("deviceOrientation", "VARCHAR(16)", "portrait"),
+    ("batteryLevel", "VARCHAR(16)", "无"),
+    ("networkType", "VARCHAR(16)", "wifi"),
+    ("createDate", "VARCHAR(32)", ""),
+)
+
+# addUser 时随设备信息更新的字段
+DEVICE_FIELDS = ("brand", "model", "wxVer", "wxLang", "osVer", "platform",
+                 "wxFontSize", "deviceOrientation", "batteryLevel", "networkType")
+
+# 用户不存在时返回的信息
+MISSING_USER = {"exists": False, "vip": 0, "balance": 0, "freeTry": 0}
+
+
+class ConnectionPool:
+    """
+    固定大小的数据库连接池
+
+    DB-API的驱动（sqlite3、PyMySQL）都是阻塞的：每条语句在专用线程池中执行，
+    线程数与连接数相同，事件循环只 await 结果
+    """
+
+    def __init__(self, connect: Callable[[], Any], size: int = 5, placeholder: str = "?"):
+        self._connect = connect
+        self.size = size
+        self.placeholder = placeholder
+        self._idle: "queue.Queue" = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="user-store")
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            # 线程数等于连接数，空闲连接不够时新建，总数不会超过 size
+            return self._connect()
+
+    def _run(self, sql: str, params: Sequence[Any], fetch: bool) -> Any:
+        if self.placeholder != "?":
+            sql = sql.replace("?", self.placeholder)
+        conn = self._acquire()
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql, tuple(params))
+                if fetch:
+                    columns = [d[0] for d in cursor.description]
+                    result = [dict(zip(columns, row)) for row in cursor.fetchall()]
+                else:
+                    result = cursor.rowcount
+                conn.commit()
+            finally:
+                cursor.close()
+        except Exception:
+            # 出错的连接可能已不可用，直接丢弃，下次按需新建
+            try:
+                conn.close()
+            except Exception:
+                pass
+            raise
+        self._idle.put(conn)
+        return result
+
+    def _run_batch(self, statements: Sequence[Tuple[str, Sequence[Sequence[Any]]]]) -> None:
+        conn = self._acquire()
+        try:
+            cursor = conn.cursor()
+            try:
+                for sql, rows in statements:
+                    if self.placeholder != "?":
+                        sql = sql.replace("?", self.placeholder)
+                    cursor.executemany(sql, [tuple(row) for row in rows])
+                conn.commit()
+            finally:
+                cursor.close()
+        except Exception:
+            try:
+                conn.rollback()
+                conn.close()
+            except Exception:
+                pass
+            raise
+        self._idle.put(conn)
+
+    async def execute_batch(self, statements: Sequence[Tuple[str, Sequence[Sequence[Any]]]]):
+        """
+        在同一个事务中批量执行多条写语句：[(sql, [参数, 参数, ...]), ...]，全部成功才提交
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._run_batch, statements)
+
+    async def fetch(self, sql: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        """
+        执行查询，返回行字典的列表
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._run, sql, params, True)
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        """
+        执行写语句并提交，返回影响的行数
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._run, sql, params, False)
+
+    def close(self):
+        """
+        关闭全部连接和线程池
+        """
+        self._executor.shutdown(wait=True)
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def sqlite_connector(path: str) -> Callable[[], Any]:
+    """
+    SQLite连接：WAL模式下读写互不阻塞，适合本地开发和单机部署
+    """
+    def connect():
+        conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    return connect
+
+
+def mysql_connector(config: ConfigParser, section: str) -> Callable[[], Any]:
+    """
+    MySQL连接（PyMySQL），只在配置为mysql时才需要安装
+    """
+    try:
+        import pymysql
+    except ImportError:
+        raise ImportError("user_store 配置为 mysql，需要先安装 PyMySQL：pip install PyMySQL")
+
+    def connect():
+        return pymysql.connect(
+            host=config.get(section, 'mysql_host', fallback='127.0.0.1'),
+            port=config.getint(section, 'mysql_port', fallback=3306),
+            user=config.get(section, 'mysql_user', fallback='root'),
+            password=config.get(section, 'mysql_password', fallback=''),
+            database=config.get(section, 'mysql_database', fallback='vassistant'),
+            charset='utf8mb4',
+            connect_timeout=config.getint(section, 'mysql_connect_timeout', fallback=5),
+        )
+    return connect
+
+
+class UserStore:
+    """
+    用户存储
+
+    - get_user_info: 余额检查用的精简信息，先查内存缓存（cache_ttl 秒内有效），
+      未命中时读库，同一用户的并发未命中只读一次
+    - add_user / invalidate: 写入后立即让该用户的缓存失效
+    - set_pending_source: 登记尚未写入数据库的增量（如用量写后缓冲），读取时叠加在数据库的值上
+
+    缓存只在事件循环线程中使用，不需要加锁；多进程部署时，其他进程的缓存最多滞后 cache_ttl 秒
+    """
+
+    def __init__(self,
+                 pool: ConnectionPool,
+                 dialect: str = "sqlite",
+                 cache_ttl: float = 10.0,
+                 cache_max_entries: int = 10000):
+        self.pool = pool
+        self.dialect = dialect
+        self.cache_ttl = cache_ttl
+        self.cache_max_entries = cache_max_entries
+
+        # openid -> (过期时间, 用户信息)
+        self._cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._loads = SingleFlight()
+        # 写入计数：读库期间发生过写入，则本次读到的结果不放入缓存，避免旧数据覆盖失效
+        self._writes = 0
+        self._opened = False
+        self._open_lock: Optional[asyncio.Lock] = None
+        # 返回 {字段名: 增量} 的函数，没有待写入的增量时返回None
+        self._pending_source: Optional[Callable[[str], Optional[Dict[str, float]]]] = None
+
+        # 统计计数
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, section: str = 'user_store') -> "UserStore":
+        """
+        从config.ini读取参数创建用户存储，backend 为 sqlite（默认）或 mysql
+        """
+        backend = config.get(section, 'backend', fallback='sqlite').strip().lower()
+        pool_size = config.getint(section, 'pool_size', fallback=5)
+        if backend == 'mysql':
+            pool = ConnectionPool(mysql_connector(config, section), size=pool_size, placeholder="%s")
+        else:
+            path = config.get(section, 'sqlite_path', fallback='users.db')
+            pool = ConnectionPool(sqlite_connector(path), size=pool_size)
+        return cls(
+            pool,
+            dialect=backend if backend == 'mysql' else 'sqlite',
+            cache_ttl=config.getfloat(section, 'cache_ttl', fallback=10.0),
+            cache_max_entries=config.getint(section, 'cache_max_entries', fallback=10000),
+        )
+
+    async def open(self):
+        """
+        建表（不存在时），首次访问时自动调用，也可以在服务启动时提前调用
+        """
+        if self._opened:
+            return
+        if self._open_lock is None:
+            self._open_lock = asyncio.Lock()
+        async with self._open_lock:
+            if self._opened:
+                return
+            columns = ",\n    ".join(f"{name} {column_type}" for name, column_type, _ in USER_COLUMNS)
+            await self.pool.execute(
+                f"CREATE TABLE IF NOT EXISTS users (\n    openid VARCHAR(64) PRIMARY KEY,\n    {columns}\n)"
+            )
+            self._opened = True
+
+    def set_pending_source(self, source: Callable[[str], Optional[Dict[str, float]]]):
+        """
+        登记尚未写入数据库的增量来源，保证进程内读到的用户信息是最新的
+        """
+        self._pending_source = source
+
+    def _pending(self, openid: str) -> Optional[Dict[str, float]]:
+        return self._pending_source(openid) if self._pending_source is not None else None
+
+    async def get_user(self, openid: str) -> Optional[Dict[str, Any]]:
+        """
+        读取用户的完整信息（不经过缓存，叠加尚未写入的增量），用户不存在时返回None
+        """
+        await self.open()
+        rows = await self.pool.fetch("SELECT * FROM users WHERE openid = ?", (openid,))
+        if not rows:
+            return None
+        user = rows[0]
+        delta = self._pending(openid)
+        if delta:
+            for field, amount in delta.items():
+                user[field] = (user.get(field) or 0) + amount
+        return user
+
+    async def get_user_info(self, openid: str) -> Dict[str, Any]:
+        """
+        获取余额检查用的用户信息：exists / vip / balance / freeTry
+        """
+        entry = self._cache.get(openid)
+        if entry is not None and entry[0] > time.monotonic():
+            self._cache.move_to_end(openid)
+            self.hits += 1
+            info = entry[1]
+        else:
+            self.misses += 1
+            info = await self._loads.do(openid, lambda: self._load_info(openid))
+
+        # 缓存中是数据库的值，余额再扣除尚未写入的部分
+        delta = self._pending(openid)
+        if delta and info["exists"] and delta.get("balanceAmount"):
+            info = dict(info, balance=info["balance"] + delta["balanceAmount"])
+        return info
+
+    async def _load_info(self, openid: str) -> Dict[str, Any]:
+        writes = self._writes
+        await self.open()
+        rows = await self.pool.fetch("SELECT vip, balanceAmount, freeTry FROM users WHERE openid = ?", (openid,))
+        user = rows[0] if rows else None
+        if user is None:
+            info = MISSING_USER
+        else:
+            info = {
+                "exists": True,
+                "vip": user["vip"] or 0,
+                "balance": user["balanceAmount"] or 0,
+                "freeTry": user["freeTry"] or 0,
+            }
+
+        if writes == self._writes:
+            self._cache[openid] = (time.monotonic() + self.cache_ttl, info)
+            self._cache.move_to_end(openid)
+            while len(self._cache) > self.cache_max_entries:
+                self._cache.popitem(last=False)
+        return info
+
+    def invalidate(self, *openids: str):
+        """
+        让这些用户的缓存失效（任何写入之后调用）
+        """
+        self._writes += 1
+        for openid in openids:
+            self._cache.pop(openid, None)
+
+    async def add_user(self, openid: str, device: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        新用户按默认值创建，老用户只更新设备信息；返回用户的完整信息
+        """
+        await self.open()
+        device = {k: str(v) for k, v in device.items() if k in DEVICE_FIELDS and v not in (None, "")}
+
+        values = {name: default for name, _, default in USER_COLUMNS}
+        values.update(device)
+        values["createDate"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        names = ["openid"] + list(values)
+        ignore = "INSERT IGNORE" if self.dialect == "mysql" else "INSERT OR IGNORE"
+        try:
+            inserted = await self.pool.execute(
+                f"{ignore} INTO users ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)})",
+                [openid] + list(values.values())
+            )
+            if not inserted and device:
+                await self.pool.execute(
+                    f"UPDATE users SET {', '.join(f'{k} = ?' for k in device)} WHERE openid = ?",
+                    list(device.values()) + [openid]
+                )
+        finally:
+            self.invalidate(openid)
+
+        return await self.get_user(openid)
+
+    async def close(self):
+        """
+        关闭连接池（在服务关闭时调用）
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.pool.close)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        返回缓存统计
+        """
+        return {
+            "backend": self.dialect,
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# 进程内共享的用户存储
+user_store = UserStore.from_config(config)
+
+
+async def get_user_info(openid: str) -> Dict[str, Any]:
+    """
+    获取用户信息（带缓存），各聊天接口共用
+    """
+    return await user_store.get_user_info(openid)
+
+
+async def check_user_balance(openid: str, depleted_status: str = "runOut") -> Tuple[bool, str]:
+    """
+    检查用户余额
+
+    Args:
+        openid (str): 用户的openid
+        depleted_status (str): 余额和免费次数都用完时返回的状态（各接口沿用自己的约定：runOut / noMoney）
+
+    Returns:
+        (是否可以继续, 状态)：ok / noUser / depleted_status
+    """
+    user_info = await get_user_info(openid)
+    if not user_info["exists"]:
+        return False, "noUser"
+
+    if user_info["balance"] <= 0 and user_info["freeTry"] <= 0:
+        return False, depleted_status
+
+    return True, "ok"
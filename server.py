@@ -7,7 +7,7 @@
   @Date: 2025-6-16
   @Python version: 3.12.8
   @Libary:
-      pip install configparser fastapi uvicorn cryptography PyMySQL
+      pip install configparser fastapi uvicorn cryptography PyMySQL httpx
 
   生成requirements.txt， 在python工程目录中运行(xx个库)：
   pip freeze > requirements.txt
@@ -15,18 +15,42 @@
   @Update:
         1.0 2023-3-21 初始版本
         2.0 2025-6-16 全部重写，改成国内的免费AI接口
+        2.1 AI接口改为进程级共享的异步客户端，服务关闭时释放连接池
+        2.2 启动时恢复、关闭时保存AI响应缓存
+        2.3 服务关闭时释放微信登录接口的连接池
+        2.4 接口请求指标中间件和 /metrics 接口
+        2.5 启动时初始化用户存储（建表），关闭时释放数据库连接池
+        2.6 启动时补写遗留的用量日志并开始定时批量写入，关闭时写入剩余用量
+        2.7 缩短冷启动：config.ini只解析一次，uvicorn和zhipuai延迟导入，启动时输出各阶段耗时
+        2.8 可配置worker进程数，服务关闭时关闭会话存储
+        2.9 启动时从快照恢复会话并定时增量快照，关闭时写入最后一次快照
+        3.0 服务关闭时取消未完成的会话摘要
+        3.1 请求耗时分段中间件：响应头返回请求ID，慢请求输出各阶段耗时
+        3.2 日志改由后台线程经队列写出，结构化的访问日志（高并发时抽样）取代uvicorn的访问日志
+        3.3 微信接口的连接池在关闭时才导入，api_wxAuth的导入耗时计入它自己的启动阶段
 
   @Launch: python launch.py    # 或者用下面的方式也可以
            uvicorn launch:app --reload --host 0.0.0.0 --port 8000
 """
-import uvicorn
-from configparser import ConfigParser
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
+# 最先导入，从这里开始计算启动耗时
+from common_startup import startup_report
+with startup_report.phase("import fastapi"):
+    from fastapi import FastAPI
+    from fastapi.middleware.cors import CORSMiddleware
 import logging
 from contextlib import asynccontextmanager
-
-LOG_FMT = "%(asctime)s - %(levelname)s - %(message)s"
+from common_config import config
+with startup_report.phase("import common"):
+    from common_ai_chat import close_async_client
+    from common_response_cache import response_cache
+    from common_metrics import MetricsMiddleware
+    from common_tracing import TracingMiddleware
+    from common_user_store import user_store
+    from common_usage_buffer import usage_buffer
+    from common_session_store import session_store
+    from common_session_snapshot import session_snapshot
+    from common_session_summary import session_summarizer
+    from common_logging import LOG_FMT, access_log, log_shipper
 
 # 将access日志写入uvicorn的日志文件（带时间戳的日志）
 def config_access_log_to_show_time():
@@ -38,11 +62,42 @@ def config_access_log_to_show_time():
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    config_access_log_to_show_time()
+    # 日志经队列由后台线程写出（在uvicorn配置完它的日志之后接管），关闭时保持原来的同步输出
+    if log_shipper.enabled:
+        log_shipper.start()
+    else:
+        config_access_log_to_show_time()
+    # 恢复落盘的AI响应缓存
+    with startup_report.phase("response_cache.load"):
+        response_cache.load()
+    # 初始化用户存储（不存在时建表）
+    with startup_report.phase("user_store.open"):
+        await user_store.open()
+    # 补写上次遗留的用量日志，启动定时批量写入
+    with startup_report.phase("usage_buffer.start"):
+        await usage_buffer.start()
+    # 从快照恢复最近的会话（其余按需加载），启动定时增量快照
+    with startup_report.phase("session_snapshot.start"):
+        await session_snapshot.start()
+    # 输出启动各阶段的耗时
+    startup_report.mark_ready()
     yield
-
-config = ConfigParser()
-config.read(r'config.ini', encoding='utf-8')
+    # 取消未完成的会话摘要（下次对话时会重新触发），之后会话不再变化
+    await session_summarizer.stop()
+    # 写入最后一次会话快照，重启后对话上下文不丢失
+    await session_snapshot.stop()
+    # 写入剩余的用量（在关闭数据库连接池之前）
+    await usage_buffer.stop()
+    # 保存AI响应缓存，重启后继续有效
+    response_cache.save()
+    # 关闭共享的AI客户端和微信接口的连接池（api_wxAuth在注册路由时已导入）
+    from api_wxAuth import close_http_client as close_wx_http_client
+    await close_async_client()
+    await close_wx_http_client()
+    await user_store.close()
+    session_store.close()
+    # 最后写出队列中剩余的日志
+    log_shipper.stop()
 
 app = FastAPI(
     title=config.get('fastapi', 'title'),  # 从同路径的config.ini中，读取配置信息，以下雷同
@@ -55,14 +110,23 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+tracing_options = TracingMiddleware.options_from_config(config)
+
 # 添加 CORS 中间件，用于在生产环境中，更严苛的控制风险
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # 允许的来源，这里设置为允许任意来源，实际生产环境中应更严格配置
     allow_methods=["*"],  # 允许的方法，包括 "OPTIONS"
     allow_headers=["*"],  # 允许的请求头
+    expose_headers=[tracing_options["header"]],  # 允许前端读取请求ID
 )
 
+# 按路由统计请求数、耗时和在途数，供 /metrics 导出
+app.add_middleware(MetricsMiddleware)
+
+# 最外层：为每个请求记录各阶段耗时，响应头返回请求ID，慢请求输出分段日志，请求结束时记录访问日志
+app.add_middleware(TracingMiddleware, access_log=access_log if access_log.enabled else None, **tracing_options)
+
 # -----------------------------------------------------------
 # 【 -- v2版本 -- 第2版百变助理 -- 】
 # -----------------------------------------------------------
@@ -71,7 +135,8 @@ app.add_middleware(
 # -----------------------------------------------------------
 # 接口：/getTips/  -- 请求方式PUT
 # 【系统】获取欢迎页面提示信息
-from api_getTips import router as TipsRouter
+with startup_report.phase("import api_getTips"):
+    from api_getTips import router as TipsRouter
 app.include_router(TipsRouter)
 
 # -----------------------------------------------------------
@@ -79,7 +144,8 @@ app.include_router(TipsRouter)
 # -----------------------------------------------------------
 # 接口：/v0/auth/login/  -- 请求方式POST
 # 【系统】微信小程序登录认证
-from api_wxAuth import router as WxAuthRouter
+with startup_report.phase("import api_wxAuth"):
+    from api_wxAuth import router as WxAuthRouter
 app.include_router(WxAuthRouter)
 
 # -----------------------------------------------------------
@@ -87,9 +153,12 @@ app.include_router(WxAuthRouter)
 # -----------------------------------------------------------
 # 接口：/addUser/  -- 请求方式PUT
 # 【系统】添加用户信息
-from api_addUser import router as AddUserRouter
-from api_getFunctions import router as GetFunctionsRouter
-from api_checkUser import router as CheckUserRouter
+with startup_report.phase("import api_addUser"):
+    from api_addUser import router as AddUserRouter
+with startup_report.phase("import api_getFunctions"):
+    from api_getFunctions import router as GetFunctionsRouter
+with startup_report.phase("import api_checkUser"):
+    from api_checkUser import router as CheckUserRouter
 app.include_router(AddUserRouter)
 app.include_router(GetFunctionsRouter)
 app.include_router(CheckUserRouter)
@@ -99,24 +168,37 @@ app.include_router(CheckUserRouter)
 # -----------------------------------------------------------
 # 接口：/chatMultiple3/  -- 请求方式PUT
 # 【系统】多轮对话聊天接口
-from api_chatMultiple3 import router as ChatMultiple3Router
+with startup_report.phase("import api_chatMultiple3"):
+    from api_chatMultiple3 import router as ChatMultiple3Router
 app.include_router(ChatMultiple3Router)
 
 # 接口：/chatMultiple4/  -- 请求方式PUT
 # 【系统】多轮对话聊天接口4
-from api_chatMultiple4 import router as ChatMultiple4Router
+with startup_report.phase("import api_chatMultiple4"):
+    from api_chatMultiple4 import router as ChatMultiple4Router
 app.include_router(ChatMultiple4Router)
 
-# 接口：/chatSingle3/  -- 请求方式PUT
-# 【系统】单轮对话聊天接口
-from api_chatSingle3 import router as ChatSingle3Router
+# 接口：/chatSingle3/ 和 /chatSingle3Batch/  -- 请求方式PUT
+# 【系统】单轮对话聊天接口和批量接口
+with startup_report.phase("import api_chatSingle3"):
+    from api_chatSingle3 import router as ChatSingle3Router
 app.include_router(ChatSingle3Router)
 
 # 接口：/chatLegal/ 和 /getSample/  -- 请求方式PUT
 # 【系统】法律咨询聊天接口和示例获取接口
-from api_chatLaw import router as ChatLawRouter
+with startup_report.phase("import api_chatLaw"):
+    from api_chatLaw import router as ChatLawRouter
 app.include_router(ChatLawRouter)
 
+# -----------------------------------------------------------
+# 【 -- 运维模块 -- 】
+# -----------------------------------------------------------
+# 接口：/metrics  -- 请求方式GET
+# 【系统】Prometheus格式的运行指标
+with startup_report.phase("import api_metrics"):
+    from api_metrics import router as MetricsRouter
+app.include_router(MetricsRouter)
+
 # -----------------------------------------------------------
 
 @app.get("/")
@@ -124,4 +206,13 @@ async def read_root():
     return {'Method': 'API Version: '+ app.version +'. Access Denied, Pls contact Lord. ：）'}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # 只有直接运行本文件时才需要uvicorn，用uvicorn命令启动时不重复导入
+    import uvicorn
+    workers = config.getint('fastapi', 'workers', fallback=1)
+    if workers > 1:
+        if config.get('session', 'backend', fallback='memory').lower() == 'memory':
+            logging.warning("多个worker进程使用进程内的会话存储，多轮对话会丢失历史，请将[session]的backend配置为sqlite")
+        # 多进程时uvicorn需要以导入路径的方式加载app
+        uvicorn.run("server:app", host="0.0.0.0", port=8000, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
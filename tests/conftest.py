@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""
+测试公共设置：服务的模块都在仓库根目录，直接导入；
+config.ini 不存在时各模块使用代码中的默认值
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+准入控制：按优先级和到达顺序排队、队列已满和排队超时的拒绝、排队中取消，名额不泄漏
+"""
+
+import asyncio
+
+import pytest
+
+from common_admission import AdmissionController, AdmissionRejected
+
+
+def assert_idle(admission: AdmissionController):
+    assert admission.inflight == 0
+    assert admission.queue_depth == 0
+
+
+def test_priority_then_arrival_order():
+    async def main():
+        admission = AdmissionController(max_inflight=1)
+        await admission.acquire()
+        order = []
+
+        async def waiter(name, priority):
+            await admission.acquire(priority)
+            order.append(name)
+
+        tasks = []
+        for name, priority in (("low1", 0), ("vip", 2), ("low2", 0), ("mid", 1)):
+            tasks.append(asyncio.create_task(waiter(name, priority)))
+            await asyncio.sleep(0)
+        assert admission.queue_depth == 4
+
+        for _ in range(5):
+            admission.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return order, admission
+
+    order, admission = asyncio.run(main())
+    assert order == ["vip", "mid", "low1", "low2"]
+    assert_idle(admission)
+
+
+def test_queue_full_is_rejected():
+    async def main():
+        admission = AdmissionController(max_inflight=1, max_queue=1)
+        await admission.acquire()
+        queued = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as rejected:
+            await admission.acquire()
+        assert rejected.value.reason == "queue_full"
+        admission.release()
+        await queued
+        admission.release()
+        return admission
+
+    admission = asyncio.run(main())
+    assert admission.rejected_full == 1
+    assert_idle(admission)
+
+
+def test_timeout_gives_up_its_place():
+    async def main():
+        admission = AdmissionController(max_inflight=1)
+        await admission.acquire()
+        with pytest.raises(AdmissionRejected) as rejected:
+            await admission.acquire(timeout=0.02)
+        assert rejected.value.reason == "timeout"
+        assert admission.queue_depth == 0
+        # 超时的请求不会再分到名额
+        admission.release()
+        return admission
+
+    admission = asyncio.run(main())
+    assert admission.rejected_timeout == 1
+    assert_idle(admission)
+
+
+def test_cancel_while_queued_does_not_leak():
+    async def main():
+        admission = AdmissionController(max_inflight=1)
+        await admission.acquire()
+        queued = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        assert admission.queue_depth == 0
+        admission.release()
+        return admission
+
+    assert_idle(asyncio.run(main()))
+
+
+def test_cancel_after_slot_handed_over_returns_it():
+    async def main():
+        admission = AdmissionController(max_inflight=1)
+        await admission.acquire()
+        queued = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        # 名额已转交，但排队的请求恢复执行之前被取消
+        admission.release()
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        return admission
+
+    assert_idle(asyncio.run(main()))
+
+
+def test_slot_releases_on_error_and_try_acquire_accounting():
+    async def main():
+        admission = AdmissionController(max_inflight=2)
+        with pytest.raises(RuntimeError):
+            async with admission.slot():
+                assert admission.inflight == 1
+                raise RuntimeError("upstream")
+        assert admission.try_acquire()
+        assert admission.try_acquire()
+        assert not admission.try_acquire()
+        admission.release()
+        admission.release()
+        return admission
+
+    admission = asyncio.run(main())
+    assert admission.admitted == 3
+    assert_idle(admission)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+单轮对话批量接口：按输入顺序返回、NDJSON按完成先后返回、部分失败时只对成功的条目计费，
+合并和命中缓存的条目按上游调用的实际用量计费（上游为桩函数）
+"""
+
+import asyncio
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import api_chatSingle3
+from common_response_cache import ResponseCache
+from common_single_flight import SingleFlight
+from common_usage_buffer import chat_tokens
+
+
+class UsageRecorder:
+    """
+    代替用量缓冲，记录每次计费的 (prompt_tokens, completion_tokens) 列表
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def record_chats(self, openid, tier, chats):
+        self.batches.append((openid, tier, [chat_tokens(*chat) for chat in chats]))
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    calls = []
+
+    async def fake_chat(messages, model, temperature, max_tokens, priority):
+        text = messages[-1]["content"]
+        calls.append(text)
+        # 输入越长越晚返回，NDJSON按完成先后输出
+        await asyncio.sleep(0.01 * len(text))
+        if text.startswith("bad"):
+            raise RuntimeError("upstream failed")
+        return text.upper(), {"prompt_tokens": 10, "completion_tokens": len(text)}
+
+    async def balance_ok(openid, depleted_status="runOut"):
+        return True, "OK"
+
+    async def user_info(openid):
+        return {"vip": 0}
+
+    monkeypatch.setattr(api_chatSingle3, "async_chat_with_usage", fake_chat)
+    monkeypatch.setattr(api_chatSingle3, "check_user_balance", balance_ok)
+    monkeypatch.setattr(api_chatSingle3, "get_user_info", user_info)
+    monkeypatch.setattr(api_chatSingle3, "response_cache", ResponseCache(enabled_functions=["translate2En"]))
+    monkeypatch.setattr(api_chatSingle3, "single_flight", SingleFlight())
+    return calls
+
+
+@pytest.fixture
+def usage(monkeypatch):
+    recorder = UsageRecorder()
+    monkeypatch.setattr(api_chatSingle3, "usage_buffer", recorder)
+    return recorder
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(api_chatSingle3.router)
+    with TestClient(app) as client:
+        yield client
+
+
+def batch(client, inputs, stream=False, function="translate2En"):
+    return client.put("/chatSingle3Batch/", json={
+        "function": function, "openid": "o1", "userInputs": inputs, "stream": stream})
+
+
+def test_results_in_input_order_and_partial_failure_charges_successes(client, upstream, usage):
+    result = batch(client, ["ccc", "a", "bad", ""]).json()["chatResult"]
+    assert result["status"] == "OK"
+    assert [r["status"] for r in result["results"]] == ["OK", "OK", "error", "noSessionWord"]
+    assert [r.get("GPTmsg") for r in result["results"][:2]] == ["CCC", "A"]
+    # 整批一次计费，只包含成功的条目（按完成先后）
+    assert len(usage.batches) == 1
+    assert sorted(usage.batches[0][2]) == [(10, 1), (10, 3)]
+
+
+def test_ndjson_streams_in_completion_order(client, upstream, usage):
+    response = batch(client, ["cccc", "a", "bb"], stream=True)
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["index"] for line in lines[:3]] == [1, 2, 0]
+    assert lines[-1]["chatResult"] == {"status": "OK", "count": 3, "sessionId": lines[-1]["chatResult"]["sessionId"]}
+    assert len(usage.batches) == 1
+    assert sorted(usage.batches[0][2]) == [(10, 1), (10, 2), (10, 4)]
+
+
+def test_folded_and_cached_items_are_charged_real_usage(client, upstream, usage):
+    batch(client, ["xx", "xx", "y"])
+    # 相同的输入只调用一次上游，两条都按这次调用的实际用量计费
+    assert sorted(upstream) == ["xx", "y"]
+    assert sorted(usage.batches[0][2]) == [(10, 1), (10, 2), (10, 2)]
+
+    batch(client, ["xx"])
+    # 命中缓存：不调用上游，按缓存中保存的用量计费
+    assert len(upstream) == 2
+    assert usage.batches[1][2] == [(10, 2)]
+
+
+def test_too_many_items_is_rejected(client, upstream, usage):
+    result = batch(client, ["a"] * (api_chatSingle3.BATCH_MAX_ITEMS + 1)).json()["chatResult"]
+    assert result["status"] == "tooMany"
+    assert upstream == []
+    assert usage.batches == []
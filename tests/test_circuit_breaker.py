@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+熔断器：请求本身无效的错误不计入错误率，也不会让半开的熔断器恢复
+"""
+
+import asyncio
+
+import httpx
+import pytest
+
+from common_ai_chat import AICircuitOpenError, AIChatError, AsyncAIClient
+from common_circuit_breaker import CircuitBreaker, STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN
+
+
+def half_open_breaker() -> CircuitBreaker:
+    breaker = CircuitBreaker(min_requests=2, error_rate_threshold=0.5, open_duration=0, half_open_max_calls=1)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == STATE_OPEN
+    assert breaker.allow()
+    assert breaker.state == STATE_HALF_OPEN
+    return breaker
+
+
+def test_neutral_result_releases_probe_without_closing():
+    breaker = half_open_breaker()
+    # 探测名额已用完
+    assert not breaker.allow()
+    breaker.record_neutral()
+    assert breaker.state == STATE_HALF_OPEN
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == STATE_CLOSED
+
+
+def test_neutral_results_do_not_dilute_error_rate():
+    breaker = CircuitBreaker(min_requests=4, error_rate_threshold=0.5)
+    for _ in range(10):
+        breaker.allow()
+        breaker.record_neutral()
+    for _ in range(4):
+        breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == STATE_OPEN
+
+
+def client_with(breaker: CircuitBreaker, status_code: int) -> AsyncAIClient:
+    client = AsyncAIClient(api_key="test", base_url="http://upstream", max_retries=0, breaker=breaker)
+    client.client = httpx.AsyncClient(
+        base_url="http://upstream",
+        transport=httpx.MockTransport(lambda request: httpx.Response(status_code, json={"error": "bad"})),
+    )
+    return client
+
+
+def test_invalid_request_during_probe_keeps_breaker_half_open():
+    breaker = half_open_breaker()
+    breaker.record_neutral()
+    client = client_with(breaker, 400)
+
+    with pytest.raises(AIChatError) as raised:
+        asyncio.run(client.chat([{"role": "user", "content": "hi"}]))
+    assert not raised.value.retryable
+    assert breaker.state == STATE_HALF_OPEN
+
+    # 上游故障时探测失败，重新熔断
+    breaker.open_duration = 60
+    client = client_with(breaker, 503)
+    with pytest.raises(AIChatError):
+        asyncio.run(client.chat([{"role": "user", "content": "hi"}]))
+    assert breaker.state == STATE_OPEN
+    with pytest.raises(AICircuitOpenError):
+        asyncio.run(client.chat([{"role": "user", "content": "hi"}]))
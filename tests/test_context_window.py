@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+上下文裁剪：按token预算从新到旧选取整轮对话，系统提示和摘要、当前输入始终保留
+"""
+
+from common_context_window import (MESSAGE_OVERHEAD_TOKENS, estimate_message_tokens, estimate_tokens,
+                                   select_context)
+from common_session_store import Message
+
+
+def user(text):
+    return {"role": "user", "content": text}
+
+
+def assistant(text):
+    return {"role": "assistant", "content": text}
+
+
+def cost(*messages):
+    return sum(estimate_message_tokens(m) for m in messages)
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("你好") == 2
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_message_tokens(user("你好")) == MESSAGE_OVERHEAD_TOKENS + 2
+
+
+def test_everything_fits():
+    messages = [{"role": "system", "content": "提示"}, user("一"), assistant("二"), user("三")]
+    selected, dropped = select_context(messages, max_tokens=100, prompt_budget=1000)
+    assert selected == messages
+    assert dropped == 0
+
+
+def test_keeps_newest_whole_turns_within_budget():
+    system = {"role": "system", "content": "提示"}
+    old = [user("很早的问题"), assistant("很早的回答")]
+    recent = [user("最近的问题"), assistant("最近的回答")]
+    current = user("现在")
+    budget = cost(system, *recent, current)
+    selected, dropped = select_context([system] + old + recent + [current], max_tokens=100, prompt_budget=budget)
+    assert selected == [system] + recent + [current]
+    assert dropped == cost(*old)
+
+
+def test_stops_at_first_turn_that_does_not_fit():
+    system = {"role": "system", "content": "提示"}
+    small = [user("小"), assistant("小")]
+    large = [user("很长" * 50), assistant("很长" * 50)]
+    current = user("现在")
+    budget = cost(system, *small, *small, current)
+    # 放不下中间较大的一轮时，即使更早的一轮放得下也不再选取，保证上下文连续
+    selected, _ = select_context([system] + small + large + [current], max_tokens=100, prompt_budget=budget)
+    assert selected == [system, current]
+
+
+def test_pinned_prompt_summary_and_current_input_survive_tiny_budget():
+    messages = [Message("system", "提示"), Message("system", "摘要"), Message("user", "旧"),
+                Message("assistant", "旧"), Message("user", "现在")]
+    selected, dropped = select_context(messages, max_tokens=100, prompt_budget=1)
+    # 会话存储中的 Message 记录转换为dict
+    assert selected == [{"role": "system", "content": "提示"}, {"role": "system", "content": "摘要"},
+                        {"role": "user", "content": "现在"}]
+    assert dropped == cost(user("旧"), assistant("旧"))
+
+
+def test_history_without_leading_user_forms_its_own_turn():
+    messages = [assistant("开场白"), user("问题")]
+    selected, _ = select_context(messages, max_tokens=100, prompt_budget=cost(user("问题")))
+    assert selected == [user("问题")]
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+对冲请求：备份请求另占一个准入名额，在途调用数不超过 max_inflight
+"""
+
+import asyncio
+
+from common_admission import AdmissionController
+from common_hedge import HedgePolicy
+
+
+def warmed_policy() -> HedgePolicy:
+    policy = HedgePolicy(enabled=True, min_delay=0.01, budget_ratio=1.0, min_samples=1)
+    policy.record_latency(0.01)
+    return policy
+
+
+def test_try_acquire_does_not_jump_the_queue():
+    async def main():
+        admission = AdmissionController(max_inflight=1)
+        assert admission.try_acquire()
+        assert not admission.try_acquire()
+        waiter = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        admission.release()
+        await waiter
+        # 名额转交给排队的请求
+        assert admission.inflight == 1
+        assert not admission.try_acquire()
+        admission.release()
+        assert admission.inflight == 0
+
+    asyncio.run(main())
+
+
+def test_backup_takes_its_own_slot():
+    async def main():
+        admission = AdmissionController(max_inflight=2)
+        policy = warmed_policy()
+        peak = 0
+
+        async def call(delay, result):
+            nonlocal peak
+            peak = max(peak, admission.inflight)
+            await asyncio.sleep(delay)
+            return result
+
+        async with admission.slot():
+            result = await policy.run(lambda: call(0.2, "primary"), lambda: call(0.01, "backup"),
+                                      try_acquire=admission.try_acquire, release=admission.release)
+        assert result == "backup"
+        assert policy.hedges == 1
+        assert peak == 2
+        await asyncio.sleep(0.01)
+        assert admission.inflight == 0
+
+    asyncio.run(main())
+
+
+def test_no_hedge_without_free_slot():
+    async def main():
+        admission = AdmissionController(max_inflight=1)
+        policy = warmed_policy()
+
+        async def call(result):
+            assert admission.inflight <= admission.max_inflight
+            await asyncio.sleep(0.05)
+            return result
+
+        async with admission.slot():
+            result = await policy.run(lambda: call("primary"), lambda: call("backup"),
+                                      try_acquire=admission.try_acquire, release=admission.release)
+        assert result == "primary"
+        assert policy.hedges == 0
+        assert policy.no_slot == 1
+        assert admission.inflight == 0
+
+    asyncio.run(main())
+
+
+def test_backup_slot_released_when_primary_wins():
+    async def main():
+        admission = AdmissionController(max_inflight=2)
+        policy = warmed_policy()
+
+        async def call(delay, result):
+            await asyncio.sleep(delay)
+            return result
+
+        async with admission.slot():
+            result = await policy.run(lambda: call(0.03, "primary"), lambda: call(1.0, "backup"),
+                                      try_acquire=admission.try_acquire, release=admission.release)
+        assert result == "primary"
+        # 被取消的备份请求结束后归还名额
+        await asyncio.sleep(0.01)
+        assert admission.inflight == 0
+
+    asyncio.run(main())
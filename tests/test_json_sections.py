@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+分段JSON的增量解析：任意切分输入得到相同的结果；不是预期格式的回复标记为失败
+"""
+
+import json
+import random
+
+import pytest
+
+from common_json_sections import JsonSectionParser, parse_json_sections
+
+ANSWER = {
+    "answer": "可以。\n结论\"是\"",
+    "statutes": "《民法典》第1048条 😀 \\ tab\t",
+    "analysis": "分析……" * 20,
+}
+
+
+@pytest.mark.parametrize("prefix,suffix", [("", ""), ("```json\n", "\n```"), ("```\n", "\n```"), ("  \n", "")])
+@pytest.mark.parametrize("ensure_ascii", [True, False])
+def test_incremental_feed_matches_whole_text(prefix, suffix, ensure_ascii):
+    text = prefix + json.dumps(ANSWER, ensure_ascii=ensure_ascii, indent=2) + suffix
+    rng = random.Random(0)
+    for _ in range(20):
+        parser = JsonSectionParser()
+        events = []
+        index = 0
+        while index < len(text):
+            size = rng.randint(1, 7)
+            events += parser.feed(text[index:index + size])
+            index += size
+        assert parser.done
+        assert parser.sections == ANSWER
+
+        deltas = {}
+        for kind, key, value in events:
+            if kind == "delta":
+                deltas[key] = deltas.get(key, "") + value
+        assert deltas == ANSWER
+        assert [key for kind, key, _ in events if kind == "section"] == ["answer", "statutes", "analysis"]
+
+
+@pytest.mark.parametrize("text", [
+    "这是普通文本回答\n法律分析：...",
+    '好的：{"answer": "x"}',
+    '{"answer": 1}',
+    '```json\nHere is the answer {"answer": "x"}',
+    '```jsonHere {"answer": "x"}',
+    '```python\n{"answer": "x"}',
+])
+def test_unexpected_format_falls_back(text):
+    assert parse_json_sections(text) is None
+
+
+def test_prose_after_fence_fails_before_object():
+    parser = JsonSectionParser()
+    parser.feed("```json\n")
+    assert not parser.failed
+    parser.feed("Here is")
+    assert parser.failed
+    assert parser.feed(' {"answer": "x"}') == []
+
+
+def test_truncated_reply_keeps_partial_section():
+    assert parse_json_sections('{"answer": "是", "statutes": "第一条", "analysis": "很长') == {
+        "answer": "是", "statutes": "第一条", "analysis": "很长",
+    }
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+指标导出：抓取时读取的累计计数为counter类型，当前值为gauge类型
+"""
+
+from common_metrics import MetricsRegistry
+
+
+def test_callback_counter_and_gauge_types():
+    registry = MetricsRegistry()
+    registry.callback_counter("cache_lookups_total", "查询数", lambda: {"hit": 3, "miss": 1}, ("result",))
+    registry.callback_gauge("queue_depth", "排队数", lambda: 2)
+    lines = registry.render().splitlines()
+    assert "# TYPE cache_lookups_total counter" in lines
+    assert 'cache_lookups_total{result="hit"} 3' in lines
+    assert "# TYPE queue_depth gauge" in lines
+    assert "queue_depth 2" in lines
+
+
+def test_api_metrics_totals_are_counters():
+    import api_metrics  # noqa: F401  注册各模块的指标
+    from common_metrics import metrics
+
+    types = {}
+    for line in metrics.render().splitlines():
+        if line.startswith("# TYPE "):
+            _, _, name, kind = line.split(" ")
+            types[name] = kind
+    for name, kind in types.items():
+        assert (kind == "counter") == name.endswith("_total"), name
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+AI响应缓存：是否允许缓存、TTL过期、LRU淘汰、落盘和恢复
+"""
+
+import json
+import time
+
+from common_response_cache import ResponseCache
+
+USAGE = {"prompt_tokens": 3, "completion_tokens": 2}
+
+
+def test_is_cacheable():
+    cache = ResponseCache(enabled_functions=["translate2En"], max_temperature=0.3)
+    assert cache.is_cacheable("translate2En", 0.9)
+    assert cache.is_cacheable("chat3", 0.2)
+    assert not cache.is_cacheable("chat3", 0.7)
+    assert not ResponseCache(enabled=False).is_cacheable("translate2En", 0)
+
+
+def test_make_key_depends_on_every_parameter():
+    base = ("glm-4-flash", "提示", "输入", 0.1, 100)
+    keys = {ResponseCache.make_key(*base)}
+    for index, value in enumerate(("glm-4", "提示2", "输入2", 0.2, 200)):
+        params = list(base)
+        params[index] = value
+        keys.add(ResponseCache.make_key(*params))
+    assert len(keys) == 6
+
+
+def test_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    cache = ResponseCache(ttl=10)
+    cache.put("k", "v", USAGE)
+    now[0] += 9
+    assert cache.get("k") == ("v", USAGE)
+    now[0] += 2
+    assert cache.get("k") is None
+    assert len(cache) == 0
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_lru_eviction():
+    cache = ResponseCache(max_entries=2)
+    cache.put("a", "1", USAGE)
+    cache.put("b", "2", USAGE)
+    # 读取a之后b成为最久未使用的
+    assert cache.get("a") is not None
+    cache.put("c", "3", USAGE)
+    assert cache.get("b") is None
+    assert cache.get("a").text == "1"
+    assert cache.get("c").text == "3"
+    assert cache.evictions == 1
+
+
+def test_persistence_round_trip(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.json")
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    cache = ResponseCache(persist_path=path, ttl=10)
+    cache.put("old", "旧", USAGE)
+    now[0] += 5
+    cache.put("a", "甲", USAGE)
+    cache.put("b", "乙", USAGE)
+    cache.get("a")
+    cache.save()
+    # 先写临时文件再替换，不留下临时文件
+    assert not (tmp_path / "cache.json.tmp").exists()
+    with open(path, encoding="utf-8") as f:
+        assert [item[0] for item in json.load(f)] == ["old", "b", "a"]
+
+    now[0] += 6
+    restored = ResponseCache(persist_path=path, ttl=10, max_entries=1)
+    restored.load()
+    # 已过期的条目跳过；超出容量时只保留最近使用的
+    assert len(restored) == 1
+    assert restored.get("a") == ("甲", USAGE)
+
+
+def test_load_ignores_missing_or_broken_file(tmp_path):
+    cache = ResponseCache(persist_path=str(tmp_path / "missing.json"))
+    cache.load()
+    assert len(cache) == 0
+    broken = tmp_path / "broken.json"
+    broken.write_text("{not json", encoding="utf-8")
+    cache = ResponseCache(persist_path=str(broken))
+    cache.load()
+    assert len(cache) == 0
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+会话快照：紧凑编码、增量写入和删除、重启后预加载最近的会话并按需加载其余会话
+"""
+
+import asyncio
+
+from common_session_snapshot import SessionSnapshot, decode_session, encode_session
+from common_session_store import Message, SessionRecord, SessionStore
+
+
+def test_encode_decode_round_trip():
+    record = SessionRecord(None, [Message("user", "问"), Message("assistant", "答"), Message("tool", "结果")],
+                           1234.5, summary="摘要", turns=3, summary_tokens=7)
+    pid, decoded = decode_session(encode_session("p1", record), 1234.5)
+    assert pid == "p1"
+    assert decoded == record
+
+    pid, decoded = decode_session(encode_session(None, SessionRecord(None, [], 1.0)), 1.0)
+    assert pid is None
+    assert decoded == SessionRecord(None, [], 1.0)
+
+
+def new_snapshot(path, store=None, eager_entries=10):
+    store = store or SessionStore()
+    snapshot = SessionSnapshot(store, path=path, interval=3600, eager_entries=eager_entries)
+    return store, snapshot
+
+
+def test_restore_after_restart(tmp_path):
+    path = str(tmp_path / "sessions.snapshot")
+
+    async def before_restart():
+        store, snapshot = new_snapshot(path)
+        await snapshot.start()
+        for name in ("old", "new"):
+            store.extend(name, [Message("system", "人设"), Message("user", f"{name}问"),
+                                Message("assistant", f"{name}答")])
+            await asyncio.sleep(0.01)
+        store.extend("new", [Message("user", "再问"), Message("assistant", "再答")])
+        _, _, token = store.compaction_candidate("new", trigger_messages=2, keep_messages=2)
+        assert store.apply_summary("new", token, "摘要", 5)
+        store.extend("gone", [Message("user", "删")])
+        await snapshot.snapshot()
+        store.delete("gone")
+        await snapshot.stop()
+        return snapshot
+
+    async def after_restart():
+        # 只预加载最近访问的一个会话，其余的按需加载
+        store, snapshot = new_snapshot(path, eager_entries=1)
+        await snapshot.start()
+        assert len(store) == 1
+        new = store.get("new")
+        old = store.get("old")
+        gone = store.get("gone")
+        await snapshot.stop()
+        return snapshot, store, new, old, gone
+
+    first = asyncio.run(before_restart())
+    assert first.written == 3
+    assert first.deleted == 1
+
+    snapshot, store, new, old, gone = asyncio.run(after_restart())
+    assert snapshot.restored == 1
+    assert [m.content for m in new] == ["人设", "摘要", "再问", "再答"]
+    assert store.info("new") == {"messages": 2, "turns": 2, "summary_tokens": 5}
+    assert [m.content for m in old] == ["人设", "old问", "old答"]
+    # 系统提示在各会话中共用同一个消息记录
+    assert new[0] is old[0]
+    assert store.paged_in == 1
+    assert gone is None
+
+
+def test_failed_write_is_retried(tmp_path, monkeypatch):
+    path = str(tmp_path / "sessions.snapshot")
+
+    async def main():
+        store, snapshot = new_snapshot(path)
+        await snapshot.start()
+        store.extend("k", [Message("user", "问")])
+        write = snapshot._write
+
+        def fail(changed, removed):
+            raise OSError("disk full")
+
+        monkeypatch.setattr(snapshot, "_write", fail)
+        await snapshot.snapshot()
+        assert snapshot.errors == 1
+        monkeypatch.setattr(snapshot, "_write", write)
+        # 失败的变更放回，下一次快照重新写入
+        await snapshot.snapshot()
+        assert snapshot.written == 1
+        await snapshot.stop()
+
+        store, snapshot = new_snapshot(path)
+        await snapshot.start()
+        restored = store.get("k")
+        await snapshot.stop()
+        return restored
+
+    assert [m.content for m in asyncio.run(main())] == ["问"]
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite会话存储：写事务在写入线程中执行，其他进程持有写锁时不阻塞事件循环
+"""
+
+import asyncio
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from common_session_store import Message, SqliteSessionStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SqliteSessionStore(path=str(tmp_path / "sessions.db"), max_messages=10)
+    yield store
+    store.close()
+
+
+def test_extend_and_get(store):
+    asyncio.run(store.extend_async("k", [Message("system", "提示"), Message("user", "问"), Message("assistant", "答")]))
+    assert [m.content for m in store.get("k")] == ["提示", "问", "答"]
+    assert store.info("k") == {"messages": 2, "turns": 1, "summary_tokens": 0}
+
+
+def test_truncation_keeps_prompt(store):
+    asyncio.run(store.extend_async("k", [Message("system", "提示")]))
+    for i in range(12):
+        asyncio.run(store.extend_async("k", [Message("user", f"问{i}")]))
+    messages = store.get("k")
+    assert len(messages) == 10
+    assert messages[0].content == "提示"
+    assert messages[-1].content == "问11"
+
+
+def test_apply_summary(store):
+    asyncio.run(store.extend_async("k", [Message("system", "提示")] +
+                                   [Message("user" if i % 2 == 0 else "assistant", str(i)) for i in range(8)]))
+    summary, folded, token = store.compaction_candidate("k", trigger_messages=4, keep_messages=2)
+    assert [m.content for m in folded] == ["0", "1", "2", "3", "4", "5"]
+    assert asyncio.run(store.apply_summary_async("k", token, "摘要", 2))
+    assert [m.content for m in store.get("k")] == ["提示", "摘要", "6", "7"]
+    # 已经替换过，同一个标记不再生效
+    assert not asyncio.run(store.apply_summary_async("k", token, "摘要2", 2))
+
+
+def test_truncation_keeps_prompt_and_summary(store):
+    asyncio.run(store.extend_async("k", [Message("system", "提示")] +
+                                   [Message("user" if i % 2 == 0 else "assistant", str(i)) for i in range(6)]))
+    _, _, token = store.compaction_candidate("k", trigger_messages=4, keep_messages=2)
+    assert store.apply_summary("k", token, "摘要", 2)
+    for i in range(6, 20):
+        asyncio.run(store.extend_async("k", [Message("user", str(i))]))
+    messages = store.get("k")
+    assert len(messages) == 10
+    assert [m.content for m in messages[:2]] == ["提示", "摘要"]
+    assert messages[-1].content == "19"
+    assert store.info("k")["messages"] == 8
+
+
+def test_write_lock_contention_does_not_block_event_loop(store):
+    asyncio.run(store.extend_async("k", [Message("user", "问")]))
+
+    # 另一个进程（连接）持有写锁 0.5 秒
+    locked = threading.Event()
+
+    def hold_lock():
+        conn = sqlite3.connect(store.path, isolation_level=None)
+        conn.execute("BEGIN IMMEDIATE")
+        locked.set()
+        time.sleep(0.5)
+        conn.execute("COMMIT")
+        conn.close()
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    locked.wait()
+
+    async def main():
+        ticks = 0
+        max_gap = 0.0
+
+        async def ticker():
+            nonlocal ticks, max_gap
+            last = time.perf_counter()
+            while True:
+                await asyncio.sleep(0.01)
+                now = time.perf_counter()
+                max_gap = max(max_gap, now - last)
+                last = now
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        started = time.perf_counter()
+        write = asyncio.create_task(store.extend_async("k", [Message("assistant", "答")]))
+        await asyncio.sleep(0.1)
+        # 等待写锁期间读取不受影响
+        assert not write.done()
+        assert [m.content for m in store.get("k")] == ["问"]
+        await write
+        waited = time.perf_counter() - started
+        assert [m.content for m in store.get("k")] == ["问", "答"]
+        task.cancel()
+        return waited, ticks, max_gap
+
+    waited, ticks, max_gap = asyncio.run(main())
+    holder.join()
+    assert waited >= 0.3
+    assert ticks >= 10
+    assert max_gap < 0.2
+
+
+def test_expired_session_is_deleted_before_next_append(store):
+    store.idle_ttl = 0.05
+    asyncio.run(store.extend_async("k", [Message("user", "旧")]))
+    time.sleep(0.1)
+    assert store.get("k") is None
+    asyncio.run(store.extend_async("k", [Message("user", "新")]))
+    store.idle_ttl = 3600
+    assert [m.content for m in store.get("k")] == ["新"]
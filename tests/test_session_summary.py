@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+会话滚动摘要：超过阈值时安排后台摘要、同一会话不重复安排、关闭时取消，
+以及摘要期间会话被修改时放弃结果（上游为桩函数）
+"""
+
+import asyncio
+
+import pytest
+
+import common_session_summary
+from common_session_store import Message, SessionStore
+from common_session_summary import SUMMARY_HEADER, SUMMARY_PRIORITY, SessionSummarizer
+
+
+def conversation(turns):
+    messages = [Message("system", "人设")]
+    for i in range(turns):
+        messages += [Message("user", f"问{i}"), Message("assistant", f"答{i}")]
+    return messages
+
+
+class Upstream:
+    """
+    摘要调用的桩函数：记录调用参数，在 release 被设置之前一直等待
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.release = asyncio.Event()
+
+    async def __call__(self, messages, model, temperature, max_tokens, priority):
+        self.calls.append((messages, priority))
+        await self.release.wait()
+        return "摘要"
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    fake = Upstream()
+    monkeypatch.setattr(common_session_summary, "async_chat_with_ai", fake)
+    return fake
+
+
+def new_summarizer(store, **kwargs):
+    return SessionSummarizer(store, enabled=True, trigger_messages=4, keep_messages=2, **kwargs)
+
+
+def test_summarizes_in_background_once_per_session(upstream):
+    async def main():
+        store = SessionStore()
+        summarizer = new_summarizer(store)
+        store.extend("short", conversation(2))
+        summarizer.maybe_schedule("short")
+        store.extend("long", conversation(3))
+        summarizer.maybe_schedule("long")
+        # 摘要进行中再次保存不会重复安排
+        summarizer.maybe_schedule("long")
+        await asyncio.sleep(0)
+        assert summarizer.stats()["pending"] == 1
+        assert len(upstream.calls) == 1
+        # 摘要期间追加的消息不受影响
+        store.extend("long", [Message("user", "新问"), Message("assistant", "新答")])
+        upstream.release.set()
+        await asyncio.gather(*summarizer._tasks)
+        return store, summarizer
+
+    store, summarizer = asyncio.run(main())
+    messages, priority = upstream.calls[0]
+    assert priority == SUMMARY_PRIORITY
+    assert "用户：问0" in messages[-1]["content"] and "问2" not in messages[-1]["content"]
+    assert [m.content for m in store.get("long")] == ["人设", SUMMARY_HEADER + "摘要", "问2", "答2", "新问", "新答"]
+    assert store.info("short")["summary_tokens"] == 0
+    stats = summarizer.stats()
+    assert stats["pending"] == 0
+    assert stats["summarized"] == 1
+    assert stats["folded_messages"] == 4
+
+
+def test_result_discarded_when_session_changed(upstream):
+    async def main():
+        store = SessionStore()
+        summarizer = new_summarizer(store)
+        store.extend("k", conversation(3))
+        summarizer.maybe_schedule("k")
+        await asyncio.sleep(0)
+        store.delete("k")
+        store.extend("k", conversation(3))
+        upstream.release.set()
+        await asyncio.gather(*summarizer._tasks)
+        return store, summarizer
+
+    store, summarizer = asyncio.run(main())
+    # 重新创建的同名会话不会被旧的摘要覆盖
+    assert [m.content for m in store.get("k")] == [m.content for m in conversation(3)]
+    assert summarizer.stats()["discarded"] == 1
+    assert summarizer.stats()["summarized"] == 0
+
+
+def test_apply_summary_rejects_stale_token():
+    store = SessionStore()
+    store.extend("k", conversation(3))
+    _, _, first = store.compaction_candidate("k", trigger_messages=4, keep_messages=2)
+    _, _, second = store.compaction_candidate("k", trigger_messages=4, keep_messages=2)
+    assert store.apply_summary("k", first, "摘要一", 3)
+    # 已被另一次摘要替换，同一批消息不能再折叠一次
+    assert not store.apply_summary("k", second, "摘要二", 3)
+    assert [m.content for m in store.get("k")] == ["人设", "摘要一", "问2", "答2"]
+
+    store.extend("t", conversation(3))
+    _, _, token = store.compaction_candidate("t", trigger_messages=4, keep_messages=2)
+    store.delete("t")
+    assert not store.apply_summary("t", token, "摘要", 3)
+
+
+def test_max_pending_and_stop(upstream):
+    async def main():
+        store = SessionStore()
+        summarizer = new_summarizer(store, max_pending=1)
+        for key in ("a", "b"):
+            store.extend(key, conversation(3))
+            summarizer.maybe_schedule(key)
+        await asyncio.sleep(0)
+        stats = summarizer.stats()
+        # 关闭时取消未完成的摘要，会话保持原样
+        await summarizer.stop()
+        return store, summarizer, stats
+
+    store, summarizer, stats = asyncio.run(main())
+    assert stats["pending"] == 1
+    assert stats["skipped"] == 1
+    assert summarizer.stats()["pending"] == 0
+    assert summarizer.stats()["summarized"] == 0
+    assert [m.content for m in store.get("a")] == [m.content for m in conversation(3)]
+
+
+def test_disabled_does_nothing(upstream):
+    store = SessionStore()
+    store.extend("k", conversation(5))
+    SessionSummarizer(store, enabled=False, trigger_messages=4).maybe_schedule("k")
+    assert upstream.calls == []
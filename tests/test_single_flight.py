@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+请求合并：流式调用的合并和重放，合并的请求共享上游调用的用量，合并的调用按等待者中最高的优先级排队；
+响应缓存保存用量
+"""
+
+import asyncio
+
+from common_admission import AdmissionController
+from common_response_cache import ResponseCache
+from common_single_flight import SingleFlight
+
+
+class FakeStream:
+    """
+    模拟上游的流式调用：逐段返回内容，结束前填好用量
+    """
+
+    def __init__(self, parts, delay=0.01, error=None):
+        self.parts = parts
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+        self.closed = False
+
+    def __call__(self):
+        self.calls += 1
+        usage = {"prompt_tokens": 0, "completion_tokens": 0}
+
+        async def chunks():
+            try:
+                for part in self.parts:
+                    await asyncio.sleep(self.delay)
+                    yield part
+                if self.error is not None:
+                    raise self.error
+                usage.update(prompt_tokens=10, completion_tokens=len(self.parts))
+            finally:
+                self.closed = True
+
+        return chunks(), usage
+
+
+async def collect(chunks):
+    return "".join([chunk async for chunk in chunks])
+
+
+def test_stream_followers_replay_and_share_usage():
+    async def main():
+        flight = SingleFlight()
+        upstream = FakeStream(["a", "b", "c", "d"])
+        first, first_usage = flight.stream("k", upstream)
+        leader = asyncio.create_task(collect(first))
+        await asyncio.sleep(0.025)
+        # 中途加入的请求从头拿到完整内容
+        second, second_usage = flight.stream("k", upstream)
+        assert await collect(second) == "abcd"
+        assert await leader == "abcd"
+        assert upstream.calls == 1
+        assert flight.folded == 1
+        assert first_usage is second_usage
+        assert second_usage == {"prompt_tokens": 10, "completion_tokens": 4}
+        assert len(flight) == 0
+
+    asyncio.run(main())
+
+
+def test_stream_error_reaches_every_subscriber():
+    async def main():
+        flight = SingleFlight()
+        upstream = FakeStream(["a"], error=RuntimeError("upstream failed"))
+        results = await asyncio.gather(collect(flight.stream("k", upstream)[0]),
+                                       collect(flight.stream("k", upstream)[0]),
+                                       return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert upstream.calls == 1
+
+    asyncio.run(main())
+
+
+def test_stream_cancelled_when_all_subscribers_leave():
+    async def main():
+        flight = SingleFlight()
+        upstream = FakeStream(["a"] * 100)
+        chunks, _ = flight.stream("k", upstream)
+        assert await chunks.__anext__() == "a"
+        await chunks.aclose()
+        await asyncio.sleep(0.05)
+        assert upstream.closed
+        assert len(flight) == 0
+        # 之后相同的请求重新发起调用
+        chunks, _ = flight.stream("k", upstream)
+        assert await chunks.__anext__() == "a"
+        assert upstream.calls == 2
+        await chunks.aclose()
+
+    asyncio.run(main())
+
+
+def test_one_subscriber_leaving_keeps_the_others():
+    async def main():
+        flight = SingleFlight()
+        upstream = FakeStream(["a", "b", "c"])
+        first, _ = flight.stream("k", upstream)
+        second, _ = flight.stream("k", upstream)
+        assert await first.__anext__() == "a"
+        await first.aclose()
+        assert await collect(second) == "abc"
+
+    asyncio.run(main())
+
+
+def test_folded_call_queues_with_highest_priority():
+    async def main():
+        flight = SingleFlight()
+        admission = AdmissionController(max_inflight=1)
+        await admission.acquire()
+        order = []
+
+        async def call(name, priority):
+            async with admission.slot(priority):
+                order.append(name)
+            return name
+
+        other = asyncio.create_task(call("mid", 1))
+        leader = asyncio.create_task(flight.do("k", lambda: call("k", 0), priority=0))
+        await asyncio.sleep(0)
+        # VIP加入普通用户发起的调用，已在排队的调用提前到 mid 之前
+        follower = asyncio.create_task(flight.do("k", lambda: call("k", 0), priority=2))
+        await asyncio.sleep(0)
+        admission.release()
+        results = await asyncio.gather(leader, follower, other)
+        return order, results, admission
+
+    order, results, admission = asyncio.run(main())
+    assert order == ["k", "mid"]
+    assert results == ["k", "k", "mid"]
+    assert admission.inflight == 0
+    assert admission.queue_depth == 0
+
+
+def test_folded_stream_queues_with_highest_priority():
+    async def main():
+        flight = SingleFlight()
+        admission = AdmissionController(max_inflight=1)
+        await admission.acquire()
+        order = []
+
+        def upstream():
+            async def chunks():
+                async with admission.slot(0):
+                    order.append("k")
+                    yield "k"
+            return chunks(), None
+
+        async def other():
+            async with admission.slot(1):
+                order.append("mid")
+
+        task = asyncio.create_task(other())
+        first, _ = flight.stream("k", upstream, priority=0)
+        leader = asyncio.create_task(collect(first))
+        await asyncio.sleep(0)
+        second, _ = flight.stream("k", upstream, priority=2)
+        admission.release()
+        await asyncio.gather(leader, collect(second), task)
+        return order
+
+    assert asyncio.run(main()) == ["k", "mid"]
+
+
+def test_response_cache_keeps_usage(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = ResponseCache(persist_path=path)
+    cache.put("k", "hello", {"prompt_tokens": 3, "completion_tokens": 2})
+    cache.save()
+
+    restored = ResponseCache(persist_path=path)
+    restored.load()
+    assert restored.get("k") == ("hello", {"prompt_tokens": 3, "completion_tokens": 2})
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+静态数据响应：只在监视的文件变化时重新生成，不监视文件时不访问文件系统
+"""
+
+import os
+
+import common_static_payload
+from common_static_payload import StaticPayload
+
+
+def test_no_watch_files_never_stats(monkeypatch):
+    payload = StaticPayload(lambda: {"a": 1}, check_interval=0)
+    calls = []
+    monkeypatch.setattr(common_static_payload.os, "stat", lambda path: calls.append(path))
+    payload._refresh_if_changed()
+    assert calls == []
+
+
+def test_rebuilds_when_watched_file_changes(tmp_path):
+    path = tmp_path / "data.txt"
+    path.write_text("1")
+    payload = StaticPayload(lambda: {"value": path.read_text()}, watch_files=(str(path),), check_interval=0)
+    etag = payload.etag
+
+    path.write_text("2")
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1_000_000))
+    payload._refresh_if_changed()
+    assert payload.body == b'{"value":"2"}'
+    assert payload.etag != etag
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+用量写后缓冲：日志追加、读取叠加、批量写入、崩溃后按批次号补写（不重复扣费）、按条数和间隔写入
+"""
+
+import asyncio
+import glob
+import os
+import shutil
+
+import pytest
+
+from common_user_store import ConnectionPool, UserStore, sqlite_connector
+from common_usage_buffer import UsageBuffer
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = UserStore(ConnectionPool(sqlite_connector(str(tmp_path / "users.db")), size=2), cache_ttl=60)
+    asyncio.run(store.add_user("o1", {}))
+    yield store
+    store.pool.close()
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return str(tmp_path / "usage.journal")
+
+
+def stored_usage(store, openid="o1"):
+    """
+    数据库中的值（不经过缓存和缓冲叠加）
+    """
+    rows = asyncio.run(store.pool.fetch(
+        "SELECT usedToken3, usedToken4, balanceAmount FROM users WHERE openid = ?", (openid,)))
+    return rows[0]
+
+
+def journal_files(journal):
+    return sorted(p for p in glob.glob(journal + "*") if not p.endswith(".lock"))
+
+
+def test_record_appends_journal_and_overlays_reads(store, journal):
+    buffer = UsageBuffer(store, journal_path=journal, debit_per_call=1)
+    buffer.record("o1", "3", 10, 5)
+    buffer.record("o1", "4", 7, 3)
+
+    with open(journal, encoding="utf-8") as f:
+        assert len(f.readlines()) == 2
+    assert buffer.pending_delta("o1") == {"usedToken3": 15, "usedToken4": 10, "balanceAmount": -2}
+    # 数据库还没有写入，checkUser 读到的是叠加后的值
+    assert stored_usage(store) == {"usedToken3": 0, "usedToken4": 0, "balanceAmount": 99}
+    user = asyncio.run(store.get_user("o1"))
+    assert (user["usedToken3"], user["usedToken4"], user["balanceAmount"]) == (15, 10, 97)
+
+
+def test_flush_writes_one_batch_and_removes_journal(store, journal):
+    buffer = UsageBuffer(store, journal_path=journal)
+    asyncio.run(store.get_user("o1"))
+    buffer.record("o1", "3", 10, 5)
+    buffer.record("o1", "3", 1, 1)
+    asyncio.run(buffer.flush())
+
+    assert stored_usage(store)["usedToken3"] == 17
+    assert buffer.pending_delta("o1") is None
+    assert journal_files(journal) == []
+    # 写入后缓存失效，不会叠加两次也不会读到旧值
+    assert asyncio.run(store.get_user("o1"))["usedToken3"] == 17
+    assert buffer.stats()["flushes"] == 1
+
+
+def test_recover_replays_rotated_and_live_journals(store, journal):
+    crashed = UsageBuffer(store, journal_path=journal)
+    crashed.record("o1", "3", 10, 0)
+    # 写入数据库之前崩溃：日志已切分成批次文件，之后又记录了一条
+    crashed._rotate_journal()
+    crashed.record("o1", "4", 5, 0)
+    crashed._journal.close()
+
+    restarted = UsageBuffer(store, journal_path=journal)
+    asyncio.run(restarted.recover())
+    assert stored_usage(store)["usedToken3"] == 10
+    assert stored_usage(store)["usedToken4"] == 5
+    assert journal_files(journal) == []
+
+
+def test_recover_skips_batches_already_applied(store, journal, tmp_path):
+    buffer = UsageBuffer(store, journal_path=journal)
+    buffer.record("o1", "3", 10, 0)
+    batch_path = buffer._rotate_journal()
+    kept = str(tmp_path / "kept")
+    shutil.copy(batch_path, kept)
+    buffer._batches[os.path.basename(batch_path)] = [batch_path, buffer._pending, False]
+    buffer._pending = {}
+    asyncio.run(buffer.flush())
+    # 提交之后、删除批次文件之前崩溃
+    shutil.copy(kept, batch_path)
+
+    asyncio.run(UsageBuffer(store, journal_path=journal).recover())
+    assert stored_usage(store)["usedToken3"] == 10
+    assert journal_files(journal) == []
+
+
+def test_failed_flush_retries_with_same_batch(store, journal, monkeypatch):
+    buffer = UsageBuffer(store, journal_path=journal)
+    buffer.record("o1", "3", 10, 0)
+    apply = buffer._apply
+
+    async def commit_then_fail(batch_id, deltas):
+        # 提交成功，但确认之前连接断开
+        await apply(batch_id, deltas)
+        raise ConnectionError("lost")
+
+    monkeypatch.setattr(buffer, "_apply", commit_then_fail)
+    asyncio.run(buffer.flush())
+    assert buffer.flush_errors == 1
+    # 批次仍在，读取时照样叠加
+    assert buffer.pending_delta("o1") == {"usedToken3": 10}
+
+    monkeypatch.setattr(buffer, "_apply", apply)
+    buffer.record("o1", "3", 1, 0)
+    asyncio.run(buffer.flush())
+    # 已提交的批次按批次号确认，不重复写入
+    assert stored_usage(store)["usedToken3"] == 11
+    assert buffer.pending_delta("o1") is None
+    assert journal_files(journal) == []
+
+
+def test_threshold_and_interval_trigger_flush(store, journal):
+    async def main():
+        buffer = UsageBuffer(store, journal_path=journal, flush_interval=3600, flush_threshold=2)
+        await buffer.start()
+        buffer.record("o1", "3", 1, 0)
+        await asyncio.sleep(0.1)
+        assert buffer.stats()["flushes"] == 0
+        buffer.record("o1", "3", 1, 0)
+        await asyncio.sleep(0.1)
+        assert buffer.stats()["flushes"] == 1
+        await buffer.stop()
+
+        buffer = UsageBuffer(store, journal_path=journal, flush_interval=0.05, flush_threshold=1000)
+        await buffer.start()
+        buffer.record("o1", "3", 1, 0)
+        await asyncio.sleep(0.2)
+        assert buffer.stats()["flushes"] >= 1
+        await buffer.stop()
+        return (await store.pool.fetch("SELECT usedToken3 FROM users WHERE openid = ?", ("o1",)))[0]
+
+    assert asyncio.run(main())["usedToken3"] == 3
+
+
+def test_record_chat_estimates_only_without_usage(store, journal):
+    buffer = UsageBuffer(store, journal_path=journal)
+    messages = [{"role": "user", "content": "你好"}]
+    buffer.record_chat("o1", "3", {"prompt_tokens": 4, "completion_tokens": 6}, messages, "回复")
+    assert buffer.pending_delta("o1") == {"usedToken3": 10}
+    buffer.record_chat("o1", "3", {"prompt_tokens": 0, "completion_tokens": 0}, messages, "回复")
+    assert buffer.pending_delta("o1")["usedToken3"] > 10
+
+    # 批量接口：整批合计为一条用量
+    buffer.record_chats("o1", "4", [({"prompt_tokens": 1, "completion_tokens": 2}, messages, "a"),
+                                    ({"prompt_tokens": 3, "completion_tokens": 4}, messages, "b")])
+    assert buffer.pending_delta("o1")["usedToken4"] == 10
+    assert buffer.stats()["recorded"] == 3
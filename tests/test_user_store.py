@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+用户存储：在临时的SQLite文件上验证用户写入、余额检查和读穿透缓存
+"""
+
+import asyncio
+
+import pytest
+
+import common_user_store
+from common_user_store import ConnectionPool, UserStore, check_user_balance, sqlite_connector
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = UserStore(ConnectionPool(sqlite_connector(str(tmp_path / "users.db")), size=2), cache_ttl=60)
+    # 各接口经模块级的 check_user_balance 使用共享实例
+    monkeypatch.setattr(common_user_store, "user_store", store)
+    yield store
+    store.pool.close()
+
+
+def count_fetches(store, monkeypatch):
+    """
+    统计读库次数
+    """
+    calls = []
+    fetch = store.pool.fetch
+
+    async def counting_fetch(sql, params=()):
+        calls.append(sql)
+        return await fetch(sql, params)
+
+    monkeypatch.setattr(store.pool, "fetch", counting_fetch)
+    return calls
+
+
+def set_balance(store, openid, balance, free_try):
+    asyncio.run(store.pool.execute(
+        "UPDATE users SET balanceAmount = ?, freeTry = ? WHERE openid = ?", (balance, free_try, openid)))
+
+
+def test_add_user_inserts_then_updates_device_fields(store):
+    user = asyncio.run(store.add_user("o1", {"brand": "Apple", "model": "", "nickName": "x"}))
+    assert user["brand"] == "Apple"
+    # 空值和非设备字段不写入，使用默认值
+    assert user["model"] == "Unknown"
+    assert user["nickName"] == "User"
+    assert user["balanceAmount"] == 99
+
+    set_balance(store, "o1", 5, 0)
+    again = asyncio.run(store.add_user("o1", {"brand": "Huawei", "model": "P60"}))
+    assert again["brand"] == "Huawei"
+    assert again["model"] == "P60"
+    # 老用户只更新设备信息
+    assert again["balanceAmount"] == 5
+    assert again["createDate"] == user["createDate"]
+
+
+def test_check_user_balance(store):
+    asyncio.run(store.add_user("rich", {}))
+    asyncio.run(store.add_user("poor", {}))
+    set_balance(store, "poor", 0, 0)
+    store.invalidate("poor")
+
+    assert asyncio.run(check_user_balance("rich")) == (True, "ok")
+    assert asyncio.run(check_user_balance("poor")) == (False, "runOut")
+    assert asyncio.run(check_user_balance("poor", "noMoney")) == (False, "noMoney")
+    assert asyncio.run(check_user_balance("nobody")) == (False, "noUser")
+
+
+def test_free_try_allows_zero_balance(store):
+    asyncio.run(store.add_user("o1", {}))
+    set_balance(store, "o1", 0, 3)
+    store.invalidate("o1")
+    assert asyncio.run(check_user_balance("o1")) == (True, "ok")
+
+
+def test_cache_hit_within_ttl_skips_database(store, monkeypatch):
+    asyncio.run(store.add_user("o1", {}))
+    fetches = count_fetches(store, monkeypatch)
+
+    first = asyncio.run(store.get_user_info("o1"))
+    second = asyncio.run(store.get_user_info("o1"))
+    assert first == second == {"exists": True, "vip": 1, "balance": 99, "freeTry": 0}
+    assert len(fetches) == 1
+    assert store.hits == 1 and store.misses == 1
+
+
+def test_cache_expires_after_ttl(store, monkeypatch):
+    store.cache_ttl = 0
+    asyncio.run(store.add_user("o1", {}))
+    fetches = count_fetches(store, monkeypatch)
+    asyncio.run(store.get_user_info("o1"))
+    asyncio.run(store.get_user_info("o1"))
+    assert len(fetches) == 2
+
+
+def test_write_invalidates_cache(store, monkeypatch):
+    asyncio.run(store.add_user("o1", {}))
+    assert asyncio.run(store.get_user_info("o1"))["balance"] == 99
+
+    set_balance(store, "o1", 7, 0)
+    # 未失效时仍是缓存中的旧值
+    assert asyncio.run(store.get_user_info("o1"))["balance"] == 99
+
+    fetches = count_fetches(store, monkeypatch)
+    asyncio.run(store.add_user("o1", {"brand": "Apple"}))
+    assert "o1" not in store._cache
+    assert asyncio.run(store.get_user_info("o1"))["balance"] == 7
+    assert any("balanceAmount" in sql for sql in fetches)
+
+
+def test_missing_user_is_cached_until_added(store, monkeypatch):
+    fetches = count_fetches(store, monkeypatch)
+    assert not asyncio.run(store.get_user_info("o1"))["exists"]
+    assert not asyncio.run(store.get_user_info("o1"))["exists"]
+    assert len(fetches) == 1
+
+    asyncio.run(store.add_user("o1", {}))
+    assert asyncio.run(store.get_user_info("o1"))["exists"]
+
+
+def test_load_overlapping_write_is_not_cached(store, monkeypatch):
+    asyncio.run(store.add_user("o1", {}))
+    fetch = store.pool.fetch
+
+    async def fetch_then_write(sql, params=()):
+        rows = await fetch(sql, params)
+        # 读库返回之前，另一个请求写入了该用户
+        store.invalidate("o1")
+        return rows
+
+    monkeypatch.setattr(store.pool, "fetch", fetch_then_write)
+    assert asyncio.run(store.get_user_info("o1"))["balance"] == 99
+    assert "o1" not in store._cache
+
+    monkeypatch.setattr(store.pool, "fetch", fetch)
+    fetches = count_fetches(store, monkeypatch)
+    asyncio.run(store.get_user_info("o1"))
+    assert len(fetches) == 1
+    assert "o1" in store._cache
+
+
+def test_pending_usage_is_applied_on_top_of_cache(store):
+    asyncio.run(store.add_user("o1", {}))
+    store.set_pending_source(lambda openid: {"balanceAmount": -99} if openid == "o1" else None)
+    assert asyncio.run(store.get_user_info("o1"))["balance"] == 0
+    assert asyncio.run(check_user_balance("o1")) == (False, "runOut")
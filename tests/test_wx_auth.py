@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+微信登录：只在连接失败和5xx时重试，读取超时和无法解析的返回不重试、按错误格式返回（微信接口为 MockTransport）
+"""
+
+import asyncio
+
+import httpx
+import pytest
+
+import api_wxAuth
+from common_config import config
+
+
+@pytest.fixture
+def wechat(monkeypatch):
+    """
+    按顺序返回 responses 中的响应（异常则抛出），记录请求次数
+    """
+    saved = dict(config["wechat"]) if config.has_section("wechat") else None
+    config.read_dict({"wechat": {"appid": "app", "secret": "secret", "max_retries": "2", "retry_delay": "0"}})
+    responses = []
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(api_wxAuth, "_http_client",
+                        httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="https://wx.test"))
+    yield responses, requests
+    config.remove_section("wechat")
+    if saved is not None:
+        config.read_dict({"wechat": saved})
+
+
+def test_retries_connect_errors_and_5xx(wechat):
+    responses, requests = wechat
+    responses += [httpx.ConnectError("refused"), httpx.Response(502),
+                  httpx.Response(200, json={"openid": "o1", "session_key": "k"})]
+    result = asyncio.run(api_wxAuth.getOpenId("code"))
+    assert result == {"openid": {"openid": "o1", "session_key": "k"}}
+    assert len(requests) == 3
+    assert requests[0].url.params["js_code"] == "code"
+
+
+def test_business_error_is_returned_as_is(wechat):
+    responses, requests = wechat
+    responses.append(httpx.Response(200, json={"errcode": 40163, "errmsg": "code been used"}))
+    result = asyncio.run(api_wxAuth.getOpenId("code"))
+    assert result == {"openid": {"errcode": 40163, "errmsg": "code been used"}}
+    assert len(requests) == 1
+
+
+def test_read_timeout_is_not_retried(wechat):
+    responses, requests = wechat
+    responses += [httpx.ReadTimeout("slow"), httpx.Response(200, json={"openid": "o1"})]
+    result = asyncio.run(api_wxAuth.getOpenId("code"))
+    # 请求可能已经到达微信，code已被使用
+    assert result["openid"]["errcode"] == -1
+    assert len(requests) == 1
+
+
+def test_unparsable_body_returns_error(wechat):
+    responses, requests = wechat
+    responses.append(httpx.Response(200, text="<html>维护中</html>"))
+    result = asyncio.run(api_wxAuth.getOpenId("code"))
+    assert result["openid"]["errcode"] == -1
+    assert len(requests) == 1
+
+
+def test_retries_exhausted(wechat):
+    responses, requests = wechat
+    responses += [httpx.Response(503)] * 3
+    result = asyncio.run(api_wxAuth.getOpenId("code"))
+    assert result["openid"]["errcode"] == -1
+    assert "503" in result["openid"]["errmsg"]
+    assert len(requests) == 3